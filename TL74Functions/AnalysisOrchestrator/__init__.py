@@ -0,0 +1,16 @@
+import logging
+
+from azure.functions import QueueMessage
+from shared_code.instrumentation import span
+from .orchestrator import run_filing_orchestration
+
+
+def main(msg: QueueMessage) -> None:
+    logging.info(f"Queue trigger function processed message {msg.id}.")
+
+    # Root span of the invocation, the parent of the spans of its stages
+    with span("function.AnalysisOrchestrator", message_id=msg.id) as current:
+        response_message, status_code = run_filing_orchestration(msg.get_json())
+        current.set(status_code=status_code)
+
+    logging.info(f"Orchestration finished with status {status_code}: {response_message}")
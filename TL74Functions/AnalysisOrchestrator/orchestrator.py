@@ -0,0 +1,75 @@
+import os
+import json
+import logging
+from shared_code.cosmos import get_container
+from shared_code.orchestration import (
+    Stage,
+    failed_transiently,
+    running_elsewhere,
+    orchestration_status_code,
+    orchestration_summary,
+    run_orchestration,
+    start_orchestration,
+)
+from shared_code.work_queue import payload_request
+
+# The activities call the analysis wrappers in-process, through the same code path as their HTTP and
+# queue triggers, so each analysis still records its own run and stores its result on the filing.
+# The wrappers are imported when a stage runs, so loading the EntryPoint stays cheap.
+
+def financial_health_activity(accession_code, ticker, date, form, force=False):
+    from FinancialHealth.fha_wrapper import fha_wrapper
+    return fha_wrapper(activity_request(accession_code, ticker, date, form, force))
+
+def llm_activity(accession_code, ticker, date, form, force=False):
+    from LLMAnalysis.llm_analy_wrapper import initialize_llm_workflow
+    return initialize_llm_workflow(activity_request(accession_code, ticker, date, form, force))
+
+def thirteenf_activity(accession_code, ticker, date, form, force=False):
+    from ThirteenF.wrapper_13f import initialize_13f_workflow
+    return initialize_13f_workflow(activity_request(accession_code, ticker, date, form, force))
+
+def activity_request(accession_code, ticker, date, form, force=False):
+    return payload_request({
+        "accession_code": accession_code,
+        "ticker": ticker,
+        "date": date,
+        "form": form,
+        "force": force
+    })
+
+def filing_stages(form):
+    # The analysis DAG of a form. The financial health and LLM analyses of a 10-K or 10-Q are
+    # independent, so they run in parallel; forms without analyses have no stages.
+    if form == "10-K" or form == "10-Q":
+        return [Stage("fha", financial_health_activity), Stage("llm", llm_activity)]
+    if form == "13F-HR":
+        return [Stage("13f", thirteenf_activity)]
+    return []
+
+def run_filing_orchestration(payload):
+    # Run, or resume, the orchestration of a queued filing. Raises while a stage failed transiently, so
+    # the message is delivered again and only the stages that are not completed run again. Also raises
+    # while another run holds the orchestration: if that run crashed or timed out, the redelivered
+    # message takes the orchestration over once its lease expires.
+    accession_code = payload.get("accession_code")
+    ticker = payload.get("ticker")
+    stages = filing_stages(payload.get("form"))
+    if not (accession_code and ticker and stages):
+        logging.error(f"Dropping orchestration message without a filing to analyze: {payload}")
+        return "Nothing to orchestrate.", 400
+
+    filings_container = get_container(os.getenv("COSMOS_DB_CONTAINER_FILINGS"))
+    # The EntryPoint created the orchestration, and reset it when forced; created here for messages
+    # sent without it
+    orchestration = start_orchestration(
+        filings_container, accession_code, ticker, payload.get("date"), payload.get("form"), stages
+    )
+    orchestration = run_orchestration(filings_container, orchestration, stages)
+
+    summary = json.dumps(orchestration_summary(orchestration))
+    if running_elsewhere(orchestration):
+        raise RuntimeError(f"Orchestration of {accession_code} is held by another run: {summary}")
+    if failed_transiently(orchestration):
+        raise RuntimeError(f"Orchestration of {accession_code} has failed stages to retry: {summary}")
+    return summary, orchestration_status_code(orchestration)
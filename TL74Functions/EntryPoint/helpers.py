@@ -1,7 +1,25 @@
 import os
+import json
 import logging
 import requests
-from azure.cosmos import CosmosClient
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from azure.cosmos.exceptions import CosmosResourceExistsError
+from shared_code.cosmos import get_container
+from shared_code.downstream import get_downstream_session
+from shared_code.idempotency import is_forced
+from shared_code.instrumentation import span
+from shared_code.orchestration import COMPLETED, orchestration_status_code, orchestration_summary, start_orchestration
+from shared_code.resilience import CircuitOpenError
+from shared_code.work_queue import get_work_queue, FHA_QUEUE, LLM_QUEUE, ORCHESTRATION_QUEUE, THIRTEENF_QUEUE
+from AnalysisOrchestrator.orchestrator import filing_stages
+
+# Seconds to wait for a downstream analysis before reporting it as dispatched (still running).
+# The LLM analysis takes minutes, so by default it is only dispatched rather than awaited.
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_FHA_TIMEOUT = 120
+DEFAULT_13F_TIMEOUT = 120
+DEFAULT_LLM_TIMEOUT = 15
 
 def process_filing_request(req):    
     # Retrieve query parameters
@@ -9,6 +27,7 @@ def process_filing_request(req):
     ticker = req.params.get("ticker")
     date = req.params.get("date")
     form = req.params.get("form")
+    force = is_forced(req.params.get("force"))
 
     # Parse JSON body if needed
     if not (accession_code and ticker and date and form):
@@ -20,35 +39,37 @@ def process_filing_request(req):
         ticker = ticker or req_body.get("ticker")
         date = date or req_body.get("date")
         form = form or req_body.get("form")
+        force = force or is_forced(req_body.get("force"))
 
     # Proceed if all required parameters are available
     if accession_code and ticker and date and form:
         try:
             # Add the filing entry to Cosmos DB
-            response_message, status_code = add_filing_entry(accession_code, ticker, date, form)
+            response_message, status_code = add_filing_entry(accession_code, ticker, date, form, force)
             if status_code != 200:
                 return response_message, status_code
             logging.info(f"Filing entry added: {response_message}")
 
+            # Dispatch the downstream analyses for this form concurrently, over HTTP or through the
+            # work queues, or run them as an orchestration, depending on ANALYSIS_DISPATCH_MODE
+            dispatch_mode = os.getenv("ANALYSIS_DISPATCH_MODE", "http").lower()
+            if dispatch_mode == "orchestrate" and filing_stages(form):
+                return orchestrate_analyses(accession_code, ticker, date, form, force)
+
+            queued = dispatch_mode == "queue"
             if form == "10-K" or form == "10-Q":
-                logging.info(f"Triggering financial health analysis for {form}.")
-                response_message, status_code = call_financial_health_analysis(accession_code, ticker, date, form)
-                if status_code != 200:
-                    return response_message, status_code
-                
-                # Call LLM Analysis
-                logging.info(f"Triggering LLM analysis for {form}.")
-                response_message, status_code = call_llm_analysis(accession_code, ticker, date, form)
-                if status_code != 200:
-                    return response_message, status_code
-
-
-            if form == "13F-HR":
-                # Call 13F-HR analysis trigger
-                print("13F-HR analysis trigger called.")
-                response_message, status_code = call_13f_analysis(accession_code, ticker, date, form)
-                if status_code != 200:
-                    return response_message, status_code
+                if queued:
+                    analysis_calls = [queue_financial_health_analysis, queue_llm_analysis]
+                else:
+                    analysis_calls = [call_financial_health_analysis, call_llm_analysis]
+            elif form == "13F-HR":
+                analysis_calls = [queue_13f_analysis] if queued else [call_13f_analysis]
+            else:
+                analysis_calls = []
+
+            if analysis_calls:
+                logging.info(f"Triggering {len(analysis_calls)} analyses for {form}.")
+                return dispatch_analyses(analysis_calls, accession_code, ticker, date, form, force)
 
             return response_message, 200
         except Exception as e:
@@ -63,7 +84,7 @@ def process_filing_request(req):
         return error_msg, 400
     
 
-def add_filing_entry(accession_code, ticker, date, form):
+def add_filing_entry(accession_code, ticker, date, form, force=False):
     COSMOS_DB_URL = os.getenv("COSMOS_DB_URL")
     COSMOS_DB_KEY = os.getenv("COSMOS_DB_KEY")
     COSMOS_DB_DATABASE = os.getenv("COSMOS_DB_DATABASE")
@@ -78,9 +99,7 @@ def add_filing_entry(accession_code, ticker, date, form):
         return error_msg, 500
 
     try:
-        client = CosmosClient(COSMOS_DB_URL, COSMOS_DB_KEY)
-        database = client.get_database_client(COSMOS_DB_DATABASE)
-        filings_container = database.get_container_client(COSMOS_DB_CONTAINER_FILINGS)
+        filings_container = get_container(COSMOS_DB_CONTAINER_FILINGS)
 
         filing_entry = {
             "id": accession_code,
@@ -90,7 +109,15 @@ def add_filing_entry(accession_code, ticker, date, form):
             "analyses": [],
         }
 
-        filings_container.upsert_item(filing_entry)
+        if force:
+            # Start over from an empty filing entry
+            filings_container.upsert_item(filing_entry)
+        else:
+            # A repeated notification must not wipe the analyses already stored for the filing
+            try:
+                filings_container.create_item(filing_entry)
+            except CosmosResourceExistsError:
+                logging.info(f"Filing entry for {accession_code} already exists, keeping its analyses.")
 
         response_message = (
             f"Received data: Accession Code - {accession_code}, "
@@ -102,8 +129,28 @@ def add_filing_entry(accession_code, ticker, date, form):
         logging.error(f"An error occurred: {e}")
         return "An error occurred while processing your request.", 500
 
-def call_financial_health_analysis(accession_code, ticker, date, form):
-    FINANICAL_HEALTH_ANALYSIS_URL = 'https://tl74functionsapp.azurewebsites.net/api/FinancialHealth'
+def dispatch_analyses(analysis_calls, accession_code, ticker, date, form, force=False):
+    # Run the analysis calls in parallel so the entry point waits for the slowest one rather than
+    # their sum. Each call is bounded by its own timeout; a call still running when its timeout
+    # expires has been delivered and keeps running downstream, so it is reported as dispatched.
+    # Each call runs in a copy of the caller's context, so its spans belong to the invocation.
+    with ThreadPoolExecutor(max_workers=len(analysis_calls)) as executor:
+        futures = {
+            analysis_call.__name__.removeprefix("call_").removeprefix("queue_"): executor.submit(contextvars.copy_context().run, analysis_call, accession_code, ticker, date, form, force)
+            for analysis_call in analysis_calls
+        }
+        results = {name: future.result() for name, future in futures.items()}
+
+    summary = {
+        name: {"status": status_code, "message": response_message}
+        for name, (response_message, status_code) in results.items()
+    }
+    failed = [status_code for _, status_code in results.values() if status_code not in (200, 202)]
+    status_code = failed[0] if failed else 200
+
+    return json.dumps({"accession_code": accession_code, "form": form, "analyses": summary}), status_code
+
+def call_analysis(analysis_name, analysis_url, read_timeout, accession_code, ticker, date, form, force=False, timeouts_are_failures=True):
     TRIGGER_API_KEY = os.getenv("TRIGGER_API_KEY")
 
     if not TRIGGER_API_KEY:
@@ -117,86 +164,102 @@ def call_financial_health_analysis(accession_code, ticker, date, form):
         "accession_code": accession_code,
         "ticker": ticker,
         "date": date,
-        "form": form
+        "form": form,
+        "force": force
     }
 
-    logging.info(f"Payload for financial health analysis: {payload}")
+    timeout = (float(os.getenv("ANALYSIS_CONNECT_TIMEOUT", DEFAULT_CONNECT_TIMEOUT)), read_timeout)
+
+    logging.info(f"Payload for {analysis_name}: {payload}")
     try:
-        finanical_analysis_endpoint = f"{FINANICAL_HEALTH_ANALYSIS_URL}?code={TRIGGER_API_KEY}"
-        response = requests.post(finanical_analysis_endpoint, json=payload)
+        analysis_endpoint = f"{analysis_url}?code={TRIGGER_API_KEY}"
+        # Retried on 429 and 5xx, and failed fast while the function's circuit is open
+        with span("http.analysis", analysis=analysis_name, url=analysis_url) as current:
+            response = get_downstream_session().post(
+                analysis_url, analysis_endpoint, timeouts_are_failures=timeouts_are_failures, json=payload, timeout=timeout
+            )
+            current.set(status_code=response.status_code)
+            current.add_bytes(len(response.content))
 
         if response.status_code == 200:
-            logging.info("Financial health analysis triggered successfully.")
+            logging.info(f"{analysis_name} triggered successfully.")
             return response.text, 200
         else:
-            logging.error(f"Failed to trigger financial health analysis: {response.status_code}")
+            logging.error(f"Failed to trigger {analysis_name}: {response.status_code}")
             return f"Error: {response.status_code}", response.status_code
+    except requests.exceptions.ReadTimeout:
+        logging.info(f"{analysis_name} dispatched, still running after {read_timeout}s.")
+        return f"{analysis_name} dispatched and still running.", 202
+    except CircuitOpenError as ex:
+        logging.error(f"Not triggering {analysis_name}: {ex}")
+        return f"{analysis_name} is unavailable: {ex}", 503
     except Exception as ex:
-        logging.error(f"Failed to trigger analysis: {ex}")
+        logging.error(f"Failed to trigger {analysis_name}: {ex}")
         return str(ex), 500
+
+def call_financial_health_analysis(accession_code, ticker, date, form, force=False):
+    FINANICAL_HEALTH_ANALYSIS_URL = 'https://tl74functionsapp.azurewebsites.net/api/FinancialHealth'
+    read_timeout = float(os.getenv("FHA_TIMEOUT", DEFAULT_FHA_TIMEOUT))
+    return call_analysis("Financial health analysis", FINANICAL_HEALTH_ANALYSIS_URL, read_timeout, accession_code, ticker, date, form, force)
     
-def call_llm_analysis(accession_code, ticker, date, form):
+def call_llm_analysis(accession_code, ticker, date, form, force=False):
     LLM_ANALYSIS_URL = 'https://tl74functionsapp.azurewebsites.net/api/LLMAnalysis'
-    TRIGGER_API_KEY = os.getenv("TRIGGER_API_KEY")
-
-    if not TRIGGER_API_KEY:
-        error_msg = (
-            "Missing TRIGGER_API_KEY configuration. Please ensure 'TRIGGER_API_KEY' is set."
-        )
-        logging.error(error_msg)
-        return error_msg, 500
+    read_timeout = float(os.getenv("LLM_TIMEOUT", DEFAULT_LLM_TIMEOUT))
+    # The LLM analysis outlives its read timeout by design, so timing out says nothing about its health
+    return call_analysis("LLM analysis", LLM_ANALYSIS_URL, read_timeout, accession_code, ticker, date, form, force, timeouts_are_failures=False)
+    
+def call_13f_analysis(accession_code, ticker, date, form, force=False):
+    ANALYSIS_13F = 'https://tl74functionsapp.azurewebsites.net/api/ThirteenF'
+    read_timeout = float(os.getenv("THIRTEENF_TIMEOUT", DEFAULT_13F_TIMEOUT))
+    return call_analysis("13F analysis", ANALYSIS_13F, read_timeout, accession_code, ticker, date, form, force)
 
+def enqueue_analysis(analysis_name, queue_name, accession_code, ticker, date, form, force=False):
     payload = {
         "accession_code": accession_code,
         "ticker": ticker,
         "date": date,
-        "form": form
+        "form": form,
+        "force": force
     }
 
-    logging.info(f"Payload for LLM analysis: {payload}")
     try:
-        llm_analysis_endpoint = f"{LLM_ANALYSIS_URL}?code={TRIGGER_API_KEY}"
-        response = requests.post(llm_analysis_endpoint, json=payload)
-
-        if response.status_code == 200:
-            logging.info("LLM analysis triggered successfully.")
-            return response.text, 200
-        else:
-            logging.error(f"Failed to trigger LLM analysis: {response.status_code}")
-            return f"Error: {response.status_code}", response.status_code
+        message_id = get_work_queue(queue_name).send(payload)
+        logging.info(f"{analysis_name} queued on {queue_name} as message {message_id}.")
+        return f"{analysis_name} queued.", 202
     except Exception as ex:
-        logging.error(f"Failed to trigger LLM analysis: {ex}")
+        logging.error(f"Failed to queue {analysis_name}: {ex}")
         return str(ex), 500
-    
-def call_13f_analysis(accession_code, ticker, date, form):
-    ANALYSIS_13F = 'https://tl74functionsapp.azurewebsites.net/api/ThirteenF'
-    TRIGGER_API_KEY = os.getenv("TRIGGER_API_KEY")
 
-    if not TRIGGER_API_KEY:
-        error_msg = (
-            "Missing TRIGGER_API_KEY configuration. Please ensure 'TRIGGER_API_KEY' is set."
-        )
-        logging.error(error_msg)
-        return error_msg, 500
+def queue_financial_health_analysis(accession_code, ticker, date, form, force=False):
+    return enqueue_analysis("Financial health analysis", FHA_QUEUE, accession_code, ticker, date, form, force)
 
-    payload = {
-        "accession_code": accession_code,
-        "ticker": ticker,
-        "date": date,
-        "form": form
-    }
+def queue_llm_analysis(accession_code, ticker, date, form, force=False):
+    return enqueue_analysis("LLM analysis", LLM_QUEUE, accession_code, ticker, date, form, force)
 
-    logging.info(f"Payload for 13F analysis: {payload}")
+def queue_13f_analysis(accession_code, ticker, date, form, force=False):
+    return enqueue_analysis("13F analysis", THIRTEENF_QUEUE, accession_code, ticker, date, form, force)
+
+def orchestrate_analyses(accession_code, ticker, date, form, force=False):
+    # Start the orchestration of the filing's analyses, or resume the one a previous request started,
+    # and hand it to the AnalysisOrchestrator. Responds with the checkpointed state of every stage;
+    # an orchestration whose stages are all completed is not run again.
     try:
-        thirteenf_analysis_endpoint = f"{ANALYSIS_13F}?code={TRIGGER_API_KEY}"
-        response = requests.post(thirteenf_analysis_endpoint, json=payload)
+        filings_container = get_container(os.getenv("COSMOS_DB_CONTAINER_FILINGS"))
+        orchestration = start_orchestration(filings_container, accession_code, ticker, date, form, filing_stages(form), force)
+        summary = json.dumps(orchestration_summary(orchestration))
+        if orchestration.get("status") == COMPLETED:
+            logging.info(f"Orchestration of {accession_code} already completed.")
+            return summary, orchestration_status_code(orchestration)
 
-        if response.status_code == 200:
-            logging.info("13F analysis triggered successfully.")
-            return response.text, 200
-        else:
-            logging.error(f"Failed to trigger 13F analysis: {response.status_code}")
-            return f"Error: {response.status_code}", response.status_code
+        message_id = get_work_queue(ORCHESTRATION_QUEUE).send({
+            "accession_code": accession_code,
+            "ticker": ticker,
+            "date": date,
+            "form": form,
+            "force": force
+        })
+        logging.info(f"Orchestration of {accession_code} queued on {ORCHESTRATION_QUEUE} as message {message_id}.")
+        return summary, 202
     except Exception as ex:
-        logging.error(f"Failed to trigger 13F analysis: {ex}")
-        return str(ex), 500
\ No newline at end of file
+        logging.error(f"Failed to start the orchestration of {accession_code}: {ex}")
+        return str(ex), 500
@@ -1,12 +1,16 @@
 import logging
 
 from azure.functions import HttpRequest, HttpResponse
+from shared_code.instrumentation import span
 from .fha_wrapper import fha_wrapper
 
 
 def main(req: HttpRequest) -> HttpResponse:
     logging.info("HTTP trigger function processed a request.")
 
-    response_message, status_code = fha_wrapper(req)
+    # Root span of the invocation, the parent of the spans of its stages
+    with span("function.FinancialHealth") as current:
+        response_message, status_code = fha_wrapper(req)
+        current.set(status_code=status_code)
 
     return HttpResponse(response_message, status_code=status_code)
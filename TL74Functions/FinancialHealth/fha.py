@@ -1,289 +1,99 @@
-from edgar import *
+from edgar import Company, get_by_accession_number
 import pandas as pd
-from dotenv import load_dotenv
-import os
 import json
+import logging
+from .metrics import evaluate_metrics
+from .raw_codec import encode_raw, get_raw_format
+from shared_code.facts_cache import get_facts_cache
+from shared_code.edgar_session import configure_edgar
+from shared_code.instrumentation import current_span, span, traced
+
+def build_fact_table(company_subset):
+    # Resolve each us-gaap fact of each filing to the value of its latest-ending row, one row per
+    # accession and one column per fact, so metric inputs never require scanning the facts frame
+    latest_rows = company_subset.groupby(['accn', 'fact'])['timestamp'].idxmax()
+    latest = company_subset.loc[latest_rows]
+    return latest.assign(val=latest['val'].astype(object)).pivot(index='accn', columns='fact', values='val')
 
 def fha(accn):
+    return fha_many([accn])[str(accn)]
 
-    identity = os.getenv("EDGAR_IDENTITY")
-    set_identity(identity)
+@traced("fha.analyze")
+def fha_many(accns):
+    # Analyze several filings, downloading and parsing each company's facts only once.
+    # Returns a dict keyed by accession number holding each filing's result or error message.
+    # Sets the identity and the shared EDGAR session up once per worker process
+    edgar_session = configure_edgar()
 
-    class DB_ANALYSIS:
-        def __init__(self):
-            self.value = None
-            self.definition = None
-            self.if_missing = None
-            self.missing_explain = None
-            self.if_generate = None
-            self.generate_explain = None
+    accns = list(dict.fromkeys(str(accn) for accn in accns))
+    current_span().set(filings=len(accns))
+    results = {}
+    accns_by_cik = {}
 
-    try:
-        filing = get_by_accession_number(str(accn))
-    except Exception as e:
-        return "FHA Error: unable to find filing with accession number " + str(accn)
-
-    try:
-        company = Company(str(filing.cik)).get_facts().to_pandas()
-    except Exception as e:
-        return "FHA Error: unable to generate pandas dataframe for company with CIK " + str(filing.cik)
+    # Filing CIKs and company facts are served from the local cache when warm
+    cache = get_facts_cache()
 
-    try:
-        company_accn_subset = company[(company['namespace'] == 'us-gaap') & (company['accn'] == str(accn))]
-    except Exception as e:
-        return f"FHA Error extracting rows for accession number {accn}: {e}"
-
-    try:
-        subset_json_dict = {} # Convert the dataframe to a JSON-serializable dictionary, keyed by the row index
-        company_accn_subset = company_accn_subset.reset_index()
-        for idx, row in company_accn_subset.iterrows():
-            row_data = row.to_dict()  # Convert each row to a dictionary
-            subset_json_dict[str(idx)] = row_data  # Use the dataframe index as the key, convert to string for JSON compatibility
-
-    except Exception as e:
-        return f"FHA Error converting dataframe subset to JSON: {e}"
-
-    try:
-        company['end'] = pd.to_datetime(company['end'])
-        company['timestamp'] = company['end'].astype('int64')
-    except Exception as e:
-        return "FHA Error: unable to parse/organize date format"
-
-    def retrieve_value_full(company, accn, fact_name):
+    for accn in accns:
         try:
-            filtered_df = company[(company['namespace'] == 'us-gaap') & (company['accn'] == str(accn)) & (company['fact'] == str(fact_name))]
-            filtered_df = filtered_df.loc[filtered_df['timestamp'].idxmax()]
-            value = filtered_df['val']
-            return value, "NO", "N/A"
+            with span("fha.filing_cik", accession_code=accn):
+                cik = cache.filing_cik(accn, lambda: get_by_accession_number(accn).cik)
         except Exception as e:
-            return "N/A", "YES", "Unable to locate parameter in data sheets"
-        
-    def retrieve_value_partial(company, accn, fact_name):
+            results[accn] = "FHA Error: unable to find filing with accession number " + accn
+            continue
+        accns_by_cik.setdefault(str(cik), []).append(accn)
+
+    for cik, cik_accns in accns_by_cik.items():
         try:
-            filtered_df = company[(company['namespace'] == 'us-gaap') & (company['accn'] == str(accn)) & (company['fact'] == str(fact_name))]
-            filtered_df = filtered_df.loc[filtered_df['timestamp'].idxmax()]
-            value = filtered_df['val']
-            return value
+            with span("fha.company_facts", cik=cik) as facts_span:
+                company = cache.company_facts(cik, lambda: Company(cik).get_facts().to_pandas())
+                facts_span.set(rows=len(company))
+                facts_span.add_bytes(int(company.memory_usage().sum()))
         except Exception as e:
-            return "N/A"
-
-
-    assets = DB_ANALYSIS()
-    liabilities = DB_ANALYSIS()
-    equity = DB_ANALYSIS()
-
-    assets.value, assets.if_missing, assets.missing_explain = retrieve_value_full(company, accn, "Assets")
-    equity.value, equity.if_missing, equity.missing_explain = retrieve_value_full(company, accn, "StockholdersEquity")
-
-    if assets.value != "N/A" and equity.value != "N/A":
-        liabilities.value = int(assets.value) - int(equity.value)
-        liabilities.if_missing = "NO"
-        liabilities.missing_explain = "N/A"
-    else:
-        liabilities.value = "N/A"
-        liabilities.if_missing = "YES"
-        liabilities.missing_explain = "Unable to locate parameter in data sheets"
-
-
-    revenue = DB_ANALYSIS()
-    expenses = DB_ANALYSIS()
-    net_income = DB_ANALYSIS()
-
-    revenue.value, revenue.if_missing, revenue.missing_explain = retrieve_value_full(company, accn, "Revenues")
-    net_income.value, net_income.if_missing, net_income.missing_explain = retrieve_value_full(company, accn, "NetIncomeLoss")
-
-    if revenue.value != "N/A" and net_income.value != "N/A":
-        expenses.value = int(revenue.value) - int(net_income.value)
-        expenses.if_missing = "NO"
-        expenses.missing_explain = "N/A"
-    else:
-        expenses.value = "N/A"
-        expenses.if_missing = "YES"
-        expenses.missing_explain = "Unable to locate parameter in data sheets"
-
-
-    operate_act = DB_ANALYSIS()
-    invest_act = DB_ANALYSIS()
-    finance_act = DB_ANALYSIS()
-
-    operate_act.value, operate_act.if_missing, operate_act.missing_explain = retrieve_value_full(company, accn, "NetCashProvidedByUsedInOperatingActivities")
-    invest_act.value, invest_act.if_missing, invest_act.missing_explain = retrieve_value_full(company, accn, "NetCashProvidedByUsedInInvestingActivities")
-    finance_act.value, finance_act.if_missing, finance_act.missing_explain = retrieve_value_full(company, accn, "NetCashProvidedByUsedInFinancingActivities")
-
-
-    current_ratio = DB_ANALYSIS()
-
-    INTR_current_assets = retrieve_value_partial(company, accn, "AssetsCurrent")
-    INTR_current_liabilities = retrieve_value_partial(company, accn, "LiabilitiesCurrent")
-
-    if INTR_current_assets != "N/A" and INTR_current_liabilities != "N/A":
-        current_ratio.value = float(INTR_current_assets) / float(INTR_current_liabilities)
-        current_ratio.if_missing = "NO"
-        current_ratio.missing_explain = "N/A"
-    else:
-        current_ratio.value = "N/A"
-        current_ratio.if_missing = "YES"
-        current_ratio.missing_explain = "Unable to locate parameter in data sheets"
-
-
-    quick_ratio = DB_ANALYSIS()
+            results.update({accn: "FHA Error: unable to generate pandas dataframe for company with CIK " + cik for accn in cik_accns})
+            continue
 
-    INTR_cash_and_cash_equivalents = retrieve_value_partial(company, accn, "CashAndCashEquivalentsAtCarryingValue")
-    INTR_short_term_investments = retrieve_value_partial(company, accn, "ShortTermInvestments")
-    INTR_account_receivables = retrieve_value_partial(company, accn, "AccountsReceivableNetCurrent")
+        results.update(analyze_company_facts(company, cik_accns))
 
-    if INTR_cash_and_cash_equivalents != "N/A" and INTR_short_term_investments != "N/A" and INTR_account_receivables != "N/A" and INTR_current_liabilities != "N/A":
-        quick_ratio.value = float((INTR_cash_and_cash_equivalents + INTR_short_term_investments + INTR_account_receivables)) / float(INTR_current_liabilities)
-        quick_ratio.if_missing = "NO"
-        quick_ratio.missing_explain = "N/A"
-    else:
-        quick_ratio.value = "N/A"
-        quick_ratio.if_missing = "YES"
-        quick_ratio.missing_explain = "Unable to locate parameter in data sheets"
+    logging.info(f"Facts cache stats: {cache.stats}")
+    logging.info(f"EDGAR session stats: {edgar_session.stats}")
+    if edgar_session.cache:
+        logging.info(f"Filing cache stats: {edgar_session.cache.stats}")
 
-    
-    debt_to_equity_ratio = DB_ANALYSIS()
+    return {accn: results[accn] for accn in accns}
 
-    if liabilities.value != "N/A" and equity.value != "N/A":
-        debt_to_equity_ratio.value = float(liabilities.value) / float(equity.value)
-        debt_to_equity_ratio.if_missing = "NO"
-        debt_to_equity_ratio.missing_explain = "N/A"
-    else:
-        debt_to_equity_ratio.value = "N/A"
-        debt_to_equity_ratio.if_missing = "YES"
-        debt_to_equity_ratio.missing_explain = "Unable to locate parameter in data sheets"
-
-
-    interest_coverage_ratio = DB_ANALYSIS()
-
-    INTR_cost_of_goods_sold = retrieve_value_partial(company, accn, "CostOfGoodsAndServicesSold")
-    INTR_operating_expenses = retrieve_value_partial(company, accn, "OperatingIncomeLoss")
-    INTR_interest_expense = retrieve_value_partial(company, accn, "InterestAndDebtExpense")
-
-    if revenue.value != "N/A" and INTR_cost_of_goods_sold != "N/A" and INTR_operating_expenses != "N/A" and INTR_interest_expense != "N/A":
-        interest_coverage_ratio.value = float((revenue.value - INTR_cost_of_goods_sold - INTR_operating_expenses)) / float(INTR_interest_expense)
-        interest_coverage_ratio.if_missing = "NO"
-        interest_coverage_ratio.missing_explain = "N/A"
-    else:
-        interest_coverage_ratio.value = "N/A"
-        interest_coverage_ratio.if_missing = "YES"
-        interest_coverage_ratio.missing_explain = "Unable to locate parameter in data sheets"
-
-
-    gross_margin_ratio = DB_ANALYSIS()
-
-    INTR_gross_profit = retrieve_value_partial(company, accn, "GrossProfit")
-
-    if INTR_gross_profit != "N/A" and revenue.value != "N/A":
-        gross_margin_ratio.value = float(INTR_gross_profit) / float(revenue.value)
-        gross_margin_ratio.if_missing = "NO"
-        gross_margin_ratio.missing_explain = "N/A"
-    else:
-        gross_margin_ratio.value = "N/A"
-        gross_margin_ratio.if_missing = "YES"
-        gross_margin_ratio.missing_explain = "Unable to locate parameter in data sheets"
-
-
-    operating_margin_ratio = DB_ANALYSIS()
-
-    INTR_operating_income = INTR_operating_expenses
-
-    if INTR_operating_income != "N/A" and revenue.value != "N/A":
-        operating_margin_ratio.value = float(INTR_operating_income) / float(revenue.value)
-        operating_margin_ratio.if_missing = "NO"
-        operating_margin_ratio.missing_explain = "N/A"
-    else:
-        operating_margin_ratio.value = "N/A"
-        operating_margin_ratio.if_missing = "YES"
-        operating_margin_ratio.missing_explain = "Unable to locate parameter in data sheets"
-
-
-    net_margin_ratio = DB_ANALYSIS()
-
-    if net_income.value != "N/A" and revenue.value != "N/A":
-        net_margin_ratio.value = float(net_income.value) / float(revenue.value)
-        net_margin_ratio.if_missing = "NO"
-        net_margin_ratio.missing_explain = "N/A"
-    else:
-        net_margin_ratio.value = "N/A"
-        net_margin_ratio.if_missing = "YES"
-        net_margin_ratio.missing_explain = "Unable to locate parameter in data sheets"
-
-
-    inventory_turnover_ratio = DB_ANALYSIS()
-
-    INTR_cost_of_revenue = retrieve_value_partial(company, accn, "CostOfRevenue")
-    INTR_inventory = retrieve_value_partial(company, accn, "InventoryNet")
-
-    if INTR_cost_of_revenue != "N/A" and INTR_inventory != "N/A":
-        inventory_turnover_ratio.value = float(INTR_cost_of_revenue) / float(INTR_inventory)
-        inventory_turnover_ratio.if_missing = "NO"
-        inventory_turnover_ratio.missing_explain = "N/A"
-    else:
-        inventory_turnover_ratio.value = "N/A"
-        inventory_turnover_ratio.if_missing = "YES"
-        inventory_turnover_ratio.missing_explain = "Unable to locate parameter in data sheets"
-
-
-    asset_turnover_ratio = DB_ANALYSIS()
-
-    INTR_net_ppe = retrieve_value_partial(company, accn, "PropertyPlantAndEquipmentNet")
-
-    if revenue.value != "N/A" and INTR_net_ppe != "N/A":
-        asset_turnover_ratio.value = float(revenue.value) / float(INTR_net_ppe)
-        asset_turnover_ratio.if_missing = "NO"
-        asset_turnover_ratio.missing_explain = "N/A"
-    else:
-        asset_turnover_ratio.value = "N/A"
-        asset_turnover_ratio.if_missing = "YES"
-        asset_turnover_ratio.missing_explain = "Unable to locate parameter in data sheets"
+@traced("fha.analyze_company_facts")
+def analyze_company_facts(company, accns):
+    # Compute the FHA output of every accession in accns from one company facts frame
+    try:
+        company_subset = company[(company['namespace'] == 'us-gaap') & (company['accn'].isin(accns))]
+    except Exception as e:
+        return {accn: f"FHA Error extracting rows for accession number {accn}: {e}" for accn in accns}
 
+    try:
+        # Convert each filing's rows to a JSON-serializable payload, row-keyed or columnar per FHA_RAW_FORMAT
+        raw_format = get_raw_format()
+        raw = {accn: encode_raw(company_subset.iloc[:0].reset_index(), raw_format) for accn in accns}
+        for accn, company_accn_subset in company_subset.groupby('accn', sort=False):
+            raw[accn] = encode_raw(company_accn_subset.reset_index(), raw_format)
 
-    def create_analysis_json(title, definition, analysis_obj, if_generated="NO", generated_explanation="N/A"):
-        return {
-            title: {
-                "Definition": definition,
-                "Value": str(analysis_obj.value),
-                "If Missing": str(analysis_obj.if_missing),
-                "Missing Explanation": str(analysis_obj.missing_explain),
-                "If Generated": if_generated,
-                "Generated Explanation": generated_explanation
-            }
-        }
+    except Exception as e:
+        return {accn: f"FHA Error converting dataframe subset to JSON: {e}" for accn in accns}
 
-    data = {}
-    analyses = [
-        ("Assets", "Resources owned by a company that provide economic value.", assets),
-        ("Liabilities", "Obligations or debts a company owes to others.", liabilities),
-        ("Equity", "The residual interest in the company's assets after deducting liabilities.", equity),
-        ("Revenue", "Total income generated from the sale of goods or services.", revenue),
-        ("Expenses", "Costs incurred to generate revenue and operate the business.", expenses),
-        ("Net Income", "Profit remaining after all expenses, taxes, and costs are deducted from revenue.", net_income),
-        ("Operating Activities", "Cash flows from a company's primary business operations.", operate_act),
-        ("Investing Activities", "Cash flows related to the acquisition or sale of long-term assets and investments.", invest_act),
-        ("Financing Activities", "Cash flows from transactions involving debt, equity, and dividend payments.", finance_act),
-        ("Current Ratio", "Measures a company's ability to pay short-term obligations with its current assets.", current_ratio, "YES", "calculated by (current assets) / (current liabilities)"),
-        ("Quick Ratio", "Assesses liquidity by comparing liquid assets to current liabilities, excluding inventory.", quick_ratio, "YES", "calculated by (cash and cash equivalents + short term investments + account receivables) / (current liabilities)"),
-        ("Debt to Equity Ratio", "Evaluates financial leverage by comparing total debt to shareholders' equity.", debt_to_equity_ratio, "YES", "calculated by (liabilities) / (stock holder equity)"),
-        ("Interest Coverage Ratio", "Indicates how easily a company can cover interest payments with its operating income.", interest_coverage_ratio, "YES", "calculated by (earnings before interest and taxes) / (interest expense)"),
-        ("Gross Margin Ratio", "Percentage of revenue remaining after subtracting cost of goods sold.", gross_margin_ratio, "YES", "calculated by (gross profit) / (revenue)"),
-        ("Operating Margin Ratio", "Shows the percentage of revenue left after covering operating expenses.", operating_margin_ratio, "YES", "calculated by (operating income) / (revenue)"),
-        ("Net Margin Ratio", "Represents the percentage of revenue remaining as profit after all expenses.", net_margin_ratio, "YES", "calculated by (net income) / (revenue)"),
-        ("Inventory Turnover Ratio", "Measures how efficiently a company sells and replaces its inventory over a period.", inventory_turnover_ratio, "YES", "calculated by (cost of revenue) / (inventory)"),
-        ("Asset Turnover Ratio", "Indicates how effectively a company uses its assets to generate revenue.", asset_turnover_ratio, "YES", "calculated by (revenue) / (property plant and equipment)")
-    ]
+    try:
+        company_subset = company_subset.copy()
+        company_subset['end'] = pd.to_datetime(company_subset['end'])
+        company_subset['timestamp'] = company_subset['end'].astype('int64')
+    except Exception as e:
+        return {accn: "FHA Error: unable to parse/organize date format" for accn in accns}
 
-    # Loop through and add each analysis to the data dict
-    for item in analyses:
-        # Handle the optional if_generated and generated_explanation
-        if len(item) == 3:
-            title, definition, analysis_obj = item
-            data.update(create_analysis_json(title, definition, analysis_obj))
-        else:
-            title, definition, analysis_obj, if_generated, generated_explanation = item
-            data.update(create_analysis_json(title, definition, analysis_obj, if_generated, generated_explanation))
+    try:
+        fact_table = build_fact_table(company_subset)
+    except Exception as e:
+        return {accn: f"FHA Error indexing facts for accession number {accn}: {e}" for accn in accns}
 
-    output_json = {"raw": subset_json_dict, "calculated": data}
-    
-    return output_json
+    try:
+        calculated = evaluate_metrics(fact_table.reindex(accns))
+    except Exception as e:
+        return {accn: f"FHA Error calculating metrics for accession number {accn}: {e}" for accn in accns}
 
+    return {accn: {"raw": raw[accn], "calculated": calculated[accn]} for accn in accns}
@@ -1,7 +1,15 @@
 import os
+import json
 import logging
-from azure.cosmos import CosmosClient
-from .fha import fha
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+from shared_code.cosmos import get_container
+from shared_code.filing_store import append_analysis
+from shared_code.idempotency import claim_run, finish_run, is_forced, recorded_outcome, run_once
+from .raw_codec import first_raw_row
+
+# Bump when the stored FHA output changes, so filings are analyzed again on their next request
+ANALYSIS_TYPE = "fha"
+ANALYSIS_VERSION = 1
 
 def fha_wrapper(req):
     COSMOS_DB_URL = os.getenv("COSMOS_DB_URL")
@@ -22,6 +30,8 @@ def fha_wrapper(req):
     ticker = req.params.get("ticker")
     date = req.params.get("date")
     form = req.params.get("form")
+    accession_codes = req.params.get("accession_codes")
+    force = req.params.get("force")
 
     logging.info("Params loaded")
     
@@ -35,111 +45,40 @@ def fha_wrapper(req):
         ticker = ticker or req_body.get("ticker")
         date = date or req_body.get("date")
         form = form or req_body.get("form")
+        accession_codes = accession_codes or req_body.get("accession_codes")
+        force = force or req_body.get("force")
 
-     
+    # Batch mode: several filings of one ticker, analyzed from a single company facts download
+    if accession_codes and ticker:
+        if isinstance(accession_codes, str):
+            accession_codes = accession_codes.split(",")
+        return fha_batch_wrapper(accession_codes, ticker, is_forced(force))
 
     # Proceed if all required parameters are available
     if accession_code and ticker and date and form:
         try:
-            fha_json = fha(accession_code)
-
-            # Ensure return is not NULL
-            if fha_json is None:
-                logging.warning(f"Skipping update: No valid Financial analyses for {accession_code}")
-                return f"No valid Financial analysis to append for {accession_code}.", 204
-            
-            # Connect to Cosmos DB
-            client = CosmosClient(COSMOS_DB_URL, COSMOS_DB_KEY)
-            database = client.get_database_client(COSMOS_DB_DATABASE)
-            filings_container = database.get_container_client(COSMOS_DB_CONTAINER_FILINGS)
-
-            try:
-                existing_item = filings_container.read_item(
-                    item=accession_code,
-                    partition_key=ticker
-                )
-                logging.info(f"Found existing item for {accession_code}")
-            except Exception as e:
-                logging.warning(f"Error {e} No existing filing found for {accession_code}. Skipping update.")
-                return f"No existing filing found for {accession_code}.", 404
-
-            # Append the new analysis as a single entry
-            new_analysis = {
-                "fha": fha_json,
-            }
-            existing_item.setdefault("analyses", []).append(new_analysis)
-
-            # Attempt to find fiscal year and quarter details
-            fiscal_period = None
-            fiscal_year = None
-
-            logging.info(f"Starting fiscal period/year extraction for accession_code: {accession_code}")
-
-            if "raw" not in fha_json:
-                logging.warning(f"'raw' key missing in fha_json for {accession_code}")
-            elif not fha_json["raw"]:
-                logging.warning(f"'raw' dictionary is empty for {accession_code}")
-            else:
-                logging.info(f"Found 'raw' data in fha_json for {accession_code}")
-                
-                try:
-                    # Get the first key in the raw dictionary
-                    if len(fha_json["raw"]) == 0:
-                        logging.warning(f"'raw' dictionary has no keys for {accession_code}")
-                    else:
-                        first_key = next(iter(fha_json["raw"]))
-                        logging.info(f"First key in raw data: {first_key}")
-                        
-                        raw_data = fha_json["raw"][first_key]
-                        logging.info(f"Raw data structure for first key: {list(raw_data.keys())}")
-                        
-                        # Extract fiscal period and year if available
-                        if "fp" in raw_data:
-                            fiscal_period = raw_data.get("fp")
-                            logging.info(f"Found fiscal period: {fiscal_period}")
-                        else:
-                            logging.warning(f"'fp' key not found in raw_data for {accession_code}")
-                            
-                        if "fy" in raw_data:
-                            fiscal_year = raw_data.get("fy")
-                            logging.info(f"Found fiscal year: {fiscal_year}")
-                        else:
-                            logging.warning(f"'fy' key not found in raw_data for {accession_code}")
-                except Exception as e:
-                    logging.error(f"Error extracting fiscal data: {str(e)}")
-
-            # Add fiscal period and year to the existing item if found
-            if fiscal_period:
-                existing_item["fiscal_period"] = fiscal_period
-                logging.info(f"Added fiscal period '{fiscal_period}' to document for {accession_code}")
-            else:
-                logging.warning(f"No fiscal period to add for {accession_code}")
+            # Pooled Cosmos DB container handle, shared across invocations
+            filings_container = get_container(COSMOS_DB_CONTAINER_FILINGS)
 
-            if fiscal_year:
-                existing_item["fiscal_year"] = fiscal_year
-                logging.info(f"Added fiscal year '{fiscal_year}' to document for {accession_code}")
-            else:
-                logging.warning(f"No fiscal year to add for {accession_code}")
-                
-            # Add fiscal period and year to the existing item if found
-            if fiscal_period:
-                existing_item["fiscal_period"] = fiscal_period
-                logging.info(f"Added fiscal period: {fiscal_period}")
-            
-            if fiscal_year:
-                existing_item["fiscal_year"] = fiscal_year
-                logging.info(f"Added fiscal year: {fiscal_year}")         
+            def run_fha():
+                # The analysis pulls in edgartools, pandas and pyarrow, so it is imported when a filing
+                # is analyzed instead of when the worker loads the function
+                from .fha import fha
 
+                fha_json = fha(accession_code)
 
-            # Replace the document in the DB
-            filings_container.replace_item(item=accession_code, body=existing_item)
+                response_message, status_code = store_fha_result(filings_container, accession_code, ticker, fha_json)
+                if status_code != 200:
+                    return response_message, status_code
 
+                response_message = (
+                    f"Received data: Accession Code - {accession_code}, "
+                    f"Ticker - {ticker}, Date - {date}, Form - {form}."
+                )
+                return response_message, 200
 
-            response_message = (
-                f"Received data: Accession Code - {accession_code}, "
-                f"Ticker - {ticker}, Date - {date}, Form - {form}."
-            )
-            return response_message, 200
+            # Repeated requests for an analyzed filing return the recorded outcome instead of rerunning
+            return run_once(filings_container, accession_code, ticker, ANALYSIS_TYPE, ANALYSIS_VERSION, run_fha, is_forced(force))
         except Exception as e:
             logging.error(f"An error occurred: {e}")
             return "An error occurred while processing your request.", 500
@@ -150,4 +89,134 @@ def fha_wrapper(req):
         )
         logging.error(error_msg)
         return error_msg, 400
+
+
+def fha_batch_wrapper(accession_codes, ticker, force=False):
+    COSMOS_DB_CONTAINER_FILINGS = os.getenv("COSMOS_DB_CONTAINER_FILINGS")
+
+    if not isinstance(accession_codes, list) or not all(isinstance(code, str) and code for code in accession_codes):
+        error_msg = "'accession_codes' must be a list of accession numbers or a comma-separated string."
+        logging.error(error_msg)
+        return error_msg, 400
+
+    logging.info(f"Batch financial health analysis of {len(accession_codes)} filing(s) for {ticker}")
+
+    try:
+        # Pooled Cosmos DB container handle, shared across invocations
+        filings_container = get_container(COSMOS_DB_CONTAINER_FILINGS)
+
+        # Only analyze the filings that are not already analyzed or in progress
+        accession_codes = list(dict.fromkeys(accession_codes))
+        summary = {}
+        claimed_runs = {}
+        for accession_code in accession_codes:
+            claimed, record = claim_run(filings_container, accession_code, ticker, ANALYSIS_TYPE, ANALYSIS_VERSION, force)
+            if claimed:
+                claimed_runs[accession_code] = record
+            else:
+                response_message, status_code = recorded_outcome(record)
+                summary[accession_code] = {"status": status_code, "message": response_message}
+
+        try:
+            from .fha import fha_many
+
+            fha_results = fha_many(list(claimed_runs)) if claimed_runs else {}
+        except Exception as e:
+            for accession_code, record in claimed_runs.items():
+                finish_run(filings_container, record, str(e), 500)
+            raise
+
+        for accession_code, fha_json in fha_results.items():
+            response_message, status_code = store_fha_result(filings_container, accession_code, ticker, fha_json)
+            finish_run(filings_container, claimed_runs[accession_code], response_message, status_code)
+            summary[accession_code] = {"status": status_code, "message": response_message}
+
+        summary = {accession_code: summary[accession_code] for accession_code in accession_codes}
+
+        # 207 Multi-Status when only some of the filings could be stored
+        status_code = 200 if all(result["status"] == 200 for result in summary.values()) else 207
+        return json.dumps(summary), status_code
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        return "An error occurred while processing your request.", 500
+
+
+def store_fha_result(filings_container, accession_code, ticker, fha_json):
+    # Ensure return is not NULL
+    if fha_json is None:
+        logging.warning(f"Skipping update: No valid Financial analyses for {accession_code}")
+        return f"No valid Financial analysis to append for {accession_code}.", 204
+
+    # fha() reports filings it cannot analyze (no facts for the CIK, unparseable facts...) as an error
+    # message instead of a result. Retrying gives the same answer, so it is a 4xx: callers neither
+    # retry it nor count it against the health of the function
+    if isinstance(fha_json, str):
+        logging.error(f"Financial health analysis failed for {accession_code}: {fha_json}")
+        return fha_json, 422
     
+    # The analysis is appended and the fiscal fields set with one patch of the filing, so analyses
+    # stored concurrently by other functions are kept
+    try:
+        append_analysis(filings_container, accession_code, ticker, {"fha": fha_json}, fiscal_fields(accession_code, fha_json))
+    except CosmosResourceNotFoundError:
+        logging.warning(f"No existing filing found for {accession_code}. Skipping update.")
+        return f"No existing filing found for {accession_code}.", 404
+
+    return f"Stored financial health analysis for {accession_code}.", 200
+
+
+def fiscal_fields(accession_code, fha_json):
+    # Fiscal period and year of an FHA result, which are copied onto the filing with the analysis.
+    # Shared by the FinancialHealth function and the bulk backfill driver
+
+    # Attempt to find fiscal year and quarter details
+    fiscal_period = None
+    fiscal_year = None
+
+    logging.info(f"Starting fiscal period/year extraction for accession_code: {accession_code}")
+
+    if "raw" not in fha_json:
+        logging.warning(f"'raw' key missing in fha_json for {accession_code}")
+    elif not fha_json["raw"]:
+        logging.warning(f"'raw' dictionary is empty for {accession_code}")
+    else:
+        logging.info(f"Found 'raw' data in fha_json for {accession_code}")
+        
+        try:
+            # Get the first row of the raw data, stored either row-keyed or columnar
+            raw_data = first_raw_row(fha_json["raw"])
+            if raw_data is None:
+                logging.warning(f"'raw' data has no rows for {accession_code}")
+            else:
+                logging.info(f"Raw data structure for first row: {list(raw_data.keys())}")
+                
+                # Extract fiscal period and year if available
+                if "fp" in raw_data:
+                    fiscal_period = raw_data.get("fp")
+                    logging.info(f"Found fiscal period: {fiscal_period}")
+                else:
+                    logging.warning(f"'fp' key not found in raw_data for {accession_code}")
+                    
+                if "fy" in raw_data:
+                    fiscal_year = raw_data.get("fy")
+                    logging.info(f"Found fiscal year: {fiscal_year}")
+                else:
+                    logging.warning(f"'fy' key not found in raw_data for {accession_code}")
+        except Exception as e:
+            logging.error(f"Error extracting fiscal data: {str(e)}")
+
+    # Add fiscal period and year to the filing if found
+    fields = {}
+    if fiscal_period:
+        fields["fiscal_period"] = fiscal_period
+        logging.info(f"Adding fiscal period '{fiscal_period}' to document for {accession_code}")
+    else:
+        logging.warning(f"No fiscal period to add for {accession_code}")
+
+    if fiscal_year:
+        fields["fiscal_year"] = fiscal_year
+        logging.info(f"Adding fiscal year '{fiscal_year}' to document for {accession_code}")
+    else:
+        logging.warning(f"No fiscal year to add for {accession_code}")
+
+    return fields
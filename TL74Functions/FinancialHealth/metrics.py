@@ -0,0 +1,153 @@
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+
+MISSING_EXPLANATION = "Unable to locate parameter in data sheets"
+
+
+class Metric:
+    def __init__(self, title, definition, inputs, formula=None, value_type="fact", if_generated="NO", generated_explanation="N/A"):
+        self.title = title
+        self.definition = definition
+        self.inputs = inputs                # XBRL us-gaap facts the metric depends on
+        self.formula = formula              # Vectorized over a DataFrame of facts, None for a reported fact
+        self.value_type = value_type        # "fact", "int" or "float": how the value is computed and rendered
+        self.if_generated = if_generated
+        self.generated_explanation = generated_explanation
+
+
+# Registry of every metric reported under "calculated", in output order.
+# Adding a metric only needs a new entry here; its inputs are resolved together with all others.
+METRICS = [
+    Metric("Assets", "Resources owned by a company that provide economic value.",
+           ["Assets"]),
+    Metric("Liabilities", "Obligations or debts a company owes to others.",
+           ["Assets", "StockholdersEquity"],
+           lambda f: f["Assets"] - f["StockholdersEquity"], "int"),
+    Metric("Equity", "The residual interest in the company's assets after deducting liabilities.",
+           ["StockholdersEquity"]),
+    Metric("Revenue", "Total income generated from the sale of goods or services.",
+           ["Revenues"]),
+    Metric("Expenses", "Costs incurred to generate revenue and operate the business.",
+           ["Revenues", "NetIncomeLoss"],
+           lambda f: f["Revenues"] - f["NetIncomeLoss"], "int"),
+    Metric("Net Income", "Profit remaining after all expenses, taxes, and costs are deducted from revenue.",
+           ["NetIncomeLoss"]),
+    Metric("Operating Activities", "Cash flows from a company's primary business operations.",
+           ["NetCashProvidedByUsedInOperatingActivities"]),
+    Metric("Investing Activities", "Cash flows related to the acquisition or sale of long-term assets and investments.",
+           ["NetCashProvidedByUsedInInvestingActivities"]),
+    Metric("Financing Activities", "Cash flows from transactions involving debt, equity, and dividend payments.",
+           ["NetCashProvidedByUsedInFinancingActivities"]),
+    Metric("Current Ratio", "Measures a company's ability to pay short-term obligations with its current assets.",
+           ["AssetsCurrent", "LiabilitiesCurrent"],
+           lambda f: f["AssetsCurrent"] / f["LiabilitiesCurrent"], "float",
+           "YES", "calculated by (current assets) / (current liabilities)"),
+    Metric("Quick Ratio", "Assesses liquidity by comparing liquid assets to current liabilities, excluding inventory.",
+           ["CashAndCashEquivalentsAtCarryingValue", "ShortTermInvestments", "AccountsReceivableNetCurrent", "LiabilitiesCurrent"],
+           lambda f: (f["CashAndCashEquivalentsAtCarryingValue"] + f["ShortTermInvestments"] + f["AccountsReceivableNetCurrent"]) / f["LiabilitiesCurrent"], "float",
+           "YES", "calculated by (cash and cash equivalents + short term investments + account receivables) / (current liabilities)"),
+    Metric("Debt to Equity Ratio", "Evaluates financial leverage by comparing total debt to shareholders' equity.",
+           ["Assets", "StockholdersEquity"],
+           lambda f: (np.trunc(f["Assets"]) - np.trunc(f["StockholdersEquity"])) / f["StockholdersEquity"], "float",
+           "YES", "calculated by (liabilities) / (stock holder equity)"),
+    Metric("Interest Coverage Ratio", "Indicates how easily a company can cover interest payments with its operating income.",
+           ["Revenues", "CostOfGoodsAndServicesSold", "OperatingIncomeLoss", "InterestAndDebtExpense"],
+           lambda f: (f["Revenues"] - f["CostOfGoodsAndServicesSold"] - f["OperatingIncomeLoss"]) / f["InterestAndDebtExpense"], "float",
+           "YES", "calculated by (earnings before interest and taxes) / (interest expense)"),
+    Metric("Gross Margin Ratio", "Percentage of revenue remaining after subtracting cost of goods sold.",
+           ["GrossProfit", "Revenues"],
+           lambda f: f["GrossProfit"] / f["Revenues"], "float",
+           "YES", "calculated by (gross profit) / (revenue)"),
+    Metric("Operating Margin Ratio", "Shows the percentage of revenue left after covering operating expenses.",
+           ["OperatingIncomeLoss", "Revenues"],
+           lambda f: f["OperatingIncomeLoss"] / f["Revenues"], "float",
+           "YES", "calculated by (operating income) / (revenue)"),
+    Metric("Net Margin Ratio", "Represents the percentage of revenue remaining as profit after all expenses.",
+           ["NetIncomeLoss", "Revenues"],
+           lambda f: f["NetIncomeLoss"] / f["Revenues"], "float",
+           "YES", "calculated by (net income) / (revenue)"),
+    Metric("Inventory Turnover Ratio", "Measures how efficiently a company sells and replaces its inventory over a period.",
+           ["CostOfRevenue", "InventoryNet"],
+           lambda f: f["CostOfRevenue"] / f["InventoryNet"], "float",
+           "YES", "calculated by (cost of revenue) / (inventory)"),
+    Metric("Asset Turnover Ratio", "Indicates how effectively a company uses its assets to generate revenue.",
+           ["Revenues", "PropertyPlantAndEquipmentNet"],
+           lambda f: f["Revenues"] / f["PropertyPlantAndEquipmentNet"], "float",
+           "YES", "calculated by (revenue) / (property plant and equipment)"),
+]
+
+
+def required_facts(metrics=METRICS):
+    # Every fact needed by the registry, deduplicated in first-use order
+    return list(dict.fromkeys(fact for metric in metrics for fact in metric.inputs))
+
+
+def evaluate_metrics(fact_values, metrics=METRICS):
+    """
+    Evaluate every metric for every filing at once.
+
+    fact_values is a DataFrame with one row per filing and one column per fact, holding the
+    reported values (NaN where a filing does not report the fact). Returns a dict mapping each
+    row label to its "calculated" JSON.
+    """
+    facts = fact_values.reindex(columns=required_facts(metrics)).astype(object)
+    available = facts.notna()
+    numeric = facts.apply(pd.to_numeric, errors="coerce").astype(float)
+    # "int" metrics are computed on the facts truncated to Python ints, which stay exact where
+    # float64 loses digits above 2**53
+    whole = pd.DataFrame([[_whole(value) for value in row] for row in facts.itertuples(index=False)],
+                         index=facts.index, columns=facts.columns, dtype=object)
+
+    columns = []
+    for metric in metrics:
+        present = available[metric.inputs].all(axis=1).to_numpy()
+        if metric.formula is None:
+            values = facts[metric.inputs[0]].to_numpy()
+        elif metric.value_type == "int":
+            present = present & whole[metric.inputs].notna().all(axis=1).to_numpy()
+            values = np.empty(len(facts), dtype=object)
+            values[present] = metric.formula(whole[present]).to_numpy()
+        else:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                values = np.asarray(metric.formula(numeric), dtype=float)
+            # A zero denominator leaves the metric undefined rather than failing the whole analysis
+            present = present & np.isfinite(values)
+        columns.append((metric, values, present))
+
+    calculated = {}
+    for row, label in enumerate(facts.index):
+        data = {}
+        for metric, values, present in columns:
+            if present[row]:
+                value = values[row]
+                if metric.value_type == "int":
+                    value = int(value)
+                elif metric.value_type == "float":
+                    value = float(value)
+                data[metric.title] = _metric_json(metric, str(value), "NO", "N/A")
+            else:
+                data[metric.title] = _metric_json(metric, "N/A", "YES", MISSING_EXPLANATION)
+        calculated[label] = data
+
+    return calculated
+
+
+def _whole(value):
+    # A reported fact truncated like int(), or None when it is missing or not a finite number
+    try:
+        return int(Decimal(value) if isinstance(value, str) else value)
+    except (TypeError, ValueError, ArithmeticError):
+        return None
+
+
+def _metric_json(metric, value, if_missing, missing_explain):
+    return {
+        "Definition": metric.definition,
+        "Value": value,
+        "If Missing": if_missing,
+        "Missing Explanation": missing_explain,
+        "If Generated": metric.if_generated,
+        "Generated Explanation": metric.generated_explanation
+    }
@@ -0,0 +1,79 @@
+import os
+
+# Encoding of the "raw" facts stored with each FHA result, selected with FHA_RAW_FORMAT:
+#   "rows"      (default) {"0": {column: value, ...}, "1": {...}} keyed by row position
+#   "columnar"  {"encoding": "columnar-v1", "length": n, "columns": {column: [values]},
+#                "dictionaries": {column: [distinct values]}}
+#               Columns listed in "dictionaries" store integer codes into that list (-1 for null)
+# Documents written in either format are read back through decode_raw().
+RAW_FORMAT_ROWS = "rows"
+RAW_FORMAT_COLUMNAR = "columnar"
+COLUMNAR_ENCODING = "columnar-v1"
+
+# Repeated strings in a filing's facts that are stored once per document
+DICTIONARY_COLUMNS = ("namespace", "fact", "accn", "form", "fp", "filed", "frame")
+
+
+def get_raw_format():
+    return os.getenv("FHA_RAW_FORMAT", RAW_FORMAT_ROWS).lower()
+
+
+def encode_raw(rows, raw_format=None):
+    # rows is one filing's facts with a positional index (i.e. after reset_index())
+    if (raw_format or get_raw_format()) == RAW_FORMAT_COLUMNAR:
+        return encode_raw_columnar(rows)
+    return encode_raw_rows(rows)
+
+
+def encode_raw_rows(rows):
+    return {str(idx): row for idx, row in rows.to_dict(orient="index").items()}
+
+
+def encode_raw_columnar(rows):
+    import pandas as pd
+
+    columns = {}
+    dictionaries = {}
+    for column in rows.columns:
+        values = rows[column]
+        if column in DICTIONARY_COLUMNS and values.dtype == object:
+            codes, uniques = pd.factorize(values)
+            columns[column] = codes.tolist()
+            dictionaries[column] = uniques.tolist()
+        else:
+            columns[column] = values.tolist()
+    return {
+        "encoding": COLUMNAR_ENCODING,
+        "length": len(rows),
+        "columns": columns,
+        "dictionaries": dictionaries,
+    }
+
+
+def is_columnar(raw):
+    return isinstance(raw, dict) and raw.get("encoding") == COLUMNAR_ENCODING
+
+
+def decode_raw(raw):
+    # Return the raw facts in the row-keyed shape regardless of how they were stored
+    if not is_columnar(raw):
+        return raw
+    return {str(position): _decode_row(raw, position) for position in range(raw["length"])}
+
+
+def first_raw_row(raw):
+    # First fact row of a stored "raw" payload, or None when it holds no rows
+    if is_columnar(raw):
+        return _decode_row(raw, 0) if raw["length"] else None
+    return next(iter(raw.values()), None)
+
+
+def _decode_row(raw, position):
+    row = {}
+    dictionaries = raw.get("dictionaries", {})
+    for column, values in raw["columns"].items():
+        value = values[position]
+        if column in dictionaries:
+            value = dictionaries[column][value] if value >= 0 else None
+        row[column] = value
+    return row
@@ -1,9 +1,24 @@
 import os
 import logging
-from azure.cosmos import CosmosClient
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+from shared_code.cosmos import get_container
+from shared_code.filing_store import append_analysis
+from shared_code.idempotency import is_forced, run_once
+from shared_code.instrumentation import traced
+from shared_code.llm_cache import llm_cache_scope
+from shared_code.llm_progress import WRITE_MODE_INCREMENTAL, LLMProgress, get_write_mode
 
-# Local Imports
-from .llm_analysis_repo.scripts.llm_pipeline import llm_pipeline
+# Bump when the stored LLM output changes, so filings are analyzed again on their next request
+ANALYSIS_TYPE = "llm"
+ANALYSIS_VERSION = 1
+
+@traced("llm.pipeline")
+def llm_pipeline(accession_code):
+    # The pipeline pulls in openai and tiktoken, so it is imported on first use instead of when the
+    # worker loads the function
+    from .llm_analysis_repo.scripts.llm_pipeline import llm_pipeline as pipeline
+
+    return pipeline(accession_code)
 
 def initialize_llm_workflow(req):
     COSMOS_DB_URL = os.getenv("COSMOS_DB_URL")
@@ -24,6 +39,7 @@ def initialize_llm_workflow(req):
     ticker = req.params.get("ticker")
     date = req.params.get("date")
     form = req.params.get("form")
+    force = req.params.get("force")
 
     logging.info("Params loaded")
     
@@ -37,6 +53,7 @@ def initialize_llm_workflow(req):
         ticker = ticker or req_body.get("ticker")
         date = date or req_body.get("date")
         form = form or req_body.get("form")
+        force = force or req_body.get("force")
 
     # Proceed if all required parameters are available
     if accession_code and ticker and date and form:
@@ -45,45 +62,61 @@ def initialize_llm_workflow(req):
         logging.info(f"Chunking Token Max: {os.getenv('MAX_TOKENS')}")
 
         try:
-            # Run LLM pipeline
-            comp_analy, risk_analy = llm_pipeline(accession_code)
-            
-            # Skip appending if both are None
-            if comp_analy is None and risk_analy is None:
-                logging.warning(f"Skipping update: No valid LLM analyses for {accession_code}")
-                return f"No valid LLM analysis to append for {accession_code}.", 204
-
-            # Connect to Cosmos DB
-            client = CosmosClient(COSMOS_DB_URL, COSMOS_DB_KEY)
-            database = client.get_database_client(COSMOS_DB_DATABASE)
-            filings_container = database.get_container_client(COSMOS_DB_CONTAINER_FILINGS)
-
-            # Try to read existing document
-            try:
-                existing_item = filings_container.read_item(
-                    item=accession_code,
-                    partition_key=ticker
+            # Pooled Cosmos DB container handle, shared across invocations
+            filings_container = get_container(COSMOS_DB_CONTAINER_FILINGS)
+
+            def run_llm():
+                # EDGAR requests share one keep-alive session and rate limiter per worker process.
+                # Imported here since httpx loads its command line interface (rich, pygments) with it.
+                from shared_code.edgar_session import configure_edgar
+
+                configure_edgar()
+
+                # In incremental mode every model completion is recorded next to the filing as soon as
+                # it is received, and a run cut short by a timeout resumes from the recorded ones
+                progress = None
+                if get_write_mode() == WRITE_MODE_INCREMENTAL:
+                    progress = LLMProgress.load(filings_container, accession_code, ticker)
+
+                # Run LLM pipeline. Tokenized sections and model completions of an earlier run of the
+                # filing are served from the local LLM cache.
+                with llm_cache_scope(accession_code, progress) as llm_cache:
+                    comp_analy, risk_analy = llm_pipeline(accession_code)
+                if llm_cache:
+                    logging.info(f"LLM cache stats: {llm_cache.stats}, hit rates: {llm_cache.hit_rates()}")
+                if progress:
+                    logging.info(f"LLM progress stats: {progress.stats}")
+
+                # Skip appending if both are None
+                if comp_analy is None and risk_analy is None:
+                    logging.warning(f"Skipping update: No valid LLM analyses for {accession_code}")
+                    if progress:
+                        progress.clear()
+                    return f"No valid LLM analysis to append for {accession_code}.", 204
+
+                # Append the new analysis as a single entry, patched into the filing instead of
+                # reading and replacing the whole document
+                new_analysis = {
+                    "comp_analysis": comp_analy,
+                    "risk_analysis": risk_analy
+                }
+                try:
+                    append_analysis(filings_container, accession_code, ticker, new_analysis)
+                except CosmosResourceNotFoundError:
+                    logging.warning(f"No existing filing found for {accession_code}. Skipping update.")
+                    return f"No existing filing found for {accession_code}.", 404
+
+                if progress:
+                    progress.clear()
+
+                response_message = (
+                    f"Received data: Accession Code - {accession_code}, "
+                    f"Ticker - {ticker}, Date - {date}, Form - {form}."
                 )
-                logging.info(f"Found existing item for {accession_code}")
-            except Exception as e:
-                logging.warning(f"Error {e} No existing filing found for {accession_code}. Skipping update.")
-                return f"No existing filing found for {accession_code}.", 404
-
-            # Append the new analysis as a single entry
-            new_analysis = {
-                "comp_analysis": comp_analy,
-                "risk_analysis": risk_analy
-            }
-            existing_item.setdefault("analyses", []).append(new_analysis)
-
-            # Replace the document in the DB
-            filings_container.replace_item(item=accession_code, body=existing_item)
-
-            response_message = (
-                f"Received data: Accession Code - {accession_code}, "
-                f"Ticker - {ticker}, Date - {date}, Form - {form}."
-            )
-            return response_message, 200
+                return response_message, 200
+
+            # Repeated requests for an analyzed filing return the recorded outcome instead of rerunning
+            return run_once(filings_container, accession_code, ticker, ANALYSIS_TYPE, ANALYSIS_VERSION, run_llm, is_forced(force))
         except Exception as e:
             logging.error(f"An error occurred: {e}")
             return "An error occurred while processing your request.", 500
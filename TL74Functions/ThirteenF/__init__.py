@@ -1,11 +1,15 @@
 import logging
 
 from azure.functions import HttpRequest, HttpResponse
+from shared_code.instrumentation import span
 from .wrapper_13f import initialize_13f_workflow
 
 def main(req: HttpRequest) -> HttpResponse:
     logging.info("HTTP trigger function processed a request.")
 
-    response_message, status_code = initialize_13f_workflow(req)
+    # Root span of the invocation, the parent of the spans of its stages
+    with span("function.ThirteenF") as current:
+        response_message, status_code = initialize_13f_workflow(req)
+        current.set(status_code=status_code)
 
     return HttpResponse(response_message, status_code=status_code)
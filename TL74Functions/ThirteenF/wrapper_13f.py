@@ -1,16 +1,30 @@
 import os
+import sys
 import logging
 import subprocess
 import json
-from azure.cosmos import CosmosClient
 from azure.cosmos.exceptions import CosmosResourceNotFoundError
+from shared_code.cosmos import get_container
+from shared_code.idempotency import is_forced, run_once
+from shared_code.instrumentation import traced
+from shared_code.thirteenf_chunks import store_13f_holdings
+from shared_code.thirteenf_diff import PositionIndex, store_13f_diff
 
-import sys
-sys.path.append(os.path.join(os.path.dirname(__file__), "13F-Analysis"))
+EXTRACTOR_PATH = os.path.join(os.path.dirname(__file__), "13F-Analysis")
 
-from commands.extraction import extract_13f_from_accession
+# Bump when the stored 13F output changes, so filings are analyzed again on their next request
+ANALYSIS_TYPE = "13f"
+ANALYSIS_VERSION = 1
 
-MAX_DOC_SIZE = 1.9 * 1024 * 1024
+@traced("13f.extract")
+def extract_13f_from_accession(accession_code):
+    # The extractor and its parsing dependencies are imported on first use instead of when the worker
+    # loads the function
+    if EXTRACTOR_PATH not in sys.path:
+        sys.path.append(EXTRACTOR_PATH)
+    from commands.extraction import extract_13f_from_accession as extract
+
+    return extract(accession_code)
 
 def initialize_13f_workflow(req):
     COSMOS_DB_URL = os.getenv("COSMOS_DB_URL")
@@ -31,6 +45,7 @@ def initialize_13f_workflow(req):
     ticker = req.params.get("ticker")
     date = req.params.get("date")
     form = req.params.get("form")
+    force = req.params.get("force")
 
     logging.info("Params loaded")
     
@@ -44,75 +59,57 @@ def initialize_13f_workflow(req):
         ticker = ticker or req_body.get("ticker")
         date = date or req_body.get("date")
         form = form or req_body.get("form")
+        force = force or req_body.get("force")
 
     # Proceed if all required parameters are available
     if accession_code and ticker and date and form:
         logging.info(f"Edgar Identity used from env: {os.getenv('EDGAR_IDENTITY')}")
 
         try:
-
-            data = extract_13f_from_accession(accession_code)
-
-            try:
-                # Parse the JSON output into a Python list
-                # data = json.loads(extraction_result.stdout)
-                if not isinstance(data, list):
-                    raise ValueError("Extraction output is not a list.")
-                logging.info(f"Extraction successful: {data}")
-            except (json.JSONDecodeError, ValueError) as e:
-                logging.error(f"Failed to parse extraction output as a list: {e}")
-                return "Failed to parse extraction output.", 500
-
-            # Connect to Cosmos DB
-            client = CosmosClient(COSMOS_DB_URL, COSMOS_DB_KEY)
-            database = client.get_database_client(COSMOS_DB_DATABASE)
-            container = database.get_container_client(COSMOS_DB_CONTAINER_FILINGS)
-
-            # Try to read existing document
-            try:
-                filing = container.read_item(item=accession_code, partition_key=ticker)
-            except CosmosResourceNotFoundError:
-                return f"No existing filing for {accession_code}", 404
-
-            chunks = []
-            current_chunk = []
-            current_size = 0
-
-            for entry in data:
-                entry_str = json.dumps(entry)
-                entry_size = len(entry_str.encode("utf-8"))
-
-                if current_size + entry_size > MAX_DOC_SIZE:
-                    chunks.append(current_chunk)
-                    current_chunk = [entry]
-                    current_size = entry_size
-                else:
-                    current_chunk.append(entry)
-                    current_size += entry_size
-
-            if current_chunk:
-                chunks.append(current_chunk)
-
-            chunk_refs = []
-            for i, chunk in enumerate(chunks):
-                chunk_id = f"{accession_code}::chunk_{i}"
-                container.upsert_item({
-                    "id": chunk_id,
-                    "accession_code": accession_code,
-                    "ticker": ticker,
-                    "chunk_index": i,
-                    "13f_chunk": chunk,
-                })
-                chunk_refs.append(chunk_id)
-
-            filing.setdefault("analyses", []).append({
-                "13f_chunks": chunk_refs,
-                "chunk_count": len(chunk_refs)
-            })
-
-            container.replace_item(item=accession_code, body=filing)
-
-            return f"Stored {len(chunk_refs)} chunk(s) for {accession_code}.", 200
+            # Pooled Cosmos DB container handle, shared across invocations
+            container = get_container(COSMOS_DB_CONTAINER_FILINGS)
+
+            def run_13f():
+                # EDGAR requests share one keep-alive session and rate limiter per worker process.
+                # Imported here since httpx loads its command line interface (rich, pygments) with it.
+                from shared_code.edgar_session import configure_edgar
+
+                configure_edgar()
+
+                holdings = extract_13f_from_accession(accession_code)
+
+                try:
+                    # Parse the JSON output into a Python list
+                    # data = json.loads(extraction_result.stdout)
+                    if isinstance(holdings, (str, bytes, dict)) or not hasattr(holdings, "__iter__"):
+                        raise ValueError("Extraction output is not a list.")
+                    logging.info(f"Extraction successful for {accession_code}")
+                except (json.JSONDecodeError, ValueError) as e:
+                    logging.error(f"Failed to parse extraction output as a list: {e}")
+                    return "Failed to parse extraction output.", 500
+
+                # Try to read existing document
+                try:
+                    filing = container.read_item(item=accession_code, partition_key=ticker)
+                except CosmosResourceNotFoundError:
+                    return f"No existing filing for {accession_code}", 404
+
+                # Chunks are written in transactional batches as soon as they fill up, and the filing is
+                # switched to them in the same batch as the last chunks. The positions are indexed on the
+                # way for the comparison with the previous quarter.
+                positions = PositionIndex()
+                chunk_refs = store_13f_holdings(container, filing, positions.track(holdings))
+
+                try:
+                    store_13f_diff(container, filing, positions)
+                except Exception as e:
+                    # The holdings are stored, a forced rerun computes the diff again
+                    logging.warning(f"Failed to store the 13F diff of {accession_code}: {e}")
+
+                return f"Stored {len(chunk_refs)} chunk(s) for {accession_code}.", 200
+
+            # Repeated requests for an analyzed filing return the recorded outcome instead of rerunning
+            return run_once(container, accession_code, ticker, ANALYSIS_TYPE, ANALYSIS_VERSION, run_13f, is_forced(force))
         except Exception as e:
             logging.error(f"An error occurred: {e}")
             return "An error occurred while processing your request.", 500
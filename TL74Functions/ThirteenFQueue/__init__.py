@@ -0,0 +1,17 @@
+import logging
+
+from azure.functions import QueueMessage
+from shared_code.instrumentation import span
+from shared_code.work_queue import run_queued_analysis
+from ThirteenF.wrapper_13f import initialize_13f_workflow
+
+
+def main(msg: QueueMessage) -> None:
+    logging.info(f"Queue trigger function processed message {msg.id}.")
+
+    # Root span of the invocation, the parent of the spans of its stages
+    with span("function.ThirteenFQueue", message_id=msg.id) as current:
+        response_message, status_code = run_queued_analysis(msg.get_json(), initialize_13f_workflow)
+        current.set(status_code=status_code)
+
+    logging.info(f"Queued analysis finished with status {status_code}: {response_message}")
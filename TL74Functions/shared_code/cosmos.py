@@ -0,0 +1,193 @@
+import os
+import json
+import logging
+import functools
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from azure.core.pipeline.transport import RequestsTransport
+from azure.cosmos import ContainerProxy, CosmosClient
+
+from shared_code.instrumentation import span, start_span
+
+DEFAULT_POOL_SIZE = 10
+
+# Container operations recorded as "cosmos.<operation>" spans
+INSTRUMENTED_OPERATIONS = (
+    "create_item", "read_item", "upsert_item", "replace_item", "patch_item", "delete_item", "execute_item_batch",
+)
+
+# Limits of a transactional batch: 100 operations and a 2MB request, less room for the request envelope
+MAX_BATCH_OPERATIONS = 100
+MAX_BATCH_BYTES = 2 * 1024 * 1024 - 64 * 1024
+
+_lock = threading.Lock()
+_client = None
+_containers = {}
+
+
+def cosmos_client_options():
+    # CosmosClient keyword arguments taken from the environment:
+    #   COSMOS_DB_POOL_SIZE              HTTP connections kept alive per worker process
+    #   COSMOS_DB_CONNECTION_TIMEOUT     request timeout in seconds
+    #   COSMOS_DB_RETRY_TOTAL            maximum retry attempts
+    #   COSMOS_DB_RETRY_BACKOFF_MAX      maximum retry wait time in seconds
+    #   COSMOS_DB_RETRY_FIXED_INTERVAL   fixed retry interval in milliseconds
+    #   COSMOS_DB_CONNECTION_VERIFY      "false" to skip TLS verification, e.g. for the local emulator
+    options = {}
+    for env_name, option in (
+        ("COSMOS_DB_CONNECTION_TIMEOUT", "connection_timeout"),
+        ("COSMOS_DB_RETRY_TOTAL", "retry_total"),
+        ("COSMOS_DB_RETRY_BACKOFF_MAX", "retry_backoff_max"),
+        ("COSMOS_DB_RETRY_FIXED_INTERVAL", "retry_fixed_interval"),
+    ):
+        if os.getenv(env_name):
+            options[option] = int(os.getenv(env_name))
+
+    if os.getenv("COSMOS_DB_CONNECTION_VERIFY", "true").lower() == "false":
+        options["connection_verify"] = False
+
+    pool_size = int(os.getenv("COSMOS_DB_POOL_SIZE", DEFAULT_POOL_SIZE))
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    options["transport"] = RequestsTransport(session=session, session_owner=False)
+
+    return options
+
+
+def get_cosmos_client():
+    # One CosmosClient per worker process, created on first use so its TLS connections and
+    # account metadata are reused by every later invocation
+    global _client
+    with _lock:
+        if _client is None:
+            logging.info("Creating Cosmos DB client")
+            _client = CosmosClient(os.getenv("COSMOS_DB_URL"), os.getenv("COSMOS_DB_KEY"), **cosmos_client_options())
+        return _client
+
+
+def get_container(container_name=None, database_name=None):
+    # Cached container handle, defaulting to the filings container of the configured database.
+    # Its operations are recorded as spans (see shared_code/instrumentation.py).
+    container_name = container_name or os.getenv("COSMOS_DB_CONTAINER_FILINGS")
+    database_name = database_name or os.getenv("COSMOS_DB_DATABASE")
+    key = (database_name, container_name)
+
+    container = _containers.get(key)
+    if container is None:
+        client = get_cosmos_client()
+        container = InstrumentedContainer(client.get_database_client(database_name).get_container_client(container_name))
+        with _lock:
+            container = _containers.setdefault(key, container)
+    return container
+
+
+class InstrumentedContainer:
+    # Container handle recording each operation as a span, with the request units and response bytes
+    # Cosmos DB reports for it. Queries are recorded until their results are consumed. Other
+    # attributes are those of the wrapped container, which may also be a stand-in without response
+    # hooks, whose operations are only timed.
+    def __init__(self, container):
+        self.container = container
+        self.hooks = isinstance(container, ContainerProxy)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.container, name)
+        if name in INSTRUMENTED_OPERATIONS:
+            return functools.partial(self._call, name, attribute)
+        if name == "query_items":
+            return functools.partial(self._query, attribute)
+        return attribute
+
+    def _call(self, operation, method, *args, **kwargs):
+        with span(f"cosmos.{operation}", container=getattr(self.container, "id", None)) as current:
+            self._hook(current, kwargs)
+            return method(*args, **kwargs)
+
+    def _query(self, method, *args, **kwargs):
+        current = start_span("cosmos.query_items", container=getattr(self.container, "id", None))
+        self._hook(current, kwargs)
+        try:
+            items = method(*args, **kwargs)
+        except Exception as e:
+            current.end(e)
+            raise
+        return _recorded_items(current, items)
+
+    def _hook(self, current, kwargs):
+        if not self.hooks:
+            return
+        hook = kwargs.get("response_hook")
+
+        def record(headers, result):
+            current.add_charge(float(_header(headers, "x-ms-request-charge") or 0))
+            current.add_bytes(int(_header(headers, "Content-Length") or 0))
+            if hook:
+                hook(headers, result)
+
+        kwargs["response_hook"] = record
+
+
+def _recorded_items(current, items):
+    count = 0
+    try:
+        for item in items:
+            count += 1
+            yield item
+    except Exception as e:
+        current.end(e)
+        raise
+    finally:
+        current.set(items=count)
+        current.end()
+
+
+def _header(headers, name):
+    return headers.get(name) or headers.get(name.lower())
+
+
+def set_cosmos_client(client):
+    # Use the given client (a fake or a local Cosmos stand-in) for all later calls
+    global _client
+    with _lock:
+        _client = client
+        _containers.clear()
+
+
+def reset_cosmos():
+    set_cosmos_client(None)
+
+
+def operations_size(operations):
+    # Serialized size of the documents in a list of batch operations
+    return sum(len(json.dumps(operation[1], default=str).encode("utf-8")) for operation in operations)
+
+
+class BatchPacker:
+    # Groups batch operations into transactional batches under the operation count and size limits.
+    # Operations added together always end up in the same batch.
+    def __init__(self):
+        self.operations = []
+        self.size = 0
+
+    def add(self, operations, size=None):
+        # Returns the operations of the batch that was full before these were added, or None
+        if size is None:
+            size = operations_size(operations)
+        full = None
+        if self.operations and (
+            len(self.operations) + len(operations) > MAX_BATCH_OPERATIONS or self.size + size > MAX_BATCH_BYTES
+        ):
+            full = self.flush()
+        self.operations.extend(operations)
+        self.size += size
+        return full
+
+    def flush(self):
+        operations = self.operations
+        self.operations = []
+        self.size = 0
+        return operations
@@ -0,0 +1,172 @@
+import os
+import time
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from shared_code.instrumentation import current_span
+from shared_code.resilience import (
+    DEFAULT_FAILURE_THRESHOLD,
+    DEFAULT_RESET_SECONDS,
+    CLOSED,
+    CircuitBreaker,
+    CircuitOpenError,
+    backoff_delay,
+    retry_after,
+)
+
+# Calls from the EntryPoint to the analysis functions. Each target (function URL) gets a circuit
+# breaker, so a function that keeps failing or hanging is failed fast instead of holding EntryPoint
+# workers for its whole timeout. 429 and 5xx responses, and connections that could not be made, are
+# retried with jittered exponential backoff, after the server's Retry-After when it sends one. A read
+# timeout is not retried: the request was delivered and the function keeps running it. The analyses
+# record their runs, so a retried request that had reached the function is not run twice.
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_BACKOFF_SECONDS = 1.0
+DEFAULT_MAX_BACKOFF_SECONDS = 10.0
+DEFAULT_POOL_SIZE = 10
+
+
+class DownstreamSession:
+    def __init__(self, max_attempts=None, backoff_seconds=None, max_backoff_seconds=None,
+                 failure_threshold=None, reset_seconds=None, pool_size=None, sleep=time.sleep):
+        self.max_attempts = int(max_attempts or os.getenv("DOWNSTREAM_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS))
+        self.backoff_seconds = float(backoff_seconds or os.getenv("DOWNSTREAM_BACKOFF_SECONDS", DEFAULT_BACKOFF_SECONDS))
+        self.max_backoff_seconds = float(
+            max_backoff_seconds or os.getenv("DOWNSTREAM_MAX_BACKOFF_SECONDS", DEFAULT_MAX_BACKOFF_SECONDS)
+        )
+        self.failure_threshold = int(failure_threshold or os.getenv("CIRCUIT_FAILURE_THRESHOLD", DEFAULT_FAILURE_THRESHOLD))
+        self.reset_seconds = float(reset_seconds or os.getenv("CIRCUIT_RESET_SECONDS", DEFAULT_RESET_SECONDS))
+        pool_size = int(pool_size or os.getenv("DOWNSTREAM_POOL_SIZE", DEFAULT_POOL_SIZE))
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._sleep = sleep
+        self._breakers = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def post(self, target, url, timeouts_are_failures=True, **kwargs):
+        # POST url for target, retrying as described above. Returns the last response; raises
+        # CircuitOpenError when the target's circuit is open, and the last exception when no response
+        # came. A read timeout counts as a failure of the target unless timeouts_are_failures is False,
+        # for functions expected to outlive the timeout. The attempts made and the circuit state are
+        # set on the current span.
+        breaker = self.breaker(target)
+        attempts = [0]
+        try:
+            return self._post(target, url, breaker, attempts, timeouts_are_failures, **kwargs)
+        finally:
+            active = current_span()
+            if active is not None:
+                active.set(attempts=attempts[0], circuit=breaker.state)
+
+    def _post(self, target, url, breaker, attempts, timeouts_are_failures, **kwargs):
+        response = None
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                breaker.before_call()
+            except CircuitOpenError:
+                self._count(target, "rejected")
+                # Opened by the failures of this call: its last outcome is more telling
+                if response is not None:
+                    return response
+                raise
+            attempts[0] = attempt
+            self._count(target, "requests")
+
+            try:
+                response = self.session.post(url, **kwargs)
+            except requests.exceptions.ReadTimeout:
+                self._count(target, "timeouts")
+                if timeouts_are_failures:
+                    breaker.record_failure()
+                else:
+                    breaker.release()
+                raise
+            except requests.exceptions.ConnectionError as e:
+                self._count(target, "failures")
+                breaker.record_failure()
+                if attempt == self.max_attempts or breaker.state != CLOSED:
+                    raise
+                delay = backoff_delay(attempt, self.backoff_seconds, self.max_backoff_seconds)
+                logging.warning(f"Connecting to {target} failed ({e}), retrying in {delay:.1f}s")
+            except Exception:
+                breaker.release()
+                raise
+            else:
+                if response.status_code not in RETRY_STATUS_CODES:
+                    # 4xx outcomes come from a healthy function
+                    breaker.record_success()
+                    return response
+
+                self._count(target, "failures")
+                breaker.record_failure()
+                if attempt == self.max_attempts:
+                    return response
+                delay = retry_after(response)
+                if delay is None:
+                    delay = backoff_delay(attempt, self.backoff_seconds, self.max_backoff_seconds)
+                elif delay > self.max_backoff_seconds:
+                    # Waiting that long would hold the worker, so the caller gets the response instead
+                    logging.warning(f"{target} asked to retry in {delay:.0f}s, giving up")
+                    return response
+                logging.warning(f"{target} returned {response.status_code}, retrying in {delay:.1f}s")
+
+            self._count(target, "retries")
+            self._sleep(delay)
+        return response
+
+    def breaker(self, target):
+        with self._lock:
+            breaker = self._breakers.get(target)
+            if breaker is None:
+                breaker = CircuitBreaker(target, self.failure_threshold, self.reset_seconds)
+                self._breakers[target] = breaker
+            return breaker
+
+    def metrics(self):
+        # Counters and circuit state per target: requests, retries, failures (retryable responses and
+        # connection errors), timeouts, rejected calls, and how often the circuit opened
+        with self._lock:
+            targets = list(self._breakers)
+            stats = {target: dict(self._stats.get(target, {})) for target in targets}
+        for target in targets:
+            breaker = self._breakers[target]
+            stats[target].update({"circuit": breaker.state, "circuit_opened": breaker.stats["opened"]})
+        return stats
+
+    def close(self):
+        self.session.close()
+
+    def _count(self, target, counter):
+        with self._lock:
+            stats = self._stats.setdefault(
+                target, {"requests": 0, "retries": 0, "failures": 0, "timeouts": 0, "rejected": 0}
+            )
+            stats[counter] += 1
+
+
+_lock = threading.Lock()
+_session = None
+
+
+def get_downstream_session():
+    # One session per worker process, so circuit state is shared by its invocations
+    global _session
+    with _lock:
+        if _session is None:
+            _session = DownstreamSession()
+        return _session
+
+
+def set_downstream_session(session):
+    global _session
+    with _lock:
+        _session = session
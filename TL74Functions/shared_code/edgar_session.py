@@ -0,0 +1,285 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from contextlib import asynccontextmanager
+from importlib.metadata import PackageNotFoundError, version
+
+import httpx
+
+from shared_code.filing_cache import cache_key, get_filing_cache
+from shared_code.instrumentation import span
+from shared_code.rate_limit import TokenBucket
+from shared_code.resilience import retry_after
+
+# SEC EDGAR allows 10 requests per second per client; stay below it by default
+DEFAULT_RATE = 8
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 30
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 60.0
+
+# SEC answers 429, or 403 with "Request Rate Threshold Exceeded", when a client goes over the limit
+THROTTLED_STATUS_CODES = (403, 429)
+
+# Concurrent requests for one cacheable URL wait on the same lock, so it is downloaded once
+URL_LOCK_STRIPES = 64
+
+# edgartools release whose edgar.httprequests internals _install() relies on: every request is made
+# with an httpx.Client or httpx.AsyncClient looked up on its module, behind a Throttler whose
+# wait_for_ticket() it calls. Other releases are left to their own client and throttler.
+EDGARTOOLS_VERSION = "3.5.1"
+
+
+class EdgarSession:
+    # Keep-alive HTTP client for EDGAR with the SEC identity as User-Agent. Every request takes a
+    # token from the rate limiter, and throttled responses pause all requests of the process before
+    # being retried with exponential backoff, or after the server's Retry-After. Filing documents
+    # and indexes are served from the cache, when given, after their first download.
+    def __init__(self, identity=None, rate=None, max_attempts=None, pool_size=None, timeout=None,
+                 transport=None, sleep=time.sleep, cache=None):
+        self.identity = identity or os.getenv("EDGAR_IDENTITY")
+        self.rate = float(rate or os.getenv("EDGAR_RATE_LIMIT", DEFAULT_RATE))
+        self.max_attempts = int(max_attempts or os.getenv("EDGAR_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS))
+        pool_size = int(pool_size or os.getenv("EDGAR_POOL_SIZE", DEFAULT_POOL_SIZE))
+        timeout = float(timeout or os.getenv("EDGAR_TIMEOUT", DEFAULT_TIMEOUT))
+
+        self.cache = cache
+        self.limiter = TokenBucket(self.rate, sleep=sleep)
+        self._url_locks = [threading.Lock() for _ in range(URL_LOCK_STRIPES)]
+        self._sleep = sleep
+        self.client = httpx.Client(
+            headers={"User-Agent": self.identity or ""},
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            transport=transport,
+            follow_redirects=True,
+        )
+        self.stats = {"requests": 0, "throttled": 0, "retries": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+        self._stats_lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        with span("edgar.request", method=method, url=str(url)) as current:
+            response = self._request(method, url, **kwargs)
+            current.set(status_code=response.status_code, cached=False)
+            current.add_bytes(len(response.content))
+            return response
+
+    def _request(self, method, url, **kwargs):
+        for attempt in range(1, self.max_attempts + 1):
+            self._acquire()
+            response = self.client.request(method, url, **kwargs)
+            if response.status_code not in THROTTLED_STATUS_CODES:
+                return response
+
+            self._count("throttled")
+            if attempt == self.max_attempts:
+                logging.warning(f"EDGAR kept throttling {url} after {attempt} attempts ({response.status_code})")
+                return response
+            delay = retry_after(response) or min(MAX_BACKOFF_SECONDS, DEFAULT_BACKOFF_SECONDS * 2 ** (attempt - 1))
+            delay *= random.uniform(1.0, 1.25)
+            logging.warning(f"EDGAR throttled {url} ({response.status_code}), retrying in {delay:.1f}s")
+            self._count("retries")
+            self.limiter.pause(delay)
+
+    def get(self, url, **kwargs):
+        url = str(url)
+        key = cache_key(url) if self.cache else None
+        if key is None:
+            return self.request("GET", url, **kwargs)
+
+        with self._url_locks[hash(url) % URL_LOCK_STRIPES]:
+            cached = self.cache.get(key, url)
+            if cached is not None:
+                content, content_type = cached
+                with span("edgar.request", method="GET", url=url, status_code=200, cached=True) as current:
+                    current.add_bytes(len(content))
+                headers = {"Content-Type": content_type} if content_type else None
+                return httpx.Response(200, content=content, headers=headers, request=httpx.Request("GET", url))
+
+            response = self.request("GET", url, **kwargs)
+            if response.status_code == 200:
+                self.cache.put(key, url, response.content, response.headers.get("Content-Type"))
+            return response
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def stream(self, method, url, **kwargs):
+        # Context manager over a streamed response, rate limited but not retried
+        self._acquire()
+        return self.client.stream(method, url, **kwargs)
+
+    def close(self):
+        self.client.close()
+
+    def _acquire(self):
+        waited = self.limiter.acquire()
+        with self._stats_lock:
+            self.stats["requests"] += 1
+            self.stats["wait_seconds"] += waited
+            self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], waited)
+
+    def _count(self, counter):
+        with self._stats_lock:
+            self.stats[counter] += 1
+
+
+class _SharedClient:
+    # Stands in for the httpx.Client edgartools opens and closes around every request, sending the
+    # request through the shared session instead
+    def __init__(self, session):
+        self.session = session
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.session.post(url, **kwargs)
+
+    def stream(self, method, url, **kwargs):
+        return self.session.stream(method, url, **kwargs)
+
+
+class _SharedAsyncClient:
+    # Stands in for the httpx.AsyncClient of edgartools' async requests (get_with_retry_async,
+    # download_file_async, stream_file), which sends them through the shared session in a worker
+    # thread, so they take the same rate limiter tokens as the sync ones
+    def __init__(self, session):
+        self.session = session
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def get(self, url, **kwargs):
+        return await asyncio.to_thread(self.session.get, url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await asyncio.to_thread(self.session.post, url, **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, method, url, **kwargs):
+        # The response is read in full, aiter_bytes() then iterates over its content
+        yield await asyncio.to_thread(self.session.request, method, url, **kwargs)
+
+
+class _HttpxWithSharedClient:
+    # The httpx module as seen by edgar.httprequests, with Client and AsyncClient replaced
+    def __init__(self, session):
+        self._session = session
+
+    def Client(self, *args, **kwargs):
+        return _SharedClient(self._session)
+
+    def AsyncClient(self, *args, **kwargs):
+        return _SharedAsyncClient(self._session)
+
+    def __getattr__(self, name):
+        return getattr(httpx, name)
+
+
+_lock = threading.Lock()
+_session = None
+
+
+def get_edgar_session():
+    # One session per worker process, created on first use
+    global _session
+    with _lock:
+        if _session is None:
+            _session = EdgarSession(cache=get_filing_cache())
+        return _session
+
+
+def set_edgar_session(session):
+    # Use the given session, e.g. one pointed at a local HTTP stub through its transport
+    global _session
+    with _lock:
+        _session = session
+    _install(session)
+
+
+def configure_edgar(rate=None):
+    # Set the SEC identity and route the EDGAR requests of edgartools through the shared session.
+    # Cheap after the first call of the process; rate overrides EDGAR_RATE_LIMIT when given.
+    global _session
+    with _lock:
+        if _session is None or (rate and rate != _session.rate):
+            if _session is not None:
+                _session.close()
+            _session = EdgarSession(rate=rate, cache=get_filing_cache())
+        session = _session
+    _install(session)
+    return session
+
+
+def reset_edgar_session():
+    global _session
+    with _lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def _install(session):
+    if session.identity and os.getenv("EDGAR_IDENTITY") != session.identity:
+        from edgar import set_identity
+
+        set_identity(session.identity)
+    if not _supported_edgartools():
+        return
+
+    from edgar import httprequests
+
+    if getattr(httprequests.httpx, "_session", None) is session:
+        return
+    httprequests.httpx = _HttpxWithSharedClient(session)
+    _bypass_throttler(httprequests)
+
+
+def _bypass_throttler(httprequests):
+    # Every request of edgar.httprequests, sync or async, now takes a token from the session's
+    # limiter, so the throttle of edgartools lets them through instead of limiting them twice. The
+    # Throttler class is patched, so throttlers edgartools creates later are covered as well.
+    throttler = httprequests.Throttler
+    if getattr(throttler.wait_for_ticket, "_edgar_session", False):
+        return
+    wait_for_ticket = throttler.wait_for_ticket
+
+    def shared_session_ticket(self):
+        if not isinstance(httprequests.httpx, _HttpxWithSharedClient):
+            wait_for_ticket(self)
+
+    shared_session_ticket._edgar_session = True
+    throttler.wait_for_ticket = shared_session_ticket
+
+
+_version_checked = None
+
+
+def _supported_edgartools():
+    global _version_checked
+    if _version_checked is None:
+        try:
+            installed = version("edgartools")
+        except PackageNotFoundError:
+            installed = None
+        _version_checked = installed == EDGARTOOLS_VERSION
+        if not _version_checked:
+            logging.warning(
+                f"edgartools {installed} is not {EDGARTOOLS_VERSION}: its requests keep their own client and "
+                f"throttle instead of the shared EDGAR session"
+            )
+    return _version_checked
@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import uuid
+import logging
+import tempfile
+import threading
+
+import pandas as pd
+
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+class FactsCache:
+    # On-disk cache of parsed EDGAR company facts frames (Parquet, keyed by CIK) and of
+    # accession number -> CIK lookups. File mtime is the write time used for TTL expiry and
+    # atime is refreshed on every hit so eviction can drop the least recently used entries.
+
+    def __init__(self, directory, ttl_seconds=DEFAULT_TTL_SECONDS, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(directory, "facts"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "accessions"), exist_ok=True)
+
+    def company_facts(self, cik, loader):
+        # Return the facts frame for cik, calling loader() and caching its result on a miss
+        path = os.path.join(self.directory, "facts", f"{int(cik):010d}.parquet")
+        if self._is_fresh(path):
+            try:
+                frame = pd.read_parquet(path)
+                self._record_hit(path)
+                return frame
+            except Exception as e:
+                logging.warning(f"Discarding unreadable facts cache entry {path}: {e}")
+                self._remove(path)
+
+        self._count("misses")
+        frame = loader()
+        self._write(path, lambda tmp_path: frame.to_parquet(tmp_path, index=True))
+        return frame
+
+    def filing_cik(self, accn, loader):
+        # Return the CIK that filed accn, calling loader() on a miss. The mapping never changes,
+        # so these entries are only subject to size-based eviction, not the TTL
+        path = os.path.join(self.directory, "accessions", f"{accn}.json")
+        try:
+            with open(path) as f:
+                cik = json.load(f)["cik"]
+            self._record_hit(path)
+            return cik
+        except (OSError, ValueError, KeyError):
+            pass
+
+        self._count("misses")
+        cik = loader()
+        self._write(path, lambda tmp_path: _write_json(tmp_path, {"cik": int(cik)}))
+        return cik
+
+    def total_bytes(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        # Drop least recently used entries until the cache fits within max_bytes
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if self._remove(path):
+                total -= size
+                self._count("evictions")
+
+    def _is_fresh(self, path):
+        try:
+            age = time.time() - os.path.getmtime(path)
+        except OSError:
+            return False
+        if age > self.ttl_seconds:
+            self._count("expired")
+            self._remove(path)
+            return False
+        return True
+
+    def _record_hit(self, path):
+        self._count("hits")
+        try:
+            # Keep the write time (mtime) and refresh the access time used for LRU ordering
+            os.utime(path, (time.time(), os.path.getmtime(path)))
+        except OSError:
+            pass
+
+    def _write(self, path, write):
+        # Write through a temporary file so concurrent workers never read a partial entry
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logging.warning(f"Unable to write facts cache entry {path}: {e}")
+            self._remove(tmp_path)
+            return
+        self.evict()
+
+    def _entries(self):
+        for subdirectory in ("facts", "accessions"):
+            root = os.path.join(self.directory, subdirectory)
+            for name in os.listdir(root):
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_size, stat.st_atime
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def _count(self, counter):
+        with self._lock:
+            self.stats[counter] += 1
+
+
+def _write_json(path, data):
+    with open(path, "w") as f:
+        json.dump(data, f)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_facts_cache():
+    # Process-wide cache configured from the environment:
+    #   FACTS_CACHE_DIR            cache directory, defaults to the function app's temp storage
+    #   FACTS_CACHE_TTL_SECONDS    age after which cached company facts are refetched
+    #   FACTS_CACHE_MAX_BYTES      total size above which least recently used entries are evicted
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = FactsCache(
+                os.getenv("FACTS_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "tl74_facts_cache"),
+                ttl_seconds=float(os.getenv("FACTS_CACHE_TTL_SECONDS", DEFAULT_TTL_SECONDS)),
+                max_bytes=int(os.getenv("FACTS_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)),
+            )
+        return _cache
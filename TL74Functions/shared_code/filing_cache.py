@@ -0,0 +1,169 @@
+import os
+import re
+import json
+import time
+import uuid
+import hashlib
+import logging
+import tempfile
+import threading
+from datetime import date
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+# EDGAR archive URLs whose content never changes, and the cache key they are stored under:
+#   .../Archives/edgar/data/<cik>/<accession without dashes>/<document>   -> the accession number
+#   .../Archives/edgar/data/<cik>/<accession>.txt, <accession>-index.html -> the accession number
+#   .../Archives/edgar/full-index/<year>/QTR<n>/<index>                   -> "full-index-<year>Q<n>",
+#                                                                            once the quarter is over
+_ACCESSION_FOLDER_URL = re.compile(r"/Archives/edgar/data/\d+/(\d{10})(\d{2})(\d{6})(?:/|$)")
+_ACCESSION_FILE_URL = re.compile(r"/Archives/edgar/data/\d+/(\d{10}-\d{2}-\d{6})[^/]*$")
+_FULL_INDEX_URL = re.compile(r"/Archives/edgar/full-index/(\d{4})/QTR([1-4])/")
+
+
+def cache_key(url):
+    # The accession number (or closed quarter) the document at url belongs to, or None when the
+    # URL may change and must not be cached
+    url = url.split("?", 1)[0]
+    match = _ACCESSION_FOLDER_URL.search(url)
+    if match:
+        return "-".join(match.groups())
+    match = _ACCESSION_FILE_URL.search(url)
+    if match:
+        return match.group(1)
+    match = _FULL_INDEX_URL.search(url)
+    if match:
+        year, quarter = int(match.group(1)), int(match.group(2))
+        today = date.today()
+        if (year, quarter) < (today.year, (today.month - 1) // 3 + 1):
+            return f"full-index-{year}Q{quarter}"
+    return None
+
+
+class FilingCache:
+    # On-disk cache of EDGAR filing documents and indexes. Contents are stored once per SHA-256 under
+    # "blobs", and "index/<key>/<url hash>.json" maps each cached URL of an accession to its blob, so
+    # a document served under several URLs is stored once. Blob atime is refreshed on every hit, and
+    # the least recently used blobs are evicted once the cache exceeds max_bytes.
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(directory, "blobs"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "index"), exist_ok=True)
+
+    def get(self, key, url):
+        # Returns (content, content_type) or None
+        entry_path = self._entry_path(key, url)
+        try:
+            with open(entry_path) as f:
+                entry = json.load(f)
+            content = self._read_blob(self._blob_path(entry["sha256"]))
+        except (OSError, ValueError, KeyError):
+            self._count("misses")
+            return None
+        self._count("hits")
+        return content, entry.get("content_type")
+
+    def put(self, key, url, content, content_type=None):
+        digest = hashlib.sha256(content).hexdigest()
+        blob_path = self._blob_path(digest)
+        if not os.path.exists(blob_path):
+            if not self._write(blob_path, lambda f: f.write(content), "wb"):
+                return
+        os.makedirs(os.path.dirname(self._entry_path(key, url)), exist_ok=True)
+        entry = {"url": url, "sha256": digest, "size": len(content), "content_type": content_type}
+        if self._write(self._entry_path(key, url), lambda f: json.dump(entry, f), "w"):
+            self.evict()
+
+    def total_bytes(self):
+        return sum(size for _, size, _ in self._blobs())
+
+    def evict(self):
+        # Drop least recently used blobs until the cache fits within max_bytes. Index entries of an
+        # evicted blob are left behind and count as misses until the document is cached again.
+        blobs = sorted(self._blobs(), key=lambda blob: blob[2])
+        total = sum(size for _, size, _ in blobs)
+        for path, size, _ in blobs:
+            if total <= self.max_bytes:
+                break
+            if _remove(path):
+                total -= size
+                self._count("evictions")
+
+    def _read_blob(self, path):
+        with open(path, "rb") as f:
+            content = f.read()
+        try:
+            # Keep the write time (mtime) and refresh the access time used for LRU ordering
+            os.utime(path, (time.time(), os.path.getmtime(path)))
+        except OSError:
+            pass
+        return content
+
+    def _write(self, path, write, mode):
+        # Write through a temporary file so concurrent workers never read a partial entry
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, mode) as f:
+                write(f)
+            os.replace(tmp_path, path)
+            return True
+        except Exception as e:
+            logging.warning(f"Unable to write filing cache entry {path}: {e}")
+            _remove(tmp_path)
+            return False
+
+    def _blob_path(self, digest):
+        return os.path.join(self.directory, "blobs", digest)
+
+    def _entry_path(self, key, url):
+        return os.path.join(self.directory, "index", key, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json")
+
+    def _blobs(self):
+        root = os.path.join(self.directory, "blobs")
+        for name in os.listdir(root):
+            if name.endswith(".tmp"):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            yield path, stat.st_size, stat.st_atime
+
+    def _count(self, counter):
+        with self._lock:
+            self.stats[counter] += 1
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+        return True
+    except OSError:
+        return False
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_filing_cache():
+    # Process-wide cache configured from the environment, or None when disabled:
+    #   FILING_CACHE_DIR          cache directory, defaults to the function app's temp storage
+    #   FILING_CACHE_MAX_BYTES    total size above which least recently used documents are evicted,
+    #                             0 disables the cache
+    global _cache
+    max_bytes = int(os.getenv("FILING_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+    if max_bytes <= 0:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = FilingCache(
+                os.getenv("FILING_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "tl74_filing_cache"),
+                max_bytes=max_bytes,
+            )
+        return _cache
@@ -0,0 +1,93 @@
+import logging
+
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosHttpResponseError,
+    CosmosResourceNotFoundError,
+)
+
+# Analyses are stored on a filing document with a partial document update: the entry is added to the
+# end of "analyses" and the filing fields the analysis derives (e.g. fiscal_period) are set, in one
+# patch. Concurrent analyses of a filing therefore never overwrite each other, and a write costs
+# neither a read nor a replace of the whole document. A filing that cannot be patched (no "analyses"
+# array, or more changes than one patch allows) is read and replaced on the condition that its ETag
+# did not change in between, and read again when it did.
+
+# Operations allowed in one patch request
+MAX_PATCH_OPERATIONS = 10
+
+# Attempts at the patch and conditional replace before a concurrent writer's change is reported
+WRITE_ATTEMPTS = 5
+
+
+def analysis_patch_operations(analyses, fields=None):
+    operations = [{"op": "add", "path": "/analyses/-", "value": analysis} for analysis in analyses]
+    for key, value in (fields or {}).items():
+        operations.append({"op": "set", "path": f"/{_pointer(key)}", "value": value})
+    return operations
+
+
+def apply_analysis(filing, analyses, fields=None, supersedes=None):
+    # The same change made to a filing document in memory. Earlier entries for which
+    # supersedes(entry) is true are removed.
+    existing = filing.get("analyses") or []
+    filing["analyses"] = [entry for entry in existing if not (supersedes and supersedes(entry))] + list(analyses)
+    filing.update(fields or {})
+    return filing
+
+
+def append_analysis(container, accession_code, ticker, analysis, fields=None):
+    # Append one analysis entry to a filing and set fields on it. Returns the updated filing and
+    # raises CosmosResourceNotFoundError when the filing does not exist.
+    operations = analysis_patch_operations([analysis], fields)
+    for attempt in range(WRITE_ATTEMPTS):
+        if len(operations) <= MAX_PATCH_OPERATIONS:
+            try:
+                return container.patch_item(item=accession_code, partition_key=ticker, patch_operations=operations)
+            except CosmosResourceNotFoundError:
+                raise
+            except CosmosHttpResponseError as e:
+                # 400: the filing has no "analyses" array to append to
+                if e.status_code != 400:
+                    raise
+                if attempt == 0:
+                    logging.warning(f"Patching filing {accession_code} failed, replacing it instead: {e}")
+
+        filing = container.read_item(item=accession_code, partition_key=ticker)
+        body = apply_analysis(_body(filing), [analysis], fields)
+        try:
+            return container.replace_item(
+                item=accession_code, body=body, etag=filing.get("_etag"), match_condition=MatchConditions.IfNotModified
+            )
+        except CosmosAccessConditionFailedError:
+            # A concurrent writer changed the filing, possibly adding the array the patch needs
+            if attempt == WRITE_ATTEMPTS - 1:
+                raise
+            logging.warning(f"Retrying the update of filing {accession_code} after a concurrent change")
+
+
+def filing_update_operation(filing, analyses, fields=None, supersedes=None):
+    # Transactional batch operation making the apply_analysis() change to a filing read from the
+    # container. Appends are patched in unconditionally. Removing superseded entries addresses them by
+    # position, so that patch only applies while the filing is unchanged since it was read, as does
+    # the whole-document replace used when the filing cannot be patched.
+    existing = filing.get("analyses")
+    etag = {"if_match_etag": filing["_etag"]} if filing.get("_etag") else {}
+    if isinstance(existing, list):
+        removed = [index for index, entry in enumerate(existing) if supersedes and supersedes(entry)]
+        operations = [{"op": "remove", "path": f"/analyses/{index}"} for index in reversed(removed)]
+        operations += analysis_patch_operations(analyses, fields)
+        if len(operations) <= MAX_PATCH_OPERATIONS:
+            return ("patch", (filing["id"], operations), etag if removed else {})
+    return ("replace", (filing["id"], apply_analysis(_body(filing), analyses, fields, supersedes)), etag)
+
+
+def _body(filing):
+    # The document without its system properties
+    return {key: value for key, value in filing.items() if not key.startswith("_")}
+
+
+def _pointer(key):
+    # JSON pointer escaping of a property name
+    return str(key).replace("~", "~0").replace("/", "~1")
@@ -0,0 +1,148 @@
+import os
+import time
+import logging
+
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosResourceExistsError,
+    CosmosResourceNotFoundError,
+)
+
+# Analysis runs are recorded in the filings container, next to the filing they belong to, as
+# "{accession_code}::run::{analysis_type}::v{analysis_version}" documents. A run is either
+# in progress (leased until lease_expires_at), completed, or failed; completed runs are not
+# repeated and their stored outcome is returned instead, unless the caller forces a rerun.
+IN_PROGRESS = "in_progress"
+COMPLETED = "completed"
+FAILED = "failed"
+
+# Outcomes that are final for a filing and are served from the record on later requests
+COMPLETED_STATUS_CODES = (200, 204)
+
+DEFAULT_LEASE_SECONDS = 600
+
+
+def is_forced(value):
+    return str(value).lower() in ("1", "true", "yes")
+
+
+def run_record_id(accession_code, analysis_type, analysis_version):
+    return f"{accession_code}::run::{analysis_type}::v{analysis_version}"
+
+
+def new_run_record(accession_code, ticker, analysis_type, analysis_version):
+    now = time.time()
+    lease_seconds = float(os.getenv("ANALYSIS_LEASE_SECONDS", DEFAULT_LEASE_SECONDS))
+    return {
+        "id": run_record_id(accession_code, analysis_type, analysis_version),
+        "doc_type": "analysis_run",
+        "accession_code": accession_code,
+        "ticker": ticker,
+        "analysis_type": analysis_type,
+        "analysis_version": analysis_version,
+        "status": IN_PROGRESS,
+        "started_at": now,
+        "lease_expires_at": now + lease_seconds,
+    }
+
+
+def claim_run(container, accession_code, ticker, analysis_type, analysis_version, force=False):
+    # Try to become the one worker running this analysis. Returns (True, record) when the caller
+    # must run it, or (False, record) with the completed or in-progress record of another run.
+    record = new_run_record(accession_code, ticker, analysis_type, analysis_version)
+    now = record["started_at"]
+
+    try:
+        return True, container.create_item(record)
+    except CosmosResourceExistsError:
+        pass
+
+    try:
+        existing = container.read_item(item=record["id"], partition_key=ticker)
+    except CosmosResourceNotFoundError:
+        # Removed between the create and the read, claim it again from scratch
+        return claim_run(container, accession_code, ticker, analysis_type, analysis_version, force)
+
+    if not force:
+        if existing.get("status") == COMPLETED:
+            return False, existing
+        if existing.get("status") == IN_PROGRESS and existing.get("lease_expires_at", 0) > now:
+            return False, existing
+
+    # Failed, expired or forced: take the record over, unless another worker does so first
+    try:
+        return True, container.replace_item(
+            item=record["id"], body=record, etag=existing.get("_etag"), match_condition=MatchConditions.IfNotModified
+        )
+    except CosmosAccessConditionFailedError:
+        return False, container.read_item(item=record["id"], partition_key=ticker)
+
+
+def finish_run(container, record, response_message, status_code):
+    # Record the outcome on the claimed record, unless another worker took the run over after its
+    # lease expired: that run's record is kept and this outcome is dropped
+    try:
+        container.replace_item(
+            item=record["id"], body=finished_run_record(record, response_message, status_code),
+            etag=record.get("_etag"), match_condition=MatchConditions.IfNotModified
+        )
+    except CosmosAccessConditionFailedError:
+        logging.warning(
+            f"Dropping outcome {status_code} of {record['id']}: the run was taken over by another worker."
+        )
+
+
+def finished_run_record(record, response_message, status_code):
+    record = {key: value for key, value in record.items() if not key.startswith("_")}
+    record.update({
+        "status": COMPLETED if status_code in COMPLETED_STATUS_CODES else FAILED,
+        "status_code": status_code,
+        "response_message": response_message,
+        "completed_at": time.time(),
+    })
+    return record
+
+
+def completed_runs(container, ticker, accession_codes, analysis_type, analysis_version):
+    # Completed run records of several filings of one ticker, keyed by accession code. Reads
+    # them with one query per 100 filings instead of one point read per filing
+    ids = [run_record_id(accession_code, analysis_type, analysis_version) for accession_code in accession_codes]
+    records = {}
+    for start in range(0, len(ids), 100):
+        for record in container.query_items(
+            "SELECT * FROM c WHERE ARRAY_CONTAINS(@ids, c.id)",
+            parameters=[{"name": "@ids", "value": ids[start:start + 100]}],
+            partition_key=ticker,
+        ):
+            if record.get("status") == COMPLETED:
+                records[record["accession_code"]] = record
+    return records
+
+
+def run_once(container, accession_code, ticker, analysis_type, analysis_version, run, force=False):
+    # Run run() -> (response_message, status_code) at most once per analysis version of a filing.
+    # Duplicate requests get the stored outcome of the completed run, or 202 while it is running.
+    claimed, record = claim_run(container, accession_code, ticker, analysis_type, analysis_version, force)
+    if not claimed:
+        return recorded_outcome(record)
+
+    try:
+        response_message, status_code = run()
+    except Exception as e:
+        finish_run(container, record, str(e), 500)
+        raise
+
+    finish_run(container, record, response_message, status_code)
+    return response_message, status_code
+
+
+def recorded_outcome(record):
+    # Response for a request that was not claimed because the run is completed or in progress
+    accession_code = record.get("accession_code")
+    analysis = f"{record.get('analysis_type')} v{record.get('analysis_version')}"
+    if record.get("status") == COMPLETED:
+        logging.info(f"Skipping {analysis} for {accession_code}: already completed.")
+        return record.get("response_message"), record.get("status_code", 200)
+    logging.info(f"Skipping {analysis} for {accession_code}: already in progress.")
+    return f"{analysis} analysis for {accession_code} is already in progress.", 202
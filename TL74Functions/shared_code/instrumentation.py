@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where peak memory is not recorded
+    resource = None
+
+# Spans time one stage of an invocation (an EDGAR download, the analysis of a company's facts, a
+# model request, a Cosmos DB operation, a call to another function...) and record next to its wall
+# time the peak resident memory of the process, the payload bytes it moved and the Cosmos DB
+# request units it consumed. Spans opened while another one is running become its children and
+# share its trace_id, across threads started with a copy of the context.
+#
+# Finished spans are handed to the exporters. INSTRUMENTATION selects the default one:
+#   "log"  (default) one log record per span, with the span in custom_dimensions, which the Azure
+#          Monitor log handlers store as customDimensions in Application Insights
+#   "off"  spans are not exported
+# An InMemoryExporter collects spans for scripts and checks instead.
+
+_current = contextvars.ContextVar("instrumentation_span", default=None)
+
+
+class Span:
+    def __init__(self, name, parent=None, **attributes):
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes
+        self.payload_bytes = 0
+        self.request_charge = 0.0
+        self.started_at = time.time()
+        self.duration = None
+        self.peak_rss_mb = None
+        self.error = None
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add_bytes(self, count):
+        with self._lock:
+            self.payload_bytes += count or 0
+
+    def add_charge(self, request_units):
+        with self._lock:
+            self.request_charge += request_units or 0.0
+
+    def end(self, error=None):
+        # Finish the span and export it; later calls do nothing
+        with self._lock:
+            if self.duration is not None:
+                return
+            self.duration = time.perf_counter() - self._started
+        self.peak_rss_mb = peak_rss_mb()
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+        export(self)
+
+    def dimensions(self):
+        # Flat, JSON-serializable view of the span, as stored in Application Insights
+        dimensions = dict(self.attributes)
+        dimensions.update({
+            "span": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "duration_ms": round((self.duration or 0.0) * 1000, 3),
+            "peak_rss_mb": self.peak_rss_mb,
+            "payload_bytes": self.payload_bytes,
+            "request_charge": round(self.request_charge, 2),
+        })
+        if self.error is not None:
+            dimensions["error"] = self.error
+        return dimensions
+
+
+def peak_rss_mb():
+    # Peak resident memory of the process so far, or None where it is not available
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes elsewhere
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def current_span():
+    return _current.get()
+
+
+def start_span(name, **attributes):
+    # A child of the current span that is not made current itself, for work that outlives the block
+    # starting it (e.g. a lazily iterated query). The caller ends it.
+    return Span(name, _current.get(), **attributes)
+
+
+@contextmanager
+def span(name, **attributes):
+    # Record the block as a span, current while it runs
+    current = Span(name, _current.get(), **attributes)
+    token = _current.set(current)
+    try:
+        yield current
+    except Exception as e:
+        current.end(e)
+        raise
+    finally:
+        _current.reset(token)
+        current.end()
+
+
+def traced(name=None, **attributes):
+    # Decorator recording every call of a function as a span
+    def decorate(function):
+        span_name = name or f"{function.__module__}.{function.__qualname__}"
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(span_name, **attributes):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+class LoggingExporter:
+    def __init__(self, level=logging.INFO):
+        self.level = level
+
+    def export(self, span):
+        dimensions = span.dimensions()
+        logging.log(
+            self.level,
+            f"span {span.name} {dimensions['duration_ms']:.1f} ms {json.dumps(dimensions, default=str)}",
+            extra={"custom_dimensions": dimensions},
+        )
+
+
+class InMemoryExporter:
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def find(self, name):
+        with self._lock:
+            return [span for span in self.spans if span.name == name]
+
+    def clear(self):
+        with self._lock:
+            self.spans.clear()
+
+
+_exporters = None
+_exporters_lock = threading.Lock()
+
+
+def get_exporters():
+    global _exporters
+    with _exporters_lock:
+        if _exporters is None:
+            _exporters = [] if os.getenv("INSTRUMENTATION", "log").lower() == "off" else [LoggingExporter()]
+        return list(_exporters)
+
+
+def set_exporters(exporters):
+    # Replace the exporters of the process, e.g. with an InMemoryExporter; returns the previous ones
+    global _exporters
+    previous = get_exporters()
+    with _exporters_lock:
+        _exporters = list(exporters)
+    return previous
+
+
+def export(span):
+    for exporter in get_exporters():
+        try:
+            exporter.export(span)
+        except Exception as e:
+            logging.warning(f"Unable to export span {span.name}: {e}")
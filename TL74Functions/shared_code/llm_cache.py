@@ -0,0 +1,293 @@
+import os
+import json
+import time
+import array
+import asyncio
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import threading
+import contextvars
+from contextlib import closing, contextmanager
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# Only texts at least this long are worth a cache lookup; shorter ones tokenize faster than that
+DEFAULT_MIN_CHARS = 20000
+
+# (accession code, progress store) of the LLM analysis running in the current invocation
+_scope = contextvars.ContextVar("llm_cache_scope", default=None)
+
+
+class LLMCache:
+    # SQLite cache of the two expensive steps of an LLM analysis:
+    #   tokens       tiktoken encodings of a filing's section texts, keyed by accession code,
+    #                encoding and text hash, so sections are not tokenized again on a rerun
+    #   completions  chat completion responses, keyed by a hash of the endpoint, model, messages
+    #                and parameters, so identical prompts are not sent to the model again
+    # Rows record their last access, and the least recently used ones are evicted once the cache
+    # exceeds max_bytes.
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.stats = {
+            "token_hits": 0, "token_misses": 0,
+            "completion_hits": 0, "completion_misses": 0,
+            "tokens_saved": 0, "evictions": 0,
+        }
+        self._lock = threading.Lock()
+        with closing(self._connect()) as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS tokens ("
+                "key TEXT PRIMARY KEY, accession_code TEXT, tokens BLOB NOT NULL, "
+                "size INTEGER NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS completions ("
+                "key TEXT PRIMARY KEY, model TEXT, response TEXT NOT NULL, "
+                "size INTEGER NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        # Autocommit: each statement commits on its own, so connections are only closed after use
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def tokens(self, accession_code, encoding_name, text, encode):
+        # Token ids of text, calling encode() and caching its result on a miss
+        key = _hash(accession_code, encoding_name, text)
+        row = self._get("tokens", "tokens", key)
+        if row is not None:
+            self._count("token_hits")
+            return array.array("I", row).tolist()
+
+        self._count("token_misses")
+        tokens = encode()
+        blob = array.array("I", tokens).tobytes()
+        self._put(
+            "INSERT OR REPLACE INTO tokens (key, accession_code, tokens, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, accession_code, blob, len(blob)),
+        )
+        return tokens
+
+    def completion(self, request, create, parse):
+        # Response to a completion request (a JSON-serializable dict), calling create() on a miss.
+        # Cached responses are stored as JSON and rebuilt with parse().
+        response = self.cached_completion(request, parse)
+        if response is None:
+            response = create()
+            self.store_completion(request, response)
+        return response
+
+    def cached_completion(self, request, parse):
+        # The cached response to a completion request, or None on a miss
+        row = self._get("completions", "response", completion_key(request))
+        if row is None:
+            self._count("completion_misses")
+            return None
+        self._count("completion_hits")
+        response = parse(row)
+        usage = getattr(response, "usage", None)
+        with self._lock:
+            self.stats["tokens_saved"] += getattr(usage, "total_tokens", 0) or 0
+        return response
+
+    def store_completion(self, request, response):
+        data = response.model_dump_json() if hasattr(response, "model_dump_json") else json.dumps(response)
+        self._put(
+            "INSERT OR REPLACE INTO completions (key, model, response, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (completion_key(request), request.get("model"), data, len(data)),
+        )
+
+    def hit_rates(self):
+        rates = {}
+        for level in ("token", "completion"):
+            lookups = self.stats[f"{level}_hits"] + self.stats[f"{level}_misses"]
+            rates[level] = self.stats[f"{level}_hits"] / lookups if lookups else None
+        return rates
+
+    def total_bytes(self):
+        with closing(self._connect()) as connection:
+            return sum(
+                connection.execute(f"SELECT COALESCE(SUM(size), 0) FROM {table}").fetchone()[0]
+                for table in ("tokens", "completions")
+            )
+
+    def evict(self):
+        # Drop least recently used rows of either level until the cache fits within max_bytes
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return
+        with closing(self._connect()) as connection:
+            rows = connection.execute(
+                "SELECT 'tokens', key, size, accessed_at FROM tokens "
+                "UNION ALL SELECT 'completions', key, size, accessed_at FROM completions ORDER BY accessed_at"
+            ).fetchall()
+            for table, key, size, _ in rows:
+                if total <= self.max_bytes:
+                    break
+                connection.execute(f"DELETE FROM {table} WHERE key = ?", (key,))
+                total -= size
+                self._count("evictions")
+
+    def _get(self, table, column, key):
+        try:
+            with closing(self._connect()) as connection:
+                row = connection.execute(f"SELECT {column} FROM {table} WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    connection.execute(f"UPDATE {table} SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        except sqlite3.Error as e:
+            logging.warning(f"Unable to read LLM cache entry {key}: {e}")
+            return None
+        return row[0] if row else None
+
+    def _put(self, statement, values):
+        now = time.time()
+        try:
+            with closing(self._connect()) as connection:
+                connection.execute(statement, values + (now, now))
+            self.evict()
+        except sqlite3.Error as e:
+            logging.warning(f"Unable to write LLM cache entry: {e}")
+
+    def _count(self, counter):
+        with self._lock:
+            self.stats[counter] += 1
+
+
+def completion_key(request):
+    return _hash(json.dumps(request, sort_keys=True, default=str))
+
+
+def _hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_llm_cache():
+    # Process-wide cache configured from the environment, or None when disabled:
+    #   LLM_CACHE_PATH        SQLite database, defaults to the function app's temp storage
+    #   LLM_CACHE_MAX_BYTES   total size above which least recently used entries are evicted,
+    #                         0 disables the cache
+    global _cache
+    max_bytes = int(os.getenv("LLM_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+    if max_bytes <= 0:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = LLMCache(
+                os.getenv("LLM_CACHE_PATH") or os.path.join(tempfile.gettempdir(), "tl74_llm_cache.sqlite3"),
+                max_bytes=max_bytes,
+            )
+        return _cache
+
+
+@contextmanager
+def llm_cache_scope(accession_code, progress=None):
+    # Serve the tokenization and chat completions of the LLM analysis of accession_code from the
+    # cache while the block runs. With a progress store (see shared_code/llm_progress.py), every
+    # completion is also recorded there as soon as it is received, and completions it already holds
+    # are replayed without querying the model. Yields the cache, or None when it is disabled.
+    cache = get_llm_cache()
+    _install()
+    token = _scope.set((accession_code, progress))
+    try:
+        yield cache
+    finally:
+        _scope.reset(token)
+
+
+_installed = False
+
+
+def _install():
+    # The LLM pipeline tokenizes with tiktoken and queries the model through the openai client, so
+    # both are wrapped where they are defined: tiktoken.Encoding.encode, and the create() of the sync
+    # Completions and async AsyncCompletions resources. Written against tiktoken 0.9.0 and openai
+    # 1.70.0, the versions pinned in requirements.txt. Calls outside an llm_cache_scope() are untouched.
+    global _installed
+    with _cache_lock:
+        if _installed:
+            return
+        _installed = True
+
+    import tiktoken
+    from openai.types.chat import ChatCompletion
+    from openai.resources.chat.completions import AsyncCompletions, Completions
+
+    min_chars = int(os.getenv("LLM_CACHE_MIN_CHARS", DEFAULT_MIN_CHARS))
+    encode = tiktoken.Encoding.encode
+    create = Completions.create
+    create_async = AsyncCompletions.create
+
+    def cached_encode(self, text, *args, **kwargs):
+        scope = _scope.get()
+        if scope is None or _cache is None or len(text) < min_chars or args:
+            return encode(self, text, *args, **kwargs)
+        name = f"{self.name}:{json.dumps(kwargs, sort_keys=True, default=sorted)}"
+        return _cache.tokens(scope[0], name, text, lambda: encode(self, text, **kwargs))
+
+    def scoped_request(completions, args, kwargs):
+        # (request, progress store) of a completion to serve from the cache and the progress store,
+        # or None when the call is passed through
+        scope = _scope.get()
+        progress = scope[1] if scope else None
+        if scope is None or (_cache is None and progress is None) or args or kwargs.get("stream"):
+            return None
+        request = {key: value for key, value in kwargs.items() if key not in ("timeout", "extra_headers")}
+        request["base_url"] = str(completions._client.base_url)
+        return request, progress
+
+    def stored_response(request, progress):
+        # The response already in the progress store or the cache, or None
+        if progress is not None:
+            stored = progress.get(completion_key(request))
+            if stored is not None:
+                return ChatCompletion.model_validate_json(stored)
+        if _cache is not None:
+            return _cache.cached_completion(request, ChatCompletion.model_validate_json)
+        return None
+
+    def cached_create(self, *args, **kwargs):
+        scoped = scoped_request(self, args, kwargs)
+        if scoped is None:
+            return create(self, *args, **kwargs)
+        request, progress = scoped
+
+        response = stored_response(request, progress)
+        if response is None:
+            response = create(self, **kwargs)
+            if _cache is not None:
+                _cache.store_completion(request, response)
+        if progress is not None:
+            progress.record(completion_key(request), response.model_dump_json())
+        return response
+
+    async def cached_create_async(self, *args, **kwargs):
+        scoped = scoped_request(self, args, kwargs)
+        if scoped is None:
+            return await create_async(self, *args, **kwargs)
+        request, progress = scoped
+
+        # The cache is a SQLite database and the progress store writes to Cosmos DB, so both are
+        # used from worker threads to keep them off the event loop
+        response = await asyncio.to_thread(stored_response, request, progress)
+        if response is None:
+            response = await create_async(self, **kwargs)
+            if _cache is not None:
+                await asyncio.to_thread(_cache.store_completion, request, response)
+        if progress is not None:
+            await asyncio.to_thread(progress.record, completion_key(request), response.model_dump_json())
+        return response
+
+    tiktoken.Encoding.encode = cached_encode
+    Completions.create = cached_create
+    AsyncCompletions.create = cached_create_async
@@ -0,0 +1,250 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager, asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from shared_code.instrumentation import span
+from shared_code.rate_limit import TokenBucket
+
+DEFAULT_MAX_CONCURRENCY = 8
+
+# Rough size of a prompt before the model reports its usage, and the completion size assumed when a
+# request does not cap it
+CHARS_PER_TOKEN = 4
+DEFAULT_COMPLETION_TOKENS = 1024
+
+
+class LLMLimiter:
+    # Process-wide limits on model requests, shared by every openai client of the worker whose
+    # http_client is built on a LimitedTransport: at most max_concurrency requests in flight, and, when tokens_per_minute is set, a token bucket
+    # charged with each request's estimated prompt and completion tokens before it is sent and
+    # corrected with the usage the model reports.
+    def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY, tokens_per_minute=None):
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.bucket = TokenBucket(tokens_per_minute / 60, capacity=tokens_per_minute) if tokens_per_minute else None
+        self.stats = {"requests": 0, "failures": 0, "tokens": 0, "wait_seconds": 0.0}
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def request(self, body):
+        estimate = estimate_tokens(body)
+        with span("llm.request", model=_model(body), estimated_tokens=estimate) as current:
+            waited = self.bucket.acquire(estimate) if self.bucket else 0.0
+            started = time.monotonic()
+            with self._slots:
+                current.set(wait_seconds=self._record_wait(waited + time.monotonic() - started))
+                outcome = {}
+                try:
+                    yield outcome
+                except Exception:
+                    self._count("failures")
+                    raise
+                finally:
+                    current.set(tokens=self._settle(estimate, outcome.get("tokens")))
+
+    @asynccontextmanager
+    async def request_async(self, body):
+        estimate = estimate_tokens(body)
+        with span("llm.request", model=_model(body), estimated_tokens=estimate) as current:
+            waited = self.bucket.reserve(estimate) if self.bucket else 0.0
+            if waited:
+                await asyncio.sleep(waited)
+            # The slots are shared with threads and other event loops, so they are polled
+            started = time.monotonic()
+            while not self._slots.acquire(blocking=False):
+                await asyncio.sleep(0.05)
+            current.set(wait_seconds=self._record_wait(waited + time.monotonic() - started))
+            outcome = {}
+            try:
+                yield outcome
+            except Exception:
+                self._count("failures")
+                raise
+            finally:
+                self._slots.release()
+                current.set(tokens=self._settle(estimate, outcome.get("tokens")))
+
+    def _settle(self, estimate, tokens):
+        used = tokens or estimate
+        if self.bucket and used != estimate:
+            self.bucket.reserve(used - estimate)
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["tokens"] += used
+        return used
+
+    def _record_wait(self, seconds):
+        with self._lock:
+            self.stats["wait_seconds"] += seconds
+        return seconds
+
+    def _count(self, counter):
+        with self._lock:
+            self.stats[counter] += 1
+
+
+def _model(body):
+    return body.get("model") if isinstance(body, dict) else None
+
+
+def estimate_tokens(body):
+    if not isinstance(body, dict):
+        return DEFAULT_COMPLETION_TOKENS
+    prompt = {key: value for key, value in body.items() if key in ("messages", "input", "prompt")}
+    completion = body.get("max_completion_tokens") or body.get("max_tokens") or DEFAULT_COMPLETION_TOKENS
+    return len(json.dumps(prompt, default=str)) // CHARS_PER_TOKEN + completion
+
+
+def _used_tokens(response):
+    # Total tokens the model reports in a read completion response, or None
+    try:
+        usage = response.json().get("usage") or {}
+    except (ValueError, AttributeError):
+        return None
+    return usage.get("total_tokens")
+
+
+class LimitedTransport:
+    # httpx transport, sync and async, sending the model requests (POSTs) of an openai client through
+    # the process-wide limiter. Pass limited_http_client() or limited_async_http_client() as the
+    # client's http_client, or wrap the transport of your own httpx client. The response body is read while the request holds its slot, so the
+    # charge can be corrected with the usage it reports; streamed responses keep their estimated charge.
+    # httpx is only imported by the clients using it, since it loads its command line interface with it.
+    def __init__(self, transport):
+        self.transport = transport
+
+    def handle_request(self, request):
+        if request.method != "POST":
+            return self.transport.handle_request(request)
+        body = _json_body(request)
+        with get_llm_limiter().request(body) as outcome:
+            response = self.transport.handle_request(request)
+            if body.get("stream"):
+                return response
+            if response.is_stream_consumed:
+                outcome["tokens"] = _used_tokens(response)
+            else:
+                response, outcome["tokens"] = _buffered(request, response, b"".join(response.iter_raw()))
+            return response
+
+    async def handle_async_request(self, request):
+        if request.method != "POST":
+            return await self.transport.handle_async_request(request)
+        body = _json_body(request)
+        async with get_llm_limiter().request_async(body) as outcome:
+            response = await self.transport.handle_async_request(request)
+            if body.get("stream"):
+                return response
+            if response.is_stream_consumed:
+                outcome["tokens"] = _used_tokens(response)
+            else:
+                raw = b"".join([chunk async for chunk in response.aiter_raw()])
+                response, outcome["tokens"] = _buffered(request, response, raw)
+            return response
+
+    def close(self):
+        self.transport.close()
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def _json_body(request):
+    try:
+        body = json.loads(request.content or b"{}")
+    except ValueError:
+        return {}
+    return body if isinstance(body, dict) else {}
+
+
+def _buffered(request, response, raw):
+    # A copy of response, whose raw body was read, that the client can read again, and the total
+    # tokens the model reports in it
+    import httpx
+
+    try:
+        tokens = _used_tokens(httpx.Response(response.status_code, headers=response.headers, content=raw))
+    except httpx.DecodingError:
+        tokens = None
+    buffered = httpx.Response(
+        response.status_code, headers=response.headers, stream=httpx.ByteStream(raw),
+        request=request, extensions=response.extensions,
+    )
+    return buffered, tokens
+
+
+def limited_http_client():
+    # httpx client for openai.OpenAI(http_client=...), with openai's defaults and the limiter
+    import httpx
+    import openai
+
+    return openai.DefaultHttpxClient(transport=LimitedTransport(httpx.HTTPTransport(limits=openai.DEFAULT_CONNECTION_LIMITS)))
+
+
+def limited_async_http_client():
+    # httpx client for openai.AsyncOpenAI(http_client=...), with openai's defaults and the limiter
+    import httpx
+    import openai
+
+    return openai.DefaultAsyncHttpxClient(
+        transport=LimitedTransport(httpx.AsyncHTTPTransport(limits=openai.DEFAULT_CONNECTION_LIMITS))
+    )
+
+
+def run_concurrently(items, work, max_concurrency):
+    # Call work(item) for every item with up to max_concurrency running at once. A failing item
+    # does not stop the others: returns (item, result, error) per item, in order, with either the
+    # result or the exception. Each call runs in a copy of the caller's context.
+    def call(item):
+        try:
+            return item, work(item), None
+        except Exception as e:
+            logging.error(f"Concurrent work failed for {item}: {e}")
+            return item, None, e
+
+    items = list(items)
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(items)))) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, call, item) for item in items]
+        return [future.result() for future in futures]
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_llm_limiter():
+    # Process-wide limiter configured from the environment:
+    #   LLM_MAX_CONCURRENCY     model requests in flight at once
+    #   LLM_TOKENS_PER_MINUTE   prompt and completion tokens per minute, unlimited when unset
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            tokens_per_minute = os.getenv("LLM_TOKENS_PER_MINUTE")
+            _limiter = LLMLimiter(
+                max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY)),
+                tokens_per_minute=float(tokens_per_minute) if tokens_per_minute else None,
+            )
+        return _limiter
+
+
+def configure_llm_limiter(max_concurrency=None, tokens_per_minute=None):
+    # Replace the process-wide limiter, e.g. with a worker process's share of a rate limit
+    global _limiter
+    limiter = LLMLimiter(
+        max_concurrency=max_concurrency or int(os.getenv("LLM_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY)),
+        tokens_per_minute=tokens_per_minute,
+    )
+    get_llm_limiter()
+    with _limiter_lock:
+        _limiter = limiter
+    return limiter
+
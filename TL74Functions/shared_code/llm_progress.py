@@ -0,0 +1,92 @@
+import os
+import time
+import logging
+import threading
+
+from azure.cosmos.exceptions import CosmosHttpResponseError, CosmosResourceNotFoundError
+
+# The model completions of an LLM analysis are patched, as soon as each one is received, into an
+# "{accession_code}::llm_progress" document next to the filing. A run cut short by the function
+# timeout leaves them behind, and the next run of the filing, on any worker, replays them instead of
+# querying the model again. The document is deleted once the analysis is stored.
+#
+# LLM_WRITE_MODE selects the behavior:
+#   "incremental"  (default) record completions as they finish and resume from them
+#   "final"        only write the finished analysis
+WRITE_MODE_INCREMENTAL = "incremental"
+WRITE_MODE_FINAL = "final"
+
+
+def get_write_mode():
+    return os.getenv("LLM_WRITE_MODE", WRITE_MODE_INCREMENTAL).lower()
+
+
+def progress_id(accession_code):
+    return f"{accession_code}::llm_progress"
+
+
+class LLMProgress:
+    def __init__(self, container, accession_code, ticker, completions=None):
+        self.container = container
+        self.accession_code = accession_code
+        self.ticker = ticker
+        self.completions = dict(completions or {})
+        self.stats = {"resumed": 0, "recorded": 0}
+        self._recording = True
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, container, accession_code, ticker):
+        # The progress of an earlier, unfinished run of the filing, or a new empty record
+        try:
+            document = container.read_item(item=progress_id(accession_code), partition_key=ticker)
+        except CosmosResourceNotFoundError:
+            document = container.upsert_item({
+                "id": progress_id(accession_code),
+                "doc_type": "llm_progress",
+                "accession_code": accession_code,
+                "ticker": ticker,
+                "started_at": time.time(),
+                "completions": {},
+            })
+        progress = cls(container, accession_code, ticker, document.get("completions"))
+        if progress.completions:
+            logging.info(f"Resuming the LLM analysis of {accession_code} with {len(progress.completions)} stored completion(s)")
+        return progress
+
+    def get(self, key):
+        with self._lock:
+            stored = self.completions.get(key)
+            if stored is not None:
+                self.stats["resumed"] += 1
+        return stored
+
+    def record(self, key, response):
+        # Patch one completion into the progress document, without reading or replacing it
+        with self._lock:
+            if not self._recording or key in self.completions:
+                return
+        try:
+            self.container.patch_item(
+                item=progress_id(self.accession_code),
+                partition_key=self.ticker,
+                patch_operations=[
+                    {"op": "add", "path": f"/completions/{key}", "value": response},
+                    {"op": "set", "path": "/updated_at", "value": time.time()},
+                ],
+            )
+        except CosmosHttpResponseError as e:
+            # E.g. the document reached the item size limit: the analysis goes on without checkpoints
+            logging.warning(f"Stopped recording the LLM progress of {self.accession_code}: {e}")
+            with self._lock:
+                self._recording = False
+            return
+        with self._lock:
+            self.completions[key] = response
+            self.stats["recorded"] += 1
+
+    def clear(self):
+        try:
+            self.container.delete_item(item=progress_id(self.accession_code), partition_key=self.ticker)
+        except CosmosResourceNotFoundError:
+            pass
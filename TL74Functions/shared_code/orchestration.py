@@ -0,0 +1,309 @@
+import os
+import time
+import logging
+import contextvars
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import CosmosAccessConditionFailedError, CosmosResourceExistsError
+from shared_code.idempotency import COMPLETED, COMPLETED_STATUS_CODES, FAILED, IN_PROGRESS
+from shared_code.instrumentation import span
+
+# The analyses of a filing run as an orchestration, in the style of Durable Functions: a DAG of stages,
+# each an activity returning (response_message, status_code). Stages run in parallel as soon as the
+# stages they depend on are completed, and the outcome of every stage is checkpointed on the
+# orchestration document, "{accession_code}::orchestration" in the filings container. Running the
+# orchestration again (a redelivered queue message, a repeated request) replays the checkpoints:
+# completed stages are not run again, failed and interrupted ones are.
+#
+# A stage is retried with exponential backoff while its outcome is transient: an exception, a 5xx,
+# 408, 429 or 202 (the analysis is running elsewhere). Other 4xx outcomes fail the stage for good.
+# Stages depending on a failed stage stay pending.
+PENDING = "pending"
+
+TRANSIENT_STATUS_CODES = (202, 408, 429)
+
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_FIRST_RETRY_SECONDS = 5
+DEFAULT_MAX_RETRY_SECONDS = 60
+
+# Seconds an orchestration is leased to the run executing it. The run renews the lease with every
+# checkpoint and every LEASE_RENEWALS-th of the lease while stages run, so the lease stays well
+# below the function timeout (5 minutes by default) and a run that crashed or timed out is taken
+# over soon after.
+DEFAULT_LEASE_SECONDS = 120
+LEASE_RENEWALS = 4
+
+
+class Stage:
+    def __init__(self, name, activity, depends_on=()):
+        # activity(accession_code, ticker, date, form, force) -> (response_message, status_code)
+        self.name = name
+        self.activity = activity
+        self.depends_on = tuple(depends_on)
+
+
+class RetryOptions:
+    # Attempts at a stage within one run of the orchestration, and the backoff between them
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS, first_retry_seconds=DEFAULT_FIRST_RETRY_SECONDS,
+                 backoff_coefficient=2.0, max_retry_seconds=DEFAULT_MAX_RETRY_SECONDS):
+        self.max_attempts = max(1, max_attempts)
+        self.first_retry_seconds = first_retry_seconds
+        self.backoff_coefficient = backoff_coefficient
+        self.max_retry_seconds = max_retry_seconds
+
+    @classmethod
+    def from_environment(cls):
+        return cls(
+            max_attempts=int(os.getenv("ORCHESTRATION_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS)),
+            first_retry_seconds=float(os.getenv("ORCHESTRATION_RETRY_SECONDS", DEFAULT_FIRST_RETRY_SECONDS)),
+            max_retry_seconds=float(os.getenv("ORCHESTRATION_MAX_RETRY_SECONDS", DEFAULT_MAX_RETRY_SECONDS)),
+        )
+
+    def delay(self, attempt):
+        # Seconds to wait after the given failed attempt, counted from 1
+        return min(self.first_retry_seconds * self.backoff_coefficient ** (attempt - 1), self.max_retry_seconds)
+
+
+def is_transient(status_code):
+    return status_code >= 500 or status_code in TRANSIENT_STATUS_CODES
+
+
+def orchestration_id(accession_code):
+    return f"{accession_code}::orchestration"
+
+
+def validate_stages(stages):
+    # Stage names must be unique and the dependencies must name earlier stages, which rules out cycles
+    seen = set()
+    for stage in stages:
+        if stage.name in seen:
+            raise ValueError(f"Duplicate stage {stage.name}")
+        unknown = [name for name in stage.depends_on if name not in seen]
+        if unknown:
+            raise ValueError(f"Stage {stage.name} depends on {', '.join(unknown)}, which must be listed before it")
+        seen.add(stage.name)
+
+
+def new_orchestration(accession_code, ticker, date, form, stages, force=False):
+    now = time.time()
+    return {
+        "id": orchestration_id(accession_code),
+        "doc_type": "orchestration",
+        "accession_code": accession_code,
+        "ticker": ticker,
+        # Nested, so the document is not taken for the filing by queries on its form and date
+        "filing": {"date": date, "form": form},
+        "force": force,
+        "status": PENDING,
+        "created_at": now,
+        "updated_at": now,
+        "lease_expires_at": 0,
+        "stages": {
+            stage.name: {"status": PENDING, "attempts": 0, "depends_on": list(stage.depends_on)}
+            for stage in stages
+        },
+    }
+
+
+def start_orchestration(container, accession_code, ticker, date, form, stages, force=False):
+    # Create the orchestration of a filing, or return the existing one so its checkpoints are replayed.
+    # force starts over with every stage pending.
+    validate_stages(stages)
+    orchestration = new_orchestration(accession_code, ticker, date, form, stages, force)
+    if force:
+        return container.upsert_item(orchestration)
+    try:
+        return container.create_item(orchestration)
+    except CosmosResourceExistsError:
+        return container.read_item(item=orchestration["id"], partition_key=ticker)
+
+
+def claim_orchestration(container, orchestration):
+    # Lease the orchestration to the calling run. Returns the leased document, or None when another run
+    # holds a live lease or took it over first.
+    now = time.time()
+    if orchestration.get("status") == IN_PROGRESS and orchestration.get("lease_expires_at", 0) > now:
+        return None
+    body = {key: value for key, value in orchestration.items() if not key.startswith("_")}
+    body.update({"status": IN_PROGRESS, "updated_at": now, "lease_expires_at": now + _lease_seconds()})
+    try:
+        return container.replace_item(
+            item=body["id"], body=body, etag=orchestration.get("_etag"), match_condition=MatchConditions.IfNotModified
+        )
+    except CosmosAccessConditionFailedError:
+        return None
+
+
+def run_orchestration(container, orchestration, stages, retry=None, sleep=time.sleep):
+    # Run the stages of an orchestration that are not completed yet and checkpoint each outcome.
+    # Returns the orchestration as this run left it: completed, failed, or unchanged, and still in
+    # progress, when it was already completed or another run holds it.
+    if orchestration.get("status") == COMPLETED:
+        return orchestration
+    leased = claim_orchestration(container, orchestration)
+    if leased is None:
+        logging.info(f"Orchestration {orchestration['id']} is already running elsewhere.")
+        return orchestration
+
+    retry = retry or RetryOptions.from_environment()
+    checkpoints = dict(leased.get("stages") or {})
+    completed = {stage.name for stage in stages if checkpoints.get(stage.name, {}).get("status") == COMPLETED}
+    failed = set()
+
+    with span("orchestration.run", accession_code=leased["accession_code"], form=leased["filing"]["form"]) as current:
+        with ThreadPoolExecutor(max_workers=max(1, len(stages))) as executor:
+            running = {}
+
+            def schedule():
+                # Start every stage whose dependencies are completed, each in a copy of the context so
+                # its spans belong to the run
+                started = set(running.values())
+                for stage in stages:
+                    if stage.name in completed or stage.name in failed or stage.name in started:
+                        continue
+                    if all(name in completed for name in stage.depends_on):
+                        future = executor.submit(
+                            contextvars.copy_context().run, run_stage,
+                            container, leased, stage, checkpoints.get(stage.name, {}), retry, sleep,
+                        )
+                        running[future] = stage.name
+
+            try:
+                schedule()
+                while running:
+                    finished, _ = wait(running, timeout=_lease_seconds() / LEASE_RENEWALS, return_when=FIRST_COMPLETED)
+                    if not finished:
+                        renew_lease(container, leased)
+                    for future in finished:
+                        name = running.pop(future)
+                        checkpoints[name] = future.result()
+                        (completed if checkpoints[name]["status"] == COMPLETED else failed).add(name)
+                    schedule()
+            except Exception:
+                # A checkpoint could not be written: release the lease so the next run resumes at once
+                finish_orchestration(container, leased, FAILED)
+                raise
+
+        status = COMPLETED if len(completed) == len(stages) else FAILED
+        current.set(status=status, completed=len(completed), failed=len(failed))
+
+    return finish_orchestration(container, leased, status)
+
+
+def renew_lease(container, orchestration):
+    now = time.time()
+    container.patch_item(item=orchestration["id"], partition_key=orchestration["ticker"], patch_operations=[
+        {"op": "set", "path": "/updated_at", "value": now},
+        {"op": "set", "path": "/lease_expires_at", "value": now + _lease_seconds()},
+    ])
+
+
+def finish_orchestration(container, orchestration, status):
+    return container.patch_item(item=orchestration["id"], partition_key=orchestration["ticker"], patch_operations=[
+        {"op": "set", "path": "/status", "value": status},
+        {"op": "set", "path": "/updated_at", "value": time.time()},
+        {"op": "set", "path": "/lease_expires_at", "value": 0},
+    ])
+
+
+def run_stage(container, orchestration, stage, checkpoint, retry, sleep=time.sleep):
+    # Run one stage, retrying transient outcomes, and checkpoint its outcome. Returns the checkpoint.
+    accession_code = orchestration["accession_code"]
+    attempts = checkpoint.get("attempts", 0)
+    started_at = time.time()
+    save_checkpoint(container, orchestration, stage.name, dict(
+        checkpoint, status=IN_PROGRESS, depends_on=list(stage.depends_on), started_at=started_at
+    ))
+
+    for attempt in range(1, retry.max_attempts + 1):
+        attempts += 1
+        with span("orchestration.stage", stage=stage.name, attempt=attempts) as current:
+            try:
+                response_message, status_code = stage.activity(
+                    accession_code, orchestration["ticker"], orchestration["filing"]["date"], orchestration["filing"]["form"],
+                    orchestration.get("force", False),
+                )
+            except Exception as e:
+                logging.error(f"Stage {stage.name} of {accession_code} raised: {e}")
+                response_message, status_code = str(e), 500
+            current.set(status_code=status_code)
+
+        if status_code in COMPLETED_STATUS_CODES or not is_transient(status_code):
+            break
+        if attempt < retry.max_attempts:
+            delay = retry.delay(attempt)
+            logging.warning(f"Stage {stage.name} of {accession_code} returned {status_code}, retrying in {delay:g}s.")
+            sleep(delay)
+
+    checkpoint = {
+        "status": COMPLETED if status_code in COMPLETED_STATUS_CODES else FAILED,
+        "status_code": status_code,
+        "response_message": response_message,
+        "transient": is_transient(status_code),
+        "attempts": attempts,
+        "depends_on": list(stage.depends_on),
+        "started_at": started_at,
+        "completed_at": time.time(),
+    }
+    save_checkpoint(container, orchestration, stage.name, checkpoint)
+    logging.info(f"Stage {stage.name} of {accession_code} {checkpoint['status']} with status {status_code}.")
+    return checkpoint
+
+
+def save_checkpoint(container, orchestration, stage_name, checkpoint):
+    # A patch of the stage's own entry, so stages running in parallel never overwrite each other.
+    # Every checkpoint renews the lease of the run.
+    now = time.time()
+    container.patch_item(item=orchestration["id"], partition_key=orchestration["ticker"], patch_operations=[
+        {"op": "set", "path": f"/stages/{stage_name}", "value": checkpoint},
+        {"op": "set", "path": "/updated_at", "value": now},
+        {"op": "set", "path": "/lease_expires_at", "value": now + _lease_seconds()},
+    ])
+
+
+def running_elsewhere(orchestration):
+    # Whether another run held the orchestration when this one tried to run it
+    return orchestration.get("status") == IN_PROGRESS
+
+
+def failed_transiently(orchestration):
+    # Whether running the orchestration again may complete it
+    return any(
+        checkpoint.get("status") == FAILED and checkpoint.get("transient")
+        for checkpoint in (orchestration.get("stages") or {}).values()
+    )
+
+
+def orchestration_status_code(orchestration):
+    # 200 once every stage is completed, the status of the first failed stage after a failed run, and
+    # 202 while stages are still to run
+    if orchestration.get("status") == COMPLETED:
+        return 200
+    if orchestration.get("status") == FAILED:
+        for checkpoint in (orchestration.get("stages") or {}).values():
+            if checkpoint.get("status") == FAILED:
+                return checkpoint.get("status_code", 500)
+    return 202
+
+
+def orchestration_summary(orchestration):
+    return {
+        "instance_id": orchestration["id"],
+        "accession_code": orchestration["accession_code"],
+        "form": orchestration["filing"]["form"],
+        "status": orchestration.get("status"),
+        "stages": {
+            name: {
+                "status": checkpoint.get("status"),
+                "status_code": checkpoint.get("status_code"),
+                "message": checkpoint.get("response_message"),
+                "attempts": checkpoint.get("attempts", 0),
+            }
+            for name, checkpoint in (orchestration.get("stages") or {}).items()
+        },
+    }
+
+
+def _lease_seconds():
+    return float(os.getenv("ORCHESTRATION_LEASE_SECONDS", DEFAULT_LEASE_SECONDS))
@@ -0,0 +1,39 @@
+import time
+import threading
+
+
+class TokenBucket:
+    # Thread-safe token bucket: rate tokens per second, up to capacity at once. acquire() reserves
+    # tokens and sleeps until they are available, so waiting callers are served in order.
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1, rate))
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        # Returns the seconds waited
+        wait = self.reserve(amount)
+        if wait:
+            self._sleep(wait)
+        return wait
+
+    def reserve(self, amount=1):
+        # Take the tokens without waiting and return the seconds until they are available, for
+        # callers that wait on their own (e.g. with asyncio.sleep). A negative amount returns tokens.
+        with self._lock:
+            now = self._clock()
+            if now > self._updated:
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+            self._tokens = min(self.capacity, self._tokens - amount)
+            return max(0.0, self._updated + max(0.0, -self._tokens) / self.rate - now)
+
+    def pause(self, seconds):
+        # Hold back every caller for the given time, e.g. after the server throttled a request
+        with self._lock:
+            self._tokens = min(self._tokens, 0.0)
+            self._updated = max(self._updated, self._clock() + seconds)
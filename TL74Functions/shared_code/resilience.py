@@ -0,0 +1,98 @@
+import time
+import random
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+
+# Building blocks of the calls to services that may throttle, fail or hang: the server's Retry-After,
+# jittered exponential backoff, and a circuit breaker that fails calls fast while a service keeps failing.
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_SECONDS = 30.0
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, target, retry_in):
+        super().__init__(f"Circuit for {target} is open, retry in {retry_in:.1f}s")
+        self.target = target
+        self.retry_in = retry_in
+
+
+def retry_after(response):
+    # Seconds from a Retry-After header given as seconds or as an HTTP date, or None
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, base_seconds, max_seconds):
+    # "Full jitter" exponential backoff after the given failed attempt, counted from 1: a uniform delay
+    # up to base_seconds * 2 ** (attempt - 1), capped at max_seconds, so callers failing together do not
+    # retry together
+    return random.uniform(0.0, min(max_seconds, base_seconds * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    # Thread-safe circuit breaker of one target. failure_threshold consecutive failures open it, and
+    # calls are then rejected for reset_seconds. After that one trial call is let through (half open):
+    # its success closes the circuit, its failure opens it again.
+    def __init__(self, target, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_seconds=DEFAULT_RESET_SECONDS,
+                 clock=time.monotonic):
+        self.target = target
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.stats = {"opened": 0}
+        self._clock = clock
+        self._opened_at = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        # Raises CircuitOpenError when the call must not be made
+        with self._lock:
+            if self.state == OPEN:
+                retry_in = self._opened_at + self.reset_seconds - self._clock()
+                if retry_in > 0:
+                    raise CircuitOpenError(self.target, retry_in)
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN:
+                if self._trial:
+                    raise CircuitOpenError(self.target, 0.0)
+                self._trial = True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                logging.info(f"Circuit for {self.target} closed.")
+            self.state = CLOSED
+            self.failures = 0
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                logging.warning(f"Circuit for {self.target} opened after {self.failures} failures.")
+                self.state = OPEN
+                self._opened_at = self._clock()
+                self.stats["opened"] += 1
+
+    def release(self):
+        # The call ended without telling whether the target is healthy: let the next trial through
+        with self._lock:
+            self._trial = False
@@ -0,0 +1,328 @@
+import os
+import json
+import uuid
+import zlib
+import base64
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from azure.cosmos.exceptions import CosmosBatchOperationError
+from shared_code.cosmos import BatchPacker, MAX_BATCH_OPERATIONS
+from shared_code.filing_store import filing_update_operation
+
+# The holdings of a 13F filing are stored as "{accession_code}::chunk_{generation}_{i}" documents in
+# the filing's partition, each kept under the Cosmos DB item size limit. The filing's 13F analysis
+# entry lists the chunk ids in order. Every run writes a new generation of chunks, so the chunks the
+# entry points at are never overwritten.
+MAX_DOC_SIZE = 1.9 * 1024 * 1024
+
+# Encoding of the holdings in "13f_chunk", selected with THIRTEENF_CHUNK_FORMAT:
+#   "rows"      (default) a list of holding objects
+#   "columnar"  {"encoding": "columnar-zlib-v1", "length": n, "data": base64(zlib(JSON))}, where the
+#               JSON is {"columns": {key: [values]}, "dictionaries": {key: [distinct values]},
+#               "missing": {key: [rows without the key]}}. Columns holding only strings (issuers,
+#               CUSIPs, share types...) store integer codes into their dictionary (-1 for null).
+# Chunks written in either format are read back through decode_13f_chunk().
+CHUNK_FORMAT_ROWS = "rows"
+CHUNK_FORMAT_COLUMNAR = "columnar"
+COLUMNAR_ENCODING = "columnar-zlib-v1"
+
+# Marks holdings without a key while their columns are built
+_MISSING = object()
+
+# Batches of chunk documents written in parallel while the next chunk is filled
+DEFAULT_UPLOAD_CONCURRENCY = 4
+
+# Attempts at the final batch, which fails when the filing or its chunks changed since they were read
+FINAL_BATCH_ATTEMPTS = 3
+
+
+def new_chunk_generation():
+    return uuid.uuid4().hex[:8]
+
+
+def chunk_document(accession_code, ticker, generation, chunk_index, chunk):
+    return {
+        "id": f"{accession_code}::chunk_{generation}_{chunk_index}",
+        "doc_type": "13f_chunk",
+        "accession_code": accession_code,
+        "ticker": ticker,
+        "chunk_index": chunk_index,
+        "13f_chunk": chunk,
+    }
+
+
+def get_chunk_format():
+    return os.getenv("THIRTEENF_CHUNK_FORMAT", CHUNK_FORMAT_ROWS).lower()
+
+
+def iter_13f_chunks(accession_code, ticker, holdings, chunk_format=None, generation=None):
+    # Split the holdings (a list or any iterable) into chunk documents, yielding each one as soon as it is full
+    for document, _ in sized_13f_chunks(accession_code, ticker, holdings, chunk_format, generation):
+        yield document
+
+
+def sized_13f_chunks(accession_code, ticker, holdings, chunk_format=None, generation=None):
+    # Yields (chunk document, serialized size), of a new generation unless one is given
+    generation = generation or new_chunk_generation()
+    if (chunk_format or get_chunk_format()) == CHUNK_FORMAT_COLUMNAR:
+        return _columnar_chunks(accession_code, ticker, generation, holdings)
+    return _row_chunks(accession_code, ticker, generation, holdings)
+
+
+def _row_chunks(accession_code, ticker, generation, holdings):
+    # Every entry is serialized once, to measure it, and counted with the ", " that separates it
+    # from the next one.
+    envelope_size = len(json.dumps(chunk_document(accession_code, ticker, generation, 0, [])).encode("utf-8"))
+    chunk = []
+    chunk_size = envelope_size
+    chunk_index = 0
+
+    for entry in holdings:
+        entry_size = len(json.dumps(entry).encode("utf-8")) + 2
+
+        if chunk and chunk_size + entry_size > MAX_DOC_SIZE:
+            yield chunk_document(accession_code, ticker, generation, chunk_index, chunk), chunk_size
+            chunk = []
+            chunk_size = envelope_size
+            chunk_index += 1
+
+        chunk.append(entry)
+        chunk_size += entry_size
+
+    if chunk:
+        yield chunk_document(accession_code, ticker, generation, chunk_index, chunk), chunk_size
+
+
+def _columnar_chunks(accession_code, ticker, generation, holdings):
+    # The encoded size of a chunk is only known once it is compressed, so the chunk is encoded each
+    # time its raw size reaches the amount the compression ratio seen so far predicts will fit, and
+    # the largest encoding known to fit is stored once the next one is too big.
+    envelope_size = len(json.dumps(chunk_document(accession_code, ticker, generation, 0, None)).encode("utf-8"))
+    rows = []
+    row_sizes = []
+    raw_size = 0
+    check_at = MAX_DOC_SIZE
+    fitted = None
+    chunk_index = 0
+
+    def encode(count):
+        encoded = encode_13f_chunk(rows[:count])
+        return count, encoded, envelope_size + len(json.dumps(encoded))
+
+    def fitting_prefix():
+        # Halve the rows until they fit, for data that barely compresses
+        count = len(rows)
+        while count > 1:
+            count //= 2
+            candidate = encode(count)
+            if candidate[2] <= MAX_DOC_SIZE:
+                return candidate
+        return encode(1)
+
+    def emit(candidate):
+        nonlocal rows, row_sizes, raw_size, fitted, chunk_index
+        count, encoded, size = candidate
+        document = chunk_document(accession_code, ticker, generation, chunk_index, encoded), size
+        rows, row_sizes = rows[count:], row_sizes[count:]
+        raw_size = sum(row_sizes)
+        fitted = None
+        chunk_index += 1
+        return document
+
+    for entry in holdings:
+        entry_size = len(json.dumps(entry).encode("utf-8")) + 2
+        rows.append(entry)
+        row_sizes.append(entry_size)
+        raw_size += entry_size
+        if raw_size < check_at:
+            continue
+
+        candidate = encode(len(rows))
+        if candidate[2] <= MAX_DOC_SIZE:
+            fitted = candidate
+            chunk_raw_size = raw_size
+        else:
+            candidate = fitted or fitting_prefix()
+            chunk_raw_size = sum(row_sizes[:candidate[0]])
+            yield emit(candidate)
+        # Check again at 95% of the limit at the compression ratio just seen, and no sooner than 5%
+        # later, so a nearly full chunk is not encoded again after every holding
+        check_at = max(chunk_raw_size * MAX_DOC_SIZE / candidate[2] * 0.95, raw_size * 1.05)
+
+    while rows:
+        candidate = encode(len(rows))
+        if candidate[2] > MAX_DOC_SIZE:
+            candidate = fitted or fitting_prefix()
+        yield emit(candidate)
+
+
+def encode_13f_chunk(holdings):
+    columns = {}
+    dictionaries = {}
+    missing = {}
+    for key in dict.fromkeys(key for holding in holdings for key in holding):
+        column = [holding.get(key, _MISSING) for holding in holdings]
+        if _MISSING in column:
+            missing[key] = [position for position, value in enumerate(column) if value is _MISSING]
+            column = [None if value is _MISSING else value for value in column]
+
+        if all(value is None or isinstance(value, str) for value in column):
+            codes = {}
+            for value in column:
+                if value is not None:
+                    codes.setdefault(value, len(codes))
+            column = [codes[value] if value is not None else -1 for value in column]
+            dictionaries[key] = list(codes)
+        columns[key] = column
+
+    payload = json.dumps({"columns": columns, "dictionaries": dictionaries, "missing": missing}, separators=(",", ":"))
+    return {
+        "encoding": COLUMNAR_ENCODING,
+        "length": len(holdings),
+        "data": base64.b64encode(zlib.compress(payload.encode("utf-8"))).decode("ascii"),
+    }
+
+
+def is_columnar(chunk):
+    return isinstance(chunk, dict) and chunk.get("encoding") == COLUMNAR_ENCODING
+
+
+def decode_13f_chunk(chunk):
+    # Return the holdings of a stored "13f_chunk" as a list of objects regardless of how it was stored
+    if not is_columnar(chunk):
+        return chunk
+    payload = json.loads(zlib.decompress(base64.b64decode(chunk["data"])))
+    columns = payload["columns"]
+    dictionaries = payload.get("dictionaries", {})
+    missing = {key: set(positions) for key, positions in payload.get("missing", {}).items()}
+
+    holdings = []
+    for position in range(chunk["length"]):
+        holding = {}
+        for key, values in columns.items():
+            if position in missing.get(key, ()):
+                continue
+            value = values[position]
+            if key in dictionaries:
+                value = dictionaries[key][value] if value >= 0 else None
+            holding[key] = value
+        holdings.append(holding)
+    return holdings
+
+
+def read_13f_holdings(container, ticker, chunk_refs):
+    # Yield the holdings stored in the given chunks, in order, decoded from either format
+    for chunk_id in chunk_refs:
+        document = container.read_item(item=chunk_id, partition_key=ticker)
+        yield from decode_13f_chunk(document["13f_chunk"])
+
+
+def existing_13f_chunk_ids(container, accession_code, ticker):
+    return list(container.query_items(
+        "SELECT VALUE c.id FROM c WHERE c.accession_code = @accession_code AND STARTSWITH(c.id, @prefix)",
+        parameters=[
+            {"name": "@accession_code", "value": accession_code},
+            {"name": "@prefix", "value": f"{accession_code}::chunk_"},
+        ],
+        partition_key=ticker,
+    ))
+
+
+def thirteenf_analysis(chunk_refs):
+    # The 13F analysis entry of a filing
+    return {
+        "13f_chunks": chunk_refs,
+        "chunk_count": len(chunk_refs)
+    }
+
+
+def is_13f_analysis(analysis):
+    # Chunks of an earlier run are deleted when the new ones are stored, so the new 13F analysis entry
+    # supersedes an earlier one, which would only reference missing documents
+    return "13f_chunks" in analysis
+
+
+def stale_chunk_deletes(container, accession_code, ticker, chunk_refs):
+    # Delete operations for the chunks of earlier runs, including those of runs interrupted before
+    # their filing update
+    stale_ids = set(existing_13f_chunk_ids(container, accession_code, ticker)) - set(chunk_refs)
+    return [("delete", (chunk_id,)) for chunk_id in sorted(stale_ids)]
+
+
+def store_13f_holdings(container, filing, holdings):
+    # Store the holdings of a filing read from the container and point the filing at them.
+    #
+    # Chunks of a new generation are written in transactional batches while they are produced, with up
+    # to THIRTEENF_UPLOAD_CONCURRENCY batches in flight, next to the chunks the filing points at. The
+    # last batch holds the remaining chunks, the filing update and the deletes of the earlier
+    # generations, so the filing switches from its old chunks to the new ones atomically. An
+    # interrupted run leaves the filing on its old chunks and can simply be retried; the next run
+    # deletes the chunks it left behind. Stale chunks beyond one batch are deleted after the switch.
+    # Returns the chunk ids.
+    accession_code = filing["id"]
+    ticker = filing["ticker"]
+    concurrency = int(os.getenv("THIRTEENF_UPLOAD_CONCURRENCY", DEFAULT_UPLOAD_CONCURRENCY))
+    slots = threading.BoundedSemaphore(concurrency)
+    errors = []
+
+    def execute(operations):
+        try:
+            container.execute_item_batch(operations, partition_key=ticker)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            slots.release()
+
+    chunk_refs = []
+    packer = BatchPacker()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for document, size in sized_13f_chunks(accession_code, ticker, holdings):
+            chunk_refs.append(document["id"])
+            full = packer.add([("upsert", (document,))], size)
+            if full:
+                slots.acquire()
+                if errors:
+                    slots.release()
+                    break
+                executor.submit(contextvars.copy_context().run, execute, full)
+
+    if errors:
+        raise errors[0]
+
+    held_size = packer.size
+    held = packer.flush()
+    for attempt in range(FINAL_BATCH_ATTEMPTS):
+        deletes = stale_chunk_deletes(container, accession_code, ticker, chunk_refs)
+        # The entry is patched into the filing, so analyses appended concurrently are kept. Only the
+        # removal of an earlier entry requires the filing to be unchanged since it was read.
+        update = filing_update_operation(filing, [thirteenf_analysis(chunk_refs)], supersedes=is_13f_analysis)
+
+        # More stale chunks than fit in one batch are only possible after a much larger earlier run
+        final = [update] + deletes[:MAX_BATCH_OPERATIONS - 1]
+        remaining_deletes = deletes[MAX_BATCH_OPERATIONS - 1:]
+
+        batch = BatchPacker()
+        batch.add(held, held_size)
+        full = batch.add(final)
+        if full:
+            # The held chunks do not fit next to the filing update, write them on their own
+            container.execute_item_batch(full, partition_key=ticker)
+            held, held_size = [], 0
+
+        try:
+            container.execute_item_batch(batch.flush(), partition_key=ticker)
+            break
+        except CosmosBatchOperationError as e:
+            # 412: the filing changed since it was read, 404: a stale chunk is already gone
+            if e.status_code not in (404, 412) or attempt == FINAL_BATCH_ATTEMPTS - 1:
+                raise
+            logging.warning(f"Retrying the 13F update of {accession_code} after a concurrent change ({e.status_code})")
+            filing = container.read_item(item=accession_code, partition_key=ticker)
+
+    for start in range(0, len(remaining_deletes), MAX_BATCH_OPERATIONS):
+        container.execute_item_batch(remaining_deletes[start:start + MAX_BATCH_OPERATIONS], partition_key=ticker)
+
+    return chunk_refs
@@ -0,0 +1,197 @@
+import json
+import logging
+from datetime import date as Date
+
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+from shared_code.thirteenf_chunks import MAX_DOC_SIZE, decode_13f_chunk, encode_13f_chunk, read_13f_holdings
+
+# Quarter-over-quarter comparison of a filer's 13F holdings, stored as an "{accession_code}::diff"
+# document next to the filing's chunks. Positions are keyed by CUSIP and put/call, with the shares
+# and value of every holding row of the position summed.
+CATEGORIES = ("new", "closed", "increased", "decreased")
+
+# Only compare with the filer's 13F-HR filed at most this many days before, i.e. the previous quarter.
+# An older one means the previous quarter is missing, and comparing with it would be misleading.
+MAX_PREVIOUS_FILING_AGE_DAYS = 135
+
+# Holding keys of the extraction output, as named in the SEC information table or by edgartools
+CUSIP_KEYS = ("cusip", "Cusip", "CUSIP")
+ISSUER_KEYS = ("nameOfIssuer", "Issuer", "issuer")
+PUT_CALL_KEYS = ("putCall", "PutCall")
+SHARES_KEYS = ("sshPrnamt", "SharesPrnAmount", "shares", "Shares")
+VALUE_KEYS = ("value", "Value")
+
+
+class PositionIndex:
+    # Shares and value per position of one filing. track() indexes the holdings while they are
+    # streamed to storage, so the holdings are only read once.
+    def __init__(self):
+        self.positions = {}
+        self.unidentified = 0
+
+    def add(self, holding):
+        cusip = _lookup(holding, CUSIP_KEYS)
+        if not cusip:
+            self.unidentified += 1
+            return
+        key = (str(cusip).upper(), _lookup(holding, PUT_CALL_KEYS))
+        position = self.positions.get(key)
+        if position is None:
+            position = self.positions[key] = [_lookup(holding, ISSUER_KEYS), 0, 0]
+        position[1] += _number(_lookup(holding, SHARES_KEYS))
+        position[2] += _number(_lookup(holding, VALUE_KEYS))
+
+    def track(self, holdings):
+        for holding in holdings:
+            self.add(holding)
+            yield holding
+
+
+def diff_positions(previous, current):
+    # One pass over the current positions, looking each one up in the previous filing's index
+    diff = {category: [] for category in CATEGORIES}
+    unchanged = 0
+    remaining = dict(previous.positions)
+
+    for key, (issuer, shares, value) in current.positions.items():
+        before = remaining.pop(key, None)
+        if before is None:
+            diff["new"].append(_position_row(key, issuer, 0, shares, 0, value))
+            continue
+        if shares > before[1]:
+            category = "increased"
+        elif shares < before[1]:
+            category = "decreased"
+        else:
+            unchanged += 1
+            continue
+        diff[category].append(_position_row(key, issuer, before[1], shares, before[2], value))
+
+    for key, (issuer, shares, value) in remaining.items():
+        diff["closed"].append(_position_row(key, issuer, shares, 0, value, 0))
+
+    # Largest changes in value first
+    for rows in diff.values():
+        rows.sort(key=lambda row: abs(row["value"] - row["previous_value"]), reverse=True)
+
+    summary = {category: len(rows) for category, rows in diff.items()}
+    summary["unchanged"] = unchanged
+    return summary, diff
+
+
+def previous_13f_filing(container, filing):
+    # The filer's 13F-HR filed right before this one, or None when it is not the previous quarter's.
+    # Only filing entries have no doc_type: run records, progress, orchestration and diff documents
+    # share the partition and may copy the filing's form and date.
+    previous = list(container.query_items(
+        "SELECT TOP 1 * FROM c WHERE NOT IS_DEFINED(c.doc_type) AND c.form = @form AND c.date < @date "
+        "AND c.id != @id ORDER BY c.date DESC",
+        parameters=[
+            {"name": "@form", "value": filing.get("form", "13F-HR")},
+            {"name": "@date", "value": filing["date"]},
+            {"name": "@id", "value": filing["id"]},
+        ],
+        partition_key=filing["ticker"],
+    ))
+    if not previous:
+        return None
+    try:
+        age = (Date.fromisoformat(filing["date"][:10]) - Date.fromisoformat(previous[0]["date"][:10])).days
+    except (TypeError, ValueError):
+        return None
+    return previous[0] if age <= MAX_PREVIOUS_FILING_AGE_DAYS else None
+
+
+def chunk_refs_of(filing):
+    for analysis in filing.get("analyses", []):
+        if "13f_chunks" in analysis:
+            return analysis["13f_chunks"]
+    return None
+
+
+def store_13f_diff(container, filing, current):
+    # Compare the positions of a stored filing with the previous quarter's and store the diff.
+    # Returns the summary, or None when there is no previous quarter to compare with.
+    accession_code = filing["id"]
+    ticker = filing["ticker"]
+    previous_filing = previous_13f_filing(container, filing)
+    chunk_refs = chunk_refs_of(previous_filing) if previous_filing else None
+    if chunk_refs is None:
+        logging.info(f"No previous quarter 13F holdings to compare {accession_code} with")
+        return None
+
+    previous = PositionIndex()
+    for holding in read_13f_holdings(container, ticker, chunk_refs):
+        previous.add(holding)
+    summary, positions = diff_positions(previous, current)
+
+    document = {
+        "id": f"{accession_code}::diff",
+        "doc_type": "13f_diff",
+        "accession_code": accession_code,
+        "ticker": ticker,
+        "date": filing.get("date"),
+        "previous_accession_code": previous_filing["id"],
+        "previous_date": previous_filing.get("date"),
+        "summary": summary,
+        "positions": positions,
+    }
+    if len(json.dumps(document)) > MAX_DOC_SIZE:
+        # Large managers: store each category compressed, in the columnar chunk encoding
+        document["positions"] = {category: encode_13f_chunk(rows) for category, rows in positions.items()}
+        if len(json.dumps(document)) > MAX_DOC_SIZE:
+            logging.warning(f"13F diff of {accession_code} is too large to store its positions, storing the summary only")
+            document["positions"] = None
+
+    container.upsert_item(document)
+    logging.info(f"Stored 13F diff of {accession_code} against {previous_filing['id']}: {summary}")
+    return summary
+
+
+def read_13f_diff(container, ticker, accession_code):
+    # The stored diff of a filing with its positions decoded, or None when there is none
+    try:
+        document = container.read_item(item=f"{accession_code}::diff", partition_key=ticker)
+    except CosmosResourceNotFoundError:
+        return None
+    if document.get("positions"):
+        document["positions"] = {category: decode_13f_chunk(rows) for category, rows in document["positions"].items()}
+    return document
+
+
+def _position_row(key, issuer, previous_shares, shares, previous_value, value):
+    cusip, put_call = key
+    row = {
+        "cusip": cusip,
+        "issuer": issuer,
+        "previous_shares": previous_shares,
+        "shares": shares,
+        "previous_value": previous_value,
+        "value": value,
+    }
+    if put_call:
+        row["put_call"] = put_call
+    return row
+
+
+def _lookup(holding, keys):
+    # The value of the first of keys in the holding, also looking one level into nested objects
+    # such as the information table's "shrsOrPrnAmt"
+    for key in keys:
+        if key in holding:
+            return holding[key]
+    for value in holding.values():
+        if isinstance(value, dict):
+            for key in keys:
+                if key in value:
+                    return value[key]
+    return None
+
+
+def _number(value):
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return float(str(value).replace(",", "")) if value is not None else 0
+    except ValueError:
+        return 0
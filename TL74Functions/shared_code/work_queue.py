@@ -0,0 +1,273 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+
+# Queues between the EntryPoint and the analysis functions. Messages are JSON payloads with the
+# same fields as the HTTP requests: accession_code, ticker, date and form.
+FHA_QUEUE = "fha-requests"
+LLM_QUEUE = "llm-requests"
+THIRTEENF_QUEUE = "thirteenf-requests"
+
+# Filings whose analyses run as an orchestration, see shared_code/orchestration.py
+ORCHESTRATION_QUEUE = "analysis-orchestrations"
+
+# Messages that keep failing are moved to "<queue>-poison", the Azure Functions convention
+POISON_SUFFIX = "-poison"
+
+DEFAULT_VISIBILITY_TIMEOUT = 300
+DEFAULT_MAX_DEQUEUE_COUNT = 5
+
+
+class WorkMessage:
+    def __init__(self, id, body, dequeue_count=0, receipt=None):
+        self.id = id
+        self.body = body
+        self.dequeue_count = dequeue_count
+        self.receipt = receipt
+
+
+class WorkQueue(ABC):
+    # Interface shared by the queue backends
+    def __init__(self, name):
+        self.name = name
+
+    @abstractmethod
+    def send(self, body):
+        ...
+
+    @abstractmethod
+    def receive(self, max_messages=1, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT):
+        ...
+
+    @abstractmethod
+    def complete(self, message):
+        ...
+
+    @abstractmethod
+    def abandon(self, message):
+        # Make a received message visible again right away so it can be retried
+        ...
+
+    def dead_letter(self, message):
+        get_work_queue(self.name + POISON_SUFFIX).send(message.body)
+        self.complete(message)
+
+
+class AzureStorageWorkQueue(WorkQueue):
+    # Production backend: an Azure Storage queue, consumed by the queue-triggered functions
+    def __init__(self, name, connection_string):
+        super().__init__(name)
+        from azure.storage.queue import QueueClient, TextBase64EncodePolicy, TextBase64DecodePolicy
+
+        # Queue triggers expect base64-encoded messages by default
+        self.client = QueueClient.from_connection_string(
+            connection_string, name,
+            message_encode_policy=TextBase64EncodePolicy(),
+            message_decode_policy=TextBase64DecodePolicy(),
+        )
+        self._created = False
+
+    def send(self, body):
+        if not self._created:
+            from azure.core.exceptions import ResourceExistsError
+            try:
+                self.client.create_queue()
+            except ResourceExistsError:
+                pass
+            self._created = True
+        sent = self.client.send_message(json.dumps(body))
+        return sent.id
+
+    def receive(self, max_messages=1, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT):
+        messages = self.client.receive_messages(max_messages=max_messages, visibility_timeout=visibility_timeout)
+        return [
+            WorkMessage(message.id, json.loads(message.content), message.dequeue_count, message.pop_receipt)
+            for message in messages
+        ]
+
+    def complete(self, message):
+        self.client.delete_message(message.id, message.receipt)
+
+    def abandon(self, message):
+        self.client.update_message(message.id, message.receipt, visibility_timeout=0)
+
+
+class InMemoryWorkQueue(WorkQueue):
+    # In-process backend for tests and single-process local runs
+    def __init__(self, name):
+        super().__init__(name)
+        self._messages = deque()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def send(self, body):
+        message = WorkMessage(uuid.uuid4().hex, body)
+        with self._lock:
+            self._messages.append(message)
+        return message.id
+
+    def receive(self, max_messages=1, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT):
+        received = []
+        with self._lock:
+            while self._messages and len(received) < max_messages:
+                message = self._messages.popleft()
+                message.dequeue_count += 1
+                self._in_flight[message.id] = message
+                received.append(message)
+        return received
+
+    def complete(self, message):
+        with self._lock:
+            self._in_flight.pop(message.id, None)
+
+    def abandon(self, message):
+        with self._lock:
+            if self._in_flight.pop(message.id, None) is not None:
+                self._messages.append(message)
+
+    def __len__(self):
+        return len(self._messages) + len(self._in_flight)
+
+
+class SqliteWorkQueue(WorkQueue):
+    # Durable local backend, shared by every process that points at the same database file
+    def __init__(self, name, path):
+        super().__init__(name)
+        self.path = path
+        with closing(self._connect()) as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "id TEXT PRIMARY KEY, queue TEXT NOT NULL, body TEXT NOT NULL, "
+                "dequeue_count INTEGER NOT NULL DEFAULT 0, visible_at REAL NOT NULL, enqueued_at REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS messages_queue ON messages (queue, visible_at)")
+
+    def _connect(self):
+        # Autocommit: each statement commits on its own, so connections are only closed after use
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def send(self, body):
+        message_id = uuid.uuid4().hex
+        now = time.time()
+        with closing(self._connect()) as connection:
+            connection.execute(
+                "INSERT INTO messages (id, queue, body, visible_at, enqueued_at) VALUES (?, ?, ?, ?, ?)",
+                (message_id, self.name, json.dumps(body), now, now),
+            )
+        return message_id
+
+    def receive(self, max_messages=1, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT):
+        now = time.time()
+        with closing(self._connect()) as connection:
+            # Claim the messages and hide them for the visibility timeout in one write transaction
+            connection.execute("BEGIN IMMEDIATE")
+            rows = connection.execute(
+                "SELECT id, body, dequeue_count FROM messages WHERE queue = ? AND visible_at <= ? "
+                "ORDER BY enqueued_at LIMIT ?",
+                (self.name, now, max_messages),
+            ).fetchall()
+            connection.executemany(
+                "UPDATE messages SET dequeue_count = dequeue_count + 1, visible_at = ? WHERE id = ?",
+                [(now + visibility_timeout, row[0]) for row in rows],
+            )
+            connection.execute("COMMIT")
+        return [WorkMessage(row[0], json.loads(row[1]), row[2] + 1) for row in rows]
+
+    def complete(self, message):
+        with closing(self._connect()) as connection:
+            connection.execute("DELETE FROM messages WHERE id = ?", (message.id,))
+
+    def abandon(self, message):
+        with closing(self._connect()) as connection:
+            connection.execute("UPDATE messages SET visible_at = ? WHERE id = ?", (time.time(), message.id))
+
+    def __len__(self):
+        with closing(self._connect()) as connection:
+            return connection.execute("SELECT COUNT(*) FROM messages WHERE queue = ?", (self.name,)).fetchone()[0]
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def get_work_queue(name):
+    # Queue backend selected with WORK_QUEUE_BACKEND:
+    #   "azure"   (default) Azure Storage queues on the AzureWebJobsStorage account
+    #   "sqlite"  a local SQLite database at WORK_QUEUE_SQLITE_PATH
+    #   "memory"  in-process queues
+    with _queues_lock:
+        queue = _queues.get(name)
+        if queue is None:
+            backend = os.getenv("WORK_QUEUE_BACKEND", "azure").lower()
+            if backend == "memory":
+                queue = InMemoryWorkQueue(name)
+            elif backend == "sqlite":
+                queue = SqliteWorkQueue(name, os.getenv("WORK_QUEUE_SQLITE_PATH", "work_queue.sqlite3"))
+            else:
+                queue = AzureStorageWorkQueue(name, os.getenv("AzureWebJobsStorage"))
+            _queues[name] = queue
+        return queue
+
+
+def run_worker(queue, handler, concurrency=4, batch_size=16, max_dequeue_count=DEFAULT_MAX_DEQUEUE_COUNT,
+               visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT, stop_when_empty=True, poll_interval=1.0):
+    # Local consumer loop mirroring the queue trigger settings in host.json: receive up to batch_size
+    # messages, handle them with at most concurrency threads, complete the ones that succeed, retry
+    # failures and dead-letter messages that failed max_dequeue_count times.
+    # Returns counts of completed, retried and dead-lettered messages.
+    stats = {"completed": 0, "retried": 0, "dead_lettered": 0}
+
+    def process(message):
+        try:
+            handler(message.body)
+        except Exception as e:
+            if message.dequeue_count >= max_dequeue_count:
+                logging.error(f"Dead-lettering message {message.id} from {queue.name} after {message.dequeue_count} attempts: {e}")
+                queue.dead_letter(message)
+                return "dead_lettered"
+            logging.warning(f"Message {message.id} from {queue.name} failed (attempt {message.dequeue_count}), retrying: {e}")
+            queue.abandon(message)
+            return "retried"
+        queue.complete(message)
+        return "completed"
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            messages = queue.receive(max_messages=batch_size, visibility_timeout=visibility_timeout)
+            if not messages:
+                if stop_when_empty:
+                    break
+                time.sleep(poll_interval)
+                continue
+            for outcome in executor.map(process, messages):
+                stats[outcome] += 1
+
+    return stats
+
+
+def run_queued_analysis(payload, wrapper):
+    # Run an analysis wrapper for a queued payload through the same code path as its HTTP trigger.
+    # Server-side failures raise so the message is retried and eventually dead-lettered; client
+    # errors such as a missing filing are permanent and are only logged.
+    response_message, status_code = wrapper(payload_request(payload))
+
+    if status_code >= 500:
+        raise RuntimeError(f"Analysis failed with status {status_code}: {response_message}")
+    if status_code >= 400:
+        logging.error(f"Dropping queued analysis for {payload.get('accession_code')}: {status_code} {response_message}")
+    return response_message, status_code
+
+
+def payload_request(payload):
+    # The HTTP request an analysis function receives for a payload, to call its wrapper in-process
+    from azure.functions import HttpRequest
+
+    return HttpRequest(method="POST", url="/api/queue", body=json.dumps(payload).encode("utf-8"))
@@ -0,0 +1,108 @@
+"""
+Benchmark: per-metric boolean scans vs. the pre-built fact table used by fha().
+
+Builds a synthetic company-facts frame shaped like edgartools'
+Company(...).get_facts().to_pandas() output and times resolving every fact fha()
+needs for one accession number both ways.
+
+Usage: python benchmarks/bench_fact_index.py [--rows 500000] [--repeat 5]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "TL74Functions"))
+
+from FinancialHealth.fha import build_fact_table
+
+FHA_FACTS = [
+    "Assets", "StockholdersEquity", "Revenues", "NetIncomeLoss",
+    "NetCashProvidedByUsedInOperatingActivities", "NetCashProvidedByUsedInInvestingActivities",
+    "NetCashProvidedByUsedInFinancingActivities", "AssetsCurrent", "LiabilitiesCurrent",
+    "CashAndCashEquivalentsAtCarryingValue", "ShortTermInvestments", "AccountsReceivableNetCurrent",
+    "CostOfGoodsAndServicesSold", "OperatingIncomeLoss", "InterestAndDebtExpense", "GrossProfit",
+    "CostOfRevenue", "InventoryNet", "PropertyPlantAndEquipmentNet",
+]
+
+
+def make_company_facts(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    facts = FHA_FACTS + [f"SyntheticFact{i}" for i in range(400)]
+    accns = [f"0000320193-{yy:02d}-{n:06d}" for yy in range(10, 25) for n in range(1, 5)]
+    ends = pd.date_range("2010-01-01", periods=60, freq="QE").strftime("%Y-%m-%d")
+    company = pd.DataFrame({
+        "namespace": rng.choice(["us-gaap", "dei", "srt"], rows, p=[0.85, 0.1, 0.05]),
+        "fact": rng.choice(facts, rows),
+        "val": rng.integers(1, 10**11, rows),
+        "accn": rng.choice(accns, rows),
+        "start": rng.choice(ends, rows),
+        "end": rng.choice(ends, rows),
+        "fy": rng.integers(2010, 2025, rows),
+        "fp": rng.choice(["Q1", "Q2", "Q3", "FY"], rows),
+        "form": rng.choice(["10-K", "10-Q"], rows),
+        "filed": rng.choice(ends, rows),
+        "frame": None,
+    })
+    return company, accns[len(accns) // 2]
+
+
+def scan_lookup(company, accn):
+    # Lookup strategy fha() used before the fact index: one full-frame scan per fact
+    company = company.copy()
+    company['end'] = pd.to_datetime(company['end'])
+    company['timestamp'] = company['end'].astype('int64')
+    values = {}
+    for fact_name in FHA_FACTS:
+        try:
+            filtered_df = company[(company['namespace'] == 'us-gaap') & (company['accn'] == str(accn)) & (company['fact'] == str(fact_name))]
+            values[fact_name] = filtered_df.loc[filtered_df['timestamp'].idxmax()]['val']
+        except Exception:
+            values[fact_name] = "N/A"
+    return values
+
+
+def index_lookup(company, accn):
+    company_subset = company[(company['namespace'] == 'us-gaap') & (company['accn'] == str(accn))].copy()
+    company_subset['end'] = pd.to_datetime(company_subset['end'])
+    company_subset['timestamp'] = company_subset['end'].astype('int64')
+    facts = build_fact_table(company_subset).loc[str(accn)]
+    return {fact_name: facts.get(fact_name, "N/A") for fact_name in FHA_FACTS}
+
+
+def best_of(fn, repeat, *args):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=500_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    company, accn = make_company_facts(args.rows)
+    print(f"Synthetic facts frame: {len(company):,} rows, accession {accn}")
+
+    scan_time, scan_values = best_of(scan_lookup, args.repeat, company, accn)
+    index_time, index_values = best_of(index_lookup, args.repeat, company, accn)
+
+    mismatched = [name for name in FHA_FACTS if str(scan_values[name]) != str(index_values[name])]
+    if mismatched:
+        print(f"Value mismatch for: {mismatched}")
+        sys.exit(1)
+
+    print(f"Full-frame scans: {scan_time * 1000:8.1f} ms")
+    print(f"Fact table:       {index_time * 1000:8.1f} ms")
+    print(f"Speedup:          {scan_time / index_time:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+Benchmark: concurrent analyses stored on one filing by read-and-replace vs. patch.
+
+Runs many writers appending an analysis to the same filing document of an in-memory store
+that behaves like a Cosmos DB container (ETags, 412 on a stale conditional replace, 400 on a
+patch of a missing array), with a simulated network latency per request. Reports the analyses
+lost, requests sent, bytes written and elapsed time of:
+
+  read-replace   the former read_item + unconditional replace_item
+  etag-replace   read_item + replace_item conditioned on the ETag, retried on 412
+  patch          shared_code.filing_store.append_analysis (one add /analyses/- patch)
+  patch-missing  append_analysis on a filing without an "analyses" array, which falls back
+                 to the conditional replace
+
+Exits with an error when a mode other than read-replace loses an analysis.
+
+Usage: python benchmarks/bench_filing_writes.py [--writers 32] [--latency 0.005] [--analysis-kb 4]
+"""
+import argparse
+import copy
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosHttpResponseError,
+    CosmosResourceNotFoundError,
+)
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "TL74Functions"))
+
+from shared_code.filing_store import append_analysis
+
+ACCESSION_CODE = "0000320193-24-000123"
+TICKER = "AAPL"
+
+
+class FakeContainer:
+    # Single-partition document store with Cosmos DB's concurrency semantics. Every request
+    # sleeps for the latency before it is applied atomically, so writers interleave like they
+    # would against the service.
+    def __init__(self, latency):
+        self.latency = latency
+        self.documents = {}
+        self.stats = {"requests": 0, "bytes_written": 0, "conflicts": 0}
+        self._lock = threading.Lock()
+
+    def create_item(self, body):
+        with self._lock:
+            self._store(copy.deepcopy(body))
+
+    def read_item(self, item, partition_key):
+        self._request(0)
+        with self._lock:
+            return copy.deepcopy(self._get(item))
+
+    def replace_item(self, item, body, etag=None, match_condition=None):
+        self._request(len(json.dumps(body)))
+        with self._lock:
+            current = self._get(item)
+            if match_condition == MatchConditions.IfNotModified and current["_etag"] != etag:
+                self.stats["conflicts"] += 1
+                raise CosmosAccessConditionFailedError(status_code=412, message="Precondition failed")
+            return copy.deepcopy(self._store(copy.deepcopy(body)))
+
+    def patch_item(self, item, partition_key, patch_operations):
+        self._request(len(json.dumps(patch_operations)))
+        with self._lock:
+            document = copy.deepcopy(self._get(item))
+            for operation in patch_operations:
+                *parents, name = operation["path"].strip("/").split("/")
+                target = document
+                for parent in parents:
+                    if parent not in target:
+                        raise CosmosHttpResponseError(status_code=400, message=f"Missing path {operation['path']}")
+                    target = target[parent]
+                if operation["op"] == "add" and name == "-":
+                    target.append(operation["value"])
+                elif operation["op"] in ("add", "set"):
+                    target[name] = operation["value"]
+                else:
+                    raise CosmosHttpResponseError(status_code=400, message=f"Unsupported operation {operation['op']}")
+            return copy.deepcopy(self._store(document))
+
+    def _request(self, size):
+        time.sleep(self.latency)
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["bytes_written"] += size
+
+    def _get(self, item):
+        if item not in self.documents:
+            raise CosmosResourceNotFoundError(status_code=404, message="Not found")
+        return self.documents[item]
+
+    def _store(self, document):
+        document["_etag"] = uuid.uuid4().hex
+        self.documents[document["id"]] = document
+        return document
+
+
+def read_replace(container, analysis):
+    filing = container.read_item(item=ACCESSION_CODE, partition_key=TICKER)
+    filing.setdefault("analyses", []).append(analysis)
+    container.replace_item(item=ACCESSION_CODE, body=filing)
+
+
+def etag_replace(container, analysis):
+    while True:
+        filing = container.read_item(item=ACCESSION_CODE, partition_key=TICKER)
+        etag = filing.pop("_etag")
+        filing.setdefault("analyses", []).append(analysis)
+        try:
+            container.replace_item(item=ACCESSION_CODE, body=filing, etag=etag, match_condition=MatchConditions.IfNotModified)
+            return
+        except CosmosAccessConditionFailedError:
+            pass
+
+
+def patch(container, analysis):
+    append_analysis(container, ACCESSION_CODE, TICKER, analysis, {"fiscal_year": 2024})
+
+
+MODES = [
+    ("read-replace", read_replace, True),
+    ("etag-replace", etag_replace, True),
+    ("patch", patch, True),
+    ("patch-missing", patch, False),
+]
+
+
+def run(mode, write, with_array, args):
+    container = FakeContainer(args.latency)
+    filing = {"id": ACCESSION_CODE, "ticker": TICKER, "form": "10-Q", "date": "2024-08-02"}
+    if with_array:
+        filing["analyses"] = []
+    container.create_item(filing)
+
+    payload = "x" * (args.analysis_kb * 1024)
+    analyses = [{"writer": writer, "payload": payload} for writer in range(args.writers)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.writers) as executor:
+        list(executor.map(lambda analysis: write(container, analysis), analyses))
+    elapsed = time.perf_counter() - start
+
+    stored = {analysis["writer"] for analysis in container.documents[ACCESSION_CODE].get("analyses", [])}
+    lost = args.writers - len(stored)
+    stats = container.stats
+    print(f"{mode:14} lost {lost:4d}  requests {stats['requests']:5d}  conflicts {stats['conflicts']:5d}  "
+          f"written {stats['bytes_written'] / 1024:10.1f} KB  {elapsed * 1000:8.1f} ms")
+    return lost
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--writers", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds per simulated request")
+    parser.add_argument("--analysis-kb", type=int, default=4, help="size of each analysis")
+    args = parser.parse_args()
+
+    # The fallback's warnings would drown the results
+    logging.disable(logging.WARNING)
+    print(f"{args.writers} concurrent writers, {args.latency * 1000:.1f} ms per request, {args.analysis_kb} KB analyses")
+    failed = []
+    for mode, write, with_array in MODES:
+        lost = run(mode, write, with_array, args)
+        if lost and write is not read_replace:
+            failed.append(mode)
+
+    if failed:
+        print(f"Analyses lost by: {failed}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,506 @@
+"""
+Benchmark: the functions end to end, offline, against recorded fixtures and a baseline.
+
+Drives fha_wrapper, initialize_13f_workflow, initialize_llm_workflow and process_filing_request with
+HttpRequest objects, the way their HTTP triggers do. EDGAR, the 13F extractor and the model endpoint
+are replayed from a fixture (see offline/replay.py) and Cosmos DB is an in-memory container seeded
+with the fixture's filings before every invocation, so no network access is needed and every run
+does the same work.
+
+Scenarios:
+  fha        financial health analysis of the latest 10-K/10-Q of the fixture's company
+  fha-batch  batch financial health analysis of all of the company's filings
+  13f        13F holdings of the latest 13F-HR, compared with the previous quarter's
+  llm        LLM analysis of the filing the fixture holds model exchanges for
+  entry      entry point request for the latest 10-Q, dispatched through in-memory work queues
+
+Each invocation is recorded as a span, as are its stages (shared_code/instrumentation.py), and the
+report gives their latency percentiles, calls, payload and request units per invocation, throughput
+and the peak memory allocated, measured with tracemalloc in separate invocations since tracing slows
+them down. With a baseline, the run fails when a stage is called more often per invocation, or its
+payload or request units grew by more than the tolerance, or the allocations of a scenario or stage
+grew by more than the tolerance and --min-delta-kib, and still did when the scenario was measured
+again. These do not depend on the machine or its load. Latencies and throughput are reported, and
+only gated with --gate-latency, relative to a CPU calibration run so a slower machine does not fail
+the run.
+
+Usage:
+  python benchmarks/bench_functions.py [--scenario fha] [--iterations 20] [--fixture sample]
+  python benchmarks/bench_functions.py --gate-latency --iterations 100
+  python benchmarks/bench_functions.py --update-baseline
+  python benchmarks/bench_functions.py --record NAME --filing ACCESSION,TICKER,DATE,FORM [--filing ...]
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "TL74Functions"))
+
+from azure.functions import HttpRequest
+
+from offline.fake_cosmos import FakeContainer, FakeCosmosClient
+from offline.fixtures import load_fixture, save_fixture
+from offline.replay import Recorder, Replay, replay_environment
+from shared_code import instrumentation
+from shared_code.cosmos import set_cosmos_client
+from shared_code.instrumentation import InMemoryExporter, set_exporters, span
+from shared_code.work_queue import FHA_QUEUE, LLM_QUEUE, THIRTEENF_QUEUE, get_work_queue
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# Allowed growth over the baseline, relative, and absolute below which differences are noise
+DEFAULT_TOLERANCE = 0.3
+DEFAULT_MIN_DELTA_MS = 5.0
+DEFAULT_MIN_DELTA_KIB = 256
+
+# Settings a baseline is only comparable under
+BASELINE_SETTINGS = ("fixture", "warm_caches", "latency_scale", "cosmos_latency")
+
+COMPANY_FORMS = ("10-K", "10-Q")
+
+
+def scenarios(fixture):
+    # {name: (function, request body)} of the scenarios the fixture has data for
+    from EntryPoint.helpers import process_filing_request
+    from FinancialHealth.fha_wrapper import fha_wrapper
+    from LLMAnalysis.llm_analy_wrapper import initialize_llm_workflow
+    from ThirteenF.wrapper_13f import initialize_13f_workflow
+
+    filings = fixture["filings"]
+    company = [filing for filing in filings if filing["form"] in COMPANY_FORMS]
+    thirteenf = [filing for filing in filings if filing["form"] == "13F-HR" and filing["accession_code"] in fixture.get("holdings", {})]
+    analyzed = [filing for filing in filings if filing["accession_code"] in fixture.get("llm", {})]
+
+    found = {}
+    if company:
+        latest = max(company, key=lambda filing: filing["date"])
+        found["fha"] = (fha_wrapper, _body(latest))
+        found["fha-batch"] = (fha_wrapper, {
+            "accession_codes": [filing["accession_code"] for filing in company if filing["ticker"] == latest["ticker"]],
+            "ticker": latest["ticker"],
+        })
+    if thirteenf:
+        found["13f"] = (initialize_13f_workflow, _body(max(thirteenf, key=lambda filing: filing["date"])))
+    if analyzed:
+        found["llm"] = (initialize_llm_workflow, _body(analyzed[0]))
+    quarterly = [filing for filing in company if filing["form"] == "10-Q"]
+    if quarterly:
+        found["entry"] = (process_filing_request, _body(max(quarterly, key=lambda filing: filing["date"])))
+    return found
+
+
+def _body(filing):
+    return {key: filing[key] for key in ("accession_code", "ticker", "date", "form")}
+
+
+def http_request(name, body):
+    return HttpRequest(method="POST", url=f"/api/{name}", body=json.dumps(body).encode("utf-8"),
+                       headers={"Content-Type": "application/json"})
+
+
+def seed_documents(fixture, latency):
+    # Documents every invocation starts from: an entry per filing, and the 13F holdings of all but the
+    # latest 13F-HR of each filer, to compare the latest one with
+    from EntryPoint.helpers import add_filing_entry
+    from ThirteenF.wrapper_13f import initialize_13f_workflow
+
+    container = FakeContainer(latency=latency)
+    set_cosmos_client(FakeCosmosClient(container))
+    for filing in fixture["filings"]:
+        add_filing_entry(filing["accession_code"], filing["ticker"], filing["date"], filing["form"])
+
+    thirteenf = sorted(
+        (filing for filing in fixture["filings"] if filing["accession_code"] in fixture.get("holdings", {})),
+        key=lambda filing: filing["date"],
+    )
+    latest = {filing["ticker"]: filing for filing in thirteenf}
+    for filing in thirteenf:
+        if filing is not latest[filing["ticker"]]:
+            message, status_code = initialize_13f_workflow(http_request("ThirteenF", _body(filing)))
+            if status_code != 200:
+                raise RuntimeError(f"Seeding the 13F holdings of {filing['accession_code']} failed: {status_code} {message}")
+    return container.snapshot()
+
+
+class AllocationSpan(instrumentation.Span):
+    # Span recording the peak memory traced by tracemalloc while it runs, above the memory traced when
+    # it started. tracemalloc keeps a single peak, so it is reset when a span starts and the peak seen
+    # so far is handed to the enclosing span. Spans running concurrently in other threads add to it.
+    _stacks = threading.local()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        stack = self._stack()
+        current, peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1].peak_traced = max(stack[-1].peak_traced, peak)
+        self.start_traced = current
+        self.peak_traced = current
+        tracemalloc.reset_peak()
+        stack.append(self)
+
+    def end(self, error=None):
+        if self.duration is None:
+            stack = self._stack()
+            self.peak_traced = max(self.peak_traced, tracemalloc.get_traced_memory()[1])
+            if self in stack:
+                stack.remove(self)
+            if stack:
+                stack[-1].peak_traced = max(stack[-1].peak_traced, self.peak_traced)
+            tracemalloc.reset_peak()
+            self.set(alloc_kib=round((self.peak_traced - self.start_traced) / 1024, 1))
+        super().end(error)
+
+    def _stack(self):
+        if not hasattr(self._stacks, "spans"):
+            self._stacks.spans = []
+        return self._stacks.spans
+
+
+class Runner:
+    def __init__(self, fixture, args):
+        self.fixture = fixture
+        self.args = args
+        self.exporter = InMemoryExporter()
+        set_exporters([self.exporter])
+        self.documents = seed_documents(fixture, args.cosmos_latency)
+
+    def run(self, name, function, body, iterations):
+        # Root spans of the invocations, with their stage spans as {trace_id: [spans]}
+        roots = []
+        stages = defaultdict(list)
+        for _ in range(iterations):
+            self.reset()
+            self.exporter.clear()
+            with span(f"bench.{name}") as root:
+                response_message, status_code = function(http_request(name, body))
+                root.set(status_code=status_code)
+            if status_code >= 400:
+                raise RuntimeError(f"{name} failed with status {status_code}: {response_message}")
+            roots.append(root)
+            stages[root.trace_id] = [recorded for recorded in self.exporter.spans if recorded is not root]
+        return roots, stages
+
+    def measure(self, name, function, body):
+        # Warm-up invocations import the function's dependencies and fill the process caches
+        self.run(name, function, body, self.args.warmup)
+        calibration = calibrate()
+        roots, stages = self.run(name, function, body, self.args.iterations)
+        calibration = (calibration + calibrate()) / 2
+
+        previous_span = instrumentation.Span
+        instrumentation.Span = AllocationSpan
+        tracemalloc.start()
+        try:
+            allocation_roots, allocation_stages = self.run(name, function, body, self.args.alloc_iterations)
+        finally:
+            tracemalloc.stop()
+            instrumentation.Span = previous_span
+
+        summary = summarize(roots, stages, allocation_roots, allocation_stages)
+        summary["calibration_ms"] = round(calibration, 3)
+        return summary
+
+    def reset(self):
+        # Every invocation starts from the seeded documents and empty queues
+        set_cosmos_client(FakeCosmosClient(FakeContainer(self.documents, latency=self.args.cosmos_latency)))
+        for queue_name in (FHA_QUEUE, LLM_QUEUE, THIRTEENF_QUEUE):
+            queue = get_work_queue(queue_name)
+            for message in queue.receive(max_messages=len(queue)):
+                queue.complete(message)
+
+
+def calibrate(repeat=7):
+    # Milliseconds a fixed CPU-bound workload takes, the median of repeat runs. Baseline latencies are
+    # scaled by the ratio of the calibrations, so a machine or a moment that is slower overall is not
+    # taken for a regression.
+    document = {"rows": [{"id": index, "name": f"row {index}", "values": list(range(index % 50))} for index in range(2000)]}
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        rows = json.loads(json.dumps(document))["rows"]
+        sorted(rows, key=lambda row: (len(row["values"]), row["name"]))
+        timings.append((time.perf_counter() - started) * 1000)
+    return round(percentile(timings, 0.5), 3)
+
+
+def percentile(values, fraction):
+    # Linear interpolation between the closest ranks
+    values = sorted(values)
+    if not values:
+        return 0.0
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(roots, stages, allocation_roots, allocation_stages):
+    latencies = [root.duration * 1000 for root in roots]
+    total_seconds = sum(root.duration for root in roots)
+    summary = {
+        "invocations": len(roots),
+        "latency_ms": {name: round(percentile(latencies, fraction), 3) for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))},
+        "throughput_per_s": round(len(roots) / total_seconds, 3) if total_seconds else 0.0,
+        "alloc_kib": round(percentile([root.attributes["alloc_kib"] for root in allocation_roots], 0.5), 1),
+        "stages": {},
+    }
+
+    calls = defaultdict(list)
+    for spans in stages.values():
+        for recorded in spans:
+            calls[recorded.name].append(recorded)
+    allocations = defaultdict(list)
+    for spans in allocation_stages.values():
+        for recorded in spans:
+            allocations[recorded.name].append(recorded.attributes.get("alloc_kib", 0.0))
+
+    for name in sorted(calls):
+        durations = [recorded.duration * 1000 for recorded in calls[name]]
+        summary["stages"][name] = {
+            "calls": round(len(durations) / len(roots), 2),
+            "p50_ms": round(percentile(durations, 0.5), 3),
+            "p95_ms": round(percentile(durations, 0.95), 3),
+            "p99_ms": round(percentile(durations, 0.99), 3),
+            "kib": round(sum(recorded.payload_bytes for recorded in calls[name]) / len(roots) / 1024, 1),
+            "ru": round(sum(recorded.request_charge for recorded in calls[name]) / len(roots), 2),
+            "alloc_kib": round(percentile(allocations[name], 0.5), 1),
+        }
+    return summary
+
+
+def report(name, summary):
+    latency = summary["latency_ms"]
+    print(f"{name:10} {summary['invocations']:4d} runs  p50 {latency['p50']:9.2f} ms  p95 {latency['p95']:9.2f} ms  "
+          f"p99 {latency['p99']:9.2f} ms  {summary['throughput_per_s']:8.2f}/s  alloc {summary['alloc_kib']:9.1f} KiB")
+    print(f"    {'stage':28} {'calls':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'KiB':>9} {'RU':>8} {'alloc KiB':>10}")
+    for stage, stats in summary["stages"].items():
+        print(f"    {stage:28} {stats['calls']:6.1f} {stats['p50_ms']:9.2f} {stats['p95_ms']:9.2f} "
+              f"{stats['p99_ms']:9.2f} {stats['kib']:9.1f} {stats['ru']:8.1f} {stats['alloc_kib']:10.1f}")
+
+
+def compare(results, baseline, tolerance, min_delta_ms, min_delta_kib, gate_latency=False):
+    # Regressions of results against the baseline, as {scenario: [messages]}. Calls, payload and
+    # request units are the same on every run, allocations nearly so. Latencies and throughput vary
+    # with the machine's load, so they are only compared with gate_latency, after scaling the baseline
+    # by the calibration of the measurements.
+    def grew(current, before, min_delta, allowed=tolerance):
+        return current > before * (1 + allowed) and current - before > min_delta
+
+    regressions = {}
+    for name, summary in results.items():
+        before = baseline.get(name)
+        if before is None:
+            print(f"{name}: not in the baseline")
+            continue
+        before = scaled(before, summary["calibration_ms"] / before["calibration_ms"])
+        found = []
+        if gate_latency:
+            # The tail of a few dozen invocations is noisier, so p95 is allowed twice the tolerance
+            for key, allowed in (("p50", tolerance), ("p95", 2 * tolerance)):
+                if grew(summary["latency_ms"][key], before["latency_ms"][key], min_delta_ms, allowed):
+                    found.append(f"{name} {key} {before['latency_ms'][key]:.2f} -> {summary['latency_ms'][key]:.2f} ms")
+            if summary["throughput_per_s"] * (1 + tolerance) < before["throughput_per_s"] and grew(
+                summary["latency_ms"]["p50"], before["latency_ms"]["p50"], min_delta_ms
+            ):
+                found.append(f"{name} throughput {before['throughput_per_s']:.2f} -> {summary['throughput_per_s']:.2f}/s")
+        if grew(summary["alloc_kib"], before["alloc_kib"], min_delta_kib):
+            found.append(f"{name} alloc {before['alloc_kib']:.1f} -> {summary['alloc_kib']:.1f} KiB")
+
+        for stage, stats in summary["stages"].items():
+            stage_before = before["stages"].get(stage)
+            if stage_before is None:
+                print(f"{name}: new stage {stage}")
+                continue
+            if stats["calls"] > stage_before["calls"]:
+                found.append(f"{name} {stage} calls {stage_before['calls']:.2f} -> {stats['calls']:.2f}")
+            for key, unit in (("kib", "KiB"), ("ru", "RU")):
+                if grew(stats.get(key, 0.0), stage_before.get(key, 0.0), 0.0):
+                    found.append(f"{name} {stage} {key} {stage_before.get(key, 0.0):.1f} -> {stats.get(key, 0.0):.1f} {unit}")
+            if gate_latency and grew(stats["p50_ms"], stage_before["p50_ms"], min_delta_ms):
+                found.append(f"{name} {stage} p50 {stage_before['p50_ms']:.2f} -> {stats['p50_ms']:.2f} ms")
+            if grew(stats["alloc_kib"], stage_before["alloc_kib"], min_delta_kib):
+                found.append(f"{name} {stage} alloc {stage_before['alloc_kib']:.1f} -> {stats['alloc_kib']:.1f} KiB")
+        for stage in before["stages"]:
+            if stage not in summary["stages"]:
+                print(f"{name}: stage {stage} no longer runs")
+        if found:
+            regressions[name] = found
+    return regressions
+
+
+def scaled(summary, factor):
+    # Copy of a summary with its latencies multiplied and its throughput divided by factor
+    summary = json.loads(json.dumps(summary))
+    summary["latency_ms"] = {key: value * factor for key, value in summary["latency_ms"].items()}
+    summary["throughput_per_s"] /= factor
+    for stats in summary["stages"].values():
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            stats[key] *= factor
+    return summary
+
+
+def settings(args):
+    return {
+        "fixture": args.fixture, "warm_caches": args.warm_caches,
+        "latency_scale": args.latency_scale, "cosmos_latency": args.cosmos_latency,
+    }
+
+
+def load_baseline(args):
+    # The baseline scenarios to compare with, or None when there is no baseline
+    if args.update_baseline or not os.path.exists(args.baseline):
+        return None
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    mismatched = [key for key in BASELINE_SETTINGS if baseline.get("settings", {}).get(key) != settings(args)[key]]
+    if mismatched:
+        sys.exit(f"The baseline was recorded with other settings ({', '.join(mismatched)}): {baseline.get('settings')}")
+    return baseline["scenarios"]
+
+
+def benchmark(args, baseline):
+    # Results of the scenarios, and their regressions against the baseline. A scenario that regressed
+    # is measured again, up to args.retries times, and only reported when it regresses every time.
+    fixture = load_fixture(args.fixture)
+    Replay(fixture, args.latency_scale).install()
+    runner = Runner(fixture, args)
+
+    available = scenarios(fixture)
+    names = args.scenario or list(available)
+    missing = [name for name in names if name not in available]
+    if missing:
+        sys.exit(f"The fixture has no data for scenario(s) {missing}")
+
+    results = {}
+    regressions = {}
+    for name in names:
+        function, body = available[name]
+        for attempt in range(1 + (args.retries if baseline else 0)):
+            if attempt:
+                print(f"{name} regressed ({len(regressions[name])} metric(s)), measuring it again")
+            results[name] = runner.measure(name, function, body)
+            report(name, results[name])
+            regressions.pop(name, None)
+            if baseline:
+                regressions.update(compare(
+                    {name: results[name]}, baseline, args.tolerance, args.min_delta_ms, args.min_delta_kib, args.gate_latency
+                ))
+            if name not in regressions:
+                break
+    return results, regressions
+
+
+def record(args):
+    # Run the functions for the given filings against the live services and save what they received
+    from EntryPoint.helpers import add_filing_entry
+    from FinancialHealth.fha_wrapper import fha_wrapper
+    from LLMAnalysis.llm_analy_wrapper import initialize_llm_workflow
+    from ThirteenF.wrapper_13f import initialize_13f_workflow
+
+    os.environ.update({"LLM_WRITE_MODE": "final", "FILING_CACHE_MAX_BYTES": "0", "LLM_CACHE_MAX_BYTES": "0"})
+    recorder = Recorder()
+    recorder.install()
+    set_cosmos_client(FakeCosmosClient())
+
+    for filing in args.filing:
+        accession_code, ticker, date, form = filing
+        recorder.add_filing(accession_code, ticker, date, form)
+        add_filing_entry(accession_code, ticker, date, form)
+        body = {"accession_code": accession_code, "ticker": ticker, "date": date, "form": form}
+        if form in COMPANY_FORMS:
+            functions = [fha_wrapper, initialize_llm_workflow]
+        elif form == "13F-HR":
+            functions = [initialize_13f_workflow]
+        else:
+            functions = []
+        for function in functions:
+            response_message, status_code = function(http_request(function.__name__, body))
+            print(f"{accession_code} {function.__name__}: {status_code} {response_message[:120]}")
+
+    description = "Recorded " + ", ".join(f"{filing[3]} {filing[0]}" for filing in args.filing)
+    path = save_fixture(args.record, recorder.fixture(description))
+    print(f"Wrote {path} ({os.path.getsize(path) / 1024:.0f} KB)")
+
+
+def filing_argument(value):
+    parts = value.split(",")
+    if len(parts) != 4:
+        raise argparse.ArgumentTypeError(f"expected ACCESSION,TICKER,DATE,FORM, got {value!r}")
+    return parts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--fixture", default="sample", help="fixture name in benchmarks/fixtures, or path")
+    parser.add_argument("--scenario", action="append", help="only run this scenario (repeatable)")
+    parser.add_argument("--iterations", type=int, default=20, help="timed invocations per scenario")
+    parser.add_argument("--warmup", type=int, default=2, help="untimed invocations before them")
+    parser.add_argument("--alloc-iterations", type=int, default=3, help="invocations traced for allocations")
+    parser.add_argument("--warm-caches", action="store_true", help="keep the facts, filing and LLM caches between invocations")
+    parser.add_argument("--latency-scale", type=float, default=0.0, help="replay recorded latencies multiplied by this")
+    parser.add_argument("--cosmos-latency", type=float, default=0.0, help="seconds per Cosmos DB request")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline file (default: benchmarks/baseline.json)")
+    parser.add_argument("--update-baseline", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="allowed relative regression")
+    parser.add_argument("--gate-latency", action="store_true", help="also fail on slower latencies and throughput")
+    parser.add_argument("--min-delta-ms", type=float, default=DEFAULT_MIN_DELTA_MS, help="latency differences ignored as noise")
+    parser.add_argument("--min-delta-kib", type=float, default=DEFAULT_MIN_DELTA_KIB, help="allocation differences ignored as noise")
+    parser.add_argument("--retries", type=int, default=2, help="measurements of a regressed scenario before it fails")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    parser.add_argument("--record", metavar="NAME", help="record a fixture from the live services instead")
+    parser.add_argument("--filing", action="append", type=filing_argument, default=[], metavar="ACCESSION,TICKER,DATE,FORM",
+                        help="filing to record (repeatable)")
+    parser.add_argument("--verbose", action="store_true", help="show the functions' logs")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+
+    baseline = None if args.record else load_baseline(args)
+    with tempfile.TemporaryDirectory(prefix="bench_functions_") as directory:
+        os.environ.update(replay_environment(directory, args.warm_caches))
+        if args.record:
+            if not args.filing:
+                parser.error("--record needs at least one --filing")
+            record(args)
+            return
+        results, regressions = benchmark(args, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"settings": settings(args), "scenarios": results}, f, indent=2)
+
+    if args.update_baseline:
+        stored = {"settings": settings(args), "scenarios": {}}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                previous = json.load(f)
+            # Scenarios that were not run keep their baseline
+            if previous.get("settings") == settings(args):
+                stored["scenarios"] = previous["scenarios"]
+        stored["scenarios"].update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(stored, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Updated {args.baseline}")
+    elif baseline is None:
+        print(f"No baseline at {args.baseline}, run with --update-baseline to create it")
+    elif regressions:
+        print("Regressions against the baseline:")
+        for found in regressions.values():
+            for regression in found:
+                print(f"    {regression}")
+        sys.exit(1)
+    else:
+        print(f"No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+import copy
+import threading
+import time
+import uuid
+
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosBatchOperationError,
+    CosmosHttpResponseError,
+    CosmosResourceExistsError,
+    CosmosResourceNotFoundError,
+)
+
+# The queries the functions send, and how each one is answered
+CHUNK_IDS_QUERY = "SELECT VALUE c.id FROM c WHERE c.accession_code = @accession_code AND STARTSWITH(c.id, @prefix)"
+PREVIOUS_FILING_QUERY = (
+    "SELECT TOP 1 * FROM c WHERE NOT IS_DEFINED(c.doc_type) AND c.form = @form AND c.date < @date "
+    "AND c.id != @id ORDER BY c.date DESC"
+)
+IDS_QUERY = "SELECT * FROM c WHERE ARRAY_CONTAINS(@ids, c.id)"
+
+
+class FakeCosmosClient:
+    # Stands in for CosmosClient in shared_code.cosmos.set_cosmos_client(). Every container name
+    # of every database maps to the same container.
+    def __init__(self, container=None):
+        self.container = container or FakeContainer()
+
+    def get_database_client(self, database_name):
+        return self
+
+    def get_container_client(self, container_name):
+        return self.container
+
+
+class FakeContainer:
+    # In-memory container partitioned on /ticker with the semantics the functions rely on: ETags,
+    # 409 on creating an existing item, 412 on a stale conditional write, partial document updates,
+    # transactional batches and the queries above. Every request optionally sleeps for latency
+    # seconds before it is applied atomically.
+    def __init__(self, documents=None, latency=0.0):
+        self.id = "filings"
+        self.latency = latency
+        self.documents = {}
+        self.stats = {"requests": 0}
+        self._lock = threading.Lock()
+        for document in documents or []:
+            self._store(copy.deepcopy(document))
+
+    def snapshot(self):
+        # Copies of the stored documents, to seed another container with
+        with self._lock:
+            return copy.deepcopy(list(self.documents.values()))
+
+    def create_item(self, body, **kwargs):
+        self._request()
+        with self._lock:
+            if self._key(body) in self.documents:
+                raise CosmosResourceExistsError(status_code=409, message=f"Item {body['id']} already exists")
+            return self._read(self._store(copy.deepcopy(body)))
+
+    def upsert_item(self, body, **kwargs):
+        self._request()
+        with self._lock:
+            return self._read(self._store(copy.deepcopy(body)))
+
+    def read_item(self, item, partition_key, **kwargs):
+        self._request()
+        with self._lock:
+            return self._read(self._get(item, partition_key))
+
+    def replace_item(self, item, body, etag=None, match_condition=None, **kwargs):
+        self._request()
+        with self._lock:
+            current = self._get(item, body.get("ticker"))
+            self._check_etag(current, etag if match_condition == MatchConditions.IfNotModified else None)
+            return self._read(self._store(copy.deepcopy(body)))
+
+    def patch_item(self, item, partition_key, patch_operations, **kwargs):
+        self._request()
+        with self._lock:
+            return self._read(self._patch(item, partition_key, patch_operations))
+
+    def delete_item(self, item, partition_key, **kwargs):
+        self._request()
+        with self._lock:
+            self._get(item, partition_key)
+            del self.documents[(partition_key, item)]
+
+    def query_items(self, query, parameters=None, partition_key=None, **kwargs):
+        self._request()
+        values = {parameter["name"]: parameter["value"] for parameter in parameters or []}
+        with self._lock:
+            documents = [document for (ticker, _), document in self.documents.items() if ticker == partition_key]
+            if query == CHUNK_IDS_QUERY:
+                results = [
+                    document["id"] for document in documents
+                    if document.get("accession_code") == values["@accession_code"] and document["id"].startswith(values["@prefix"])
+                ]
+            elif query == PREVIOUS_FILING_QUERY:
+                candidates = [
+                    document for document in documents
+                    if "doc_type" not in document and document.get("form") == values["@form"]
+                    and document.get("date", "") < values["@date"] and document["id"] != values["@id"]
+                ]
+                results = sorted(candidates, key=lambda document: document["date"], reverse=True)[:1]
+            elif query == IDS_QUERY:
+                results = [document for document in documents if document["id"] in values["@ids"]]
+            else:
+                raise NotImplementedError(f"Query not supported by the fake container: {query}")
+            results = [self._read(result) if isinstance(result, dict) else result for result in results]
+        return iter(results)
+
+    def execute_item_batch(self, batch_operations, partition_key, **kwargs):
+        self._request()
+        with self._lock:
+            before = dict(self.documents)
+            results = []
+            for index, operation in enumerate(batch_operations):
+                kind, args = operation[0], operation[1]
+                options = operation[2] if len(operation) > 2 else {}
+                try:
+                    results.append(self._batch_operation(kind, args, options, partition_key))
+                except CosmosHttpResponseError as e:
+                    self.documents = before
+                    raise CosmosBatchOperationError(
+                        error_index=index, headers={}, status_code=e.status_code, message=str(e), operation_responses=[]
+                    )
+            return results
+
+    def _batch_operation(self, kind, args, options, partition_key):
+        if kind == "create":
+            if self._key(args[0]) in self.documents:
+                raise CosmosResourceExistsError(status_code=409, message=f"Item {args[0]['id']} already exists")
+            return self._read(self._store(copy.deepcopy(args[0])))
+        if kind == "upsert":
+            return self._read(self._store(copy.deepcopy(args[0])))
+        if kind == "read":
+            return self._read(self._get(args[0], partition_key))
+        if kind == "delete":
+            self._get(args[0], partition_key)
+            del self.documents[(partition_key, args[0])]
+            return {}
+        if kind == "replace":
+            self._check_etag(self._get(args[0], partition_key), options.get("if_match_etag"))
+            return self._read(self._store(copy.deepcopy(args[1])))
+        if kind == "patch":
+            self._check_etag(self._get(args[0], partition_key), options.get("if_match_etag"))
+            return self._read(self._patch(args[0], partition_key, args[1]))
+        raise CosmosHttpResponseError(status_code=400, message=f"Unsupported batch operation {kind}")
+
+    def _patch(self, item, partition_key, operations):
+        document = copy.deepcopy(self._get(item, partition_key))
+        for operation in operations:
+            *parents, name = [_unescape(part) for part in operation["path"].strip("/").split("/")]
+            target = document
+            for parent in parents:
+                try:
+                    target = target[int(parent) if isinstance(target, list) else parent]
+                except (KeyError, IndexError, ValueError):
+                    raise CosmosHttpResponseError(status_code=400, message=f"Missing path {operation['path']}")
+            if operation["op"] == "add" and isinstance(target, list):
+                target.insert(len(target) if name == "-" else int(name), operation["value"])
+            elif operation["op"] in ("add", "set", "replace"):
+                target[name] = operation["value"]
+            elif operation["op"] == "remove":
+                try:
+                    del target[int(name) if isinstance(target, list) else name]
+                except (KeyError, IndexError, ValueError):
+                    raise CosmosHttpResponseError(status_code=400, message=f"Missing path {operation['path']}")
+            elif operation["op"] == "incr":
+                target[name] = target.get(name, 0) + operation["value"]
+            else:
+                raise CosmosHttpResponseError(status_code=400, message=f"Unsupported operation {operation['op']}")
+        return self._store(document)
+
+    def _request(self):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.stats["requests"] += 1
+
+    def _get(self, item, partition_key):
+        document = self.documents.get((partition_key, item))
+        if document is None:
+            raise CosmosResourceNotFoundError(status_code=404, message=f"Item {item} not found")
+        return document
+
+    def _check_etag(self, document, etag):
+        if etag is not None and document["_etag"] != etag:
+            raise CosmosAccessConditionFailedError(status_code=412, message="Precondition failed")
+
+    def _read(self, document):
+        # Callers get their own copy, like a response deserialized from the service
+        return copy.deepcopy(document)
+
+    def _store(self, document):
+        document["_etag"] = uuid.uuid4().hex
+        document["_ts"] = int(time.time())
+        self.documents[self._key(document)] = document
+        return document
+
+    @staticmethod
+    def _key(document):
+        return document.get("ticker"), document["id"]
+
+
+def _unescape(part):
+    return part.replace("~1", "/").replace("~0", "~")
@@ -0,0 +1,60 @@
+import base64
+import gzip
+import json
+import os
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fixtures")
+
+# A fixture is the outside world of a set of filings, captured at the boundaries the replay stands in
+# for (gzipped JSON):
+#
+#   filings   [{"accession_code", "ticker", "date", "form", "cik"}], the filings the scenarios run on
+#   edgar     [{"url", "status", "content_type", "body" or "body_base64", "elapsed_ms"}], EDGAR
+#             responses: submissions and company facts JSON, filing documents and indexes
+#   holdings  {accession_code: [information table rows]}, output of the 13F extractor
+#   llm       {accession_code: {"documents": [EDGAR urls fetched by the pipeline],
+#                               "exchanges": [{"request", "response", "elapsed_ms"}],
+#                               "output": [comp_analysis, risk_analysis]}}
+#
+# Fixtures are looked up by name in benchmarks/fixtures, or given as a path.
+FIXTURE_VERSION = 1
+
+
+def fixture_path(name):
+    if os.path.sep in name or name.endswith(".json.gz"):
+        return name
+    return os.path.join(FIXTURE_DIR, f"{name}.json.gz")
+
+
+def load_fixture(name):
+    with gzip.open(fixture_path(name), "rt", encoding="utf-8") as f:
+        fixture = json.load(f)
+    if fixture.get("version") != FIXTURE_VERSION:
+        raise ValueError(f"Unsupported fixture version {fixture.get('version')} in {fixture_path(name)}")
+    return fixture
+
+
+def save_fixture(name, fixture):
+    # mtime=0 and sorted keys, so regenerating an unchanged fixture gives the same file
+    path = fixture_path(name)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    data = json.dumps(dict(fixture, version=FIXTURE_VERSION), sort_keys=True, separators=(",", ":")).encode("utf-8")
+    with open(path, "wb") as f:
+        with gzip.GzipFile(fileobj=f, mode="wb", mtime=0) as compressed:
+            compressed.write(data)
+    return path
+
+
+def edgar_response(url, status, content, content_type=None, elapsed_ms=0.0):
+    response = {"url": url, "status": status, "content_type": content_type, "elapsed_ms": round(elapsed_ms, 1)}
+    try:
+        response["body"] = content.decode("utf-8")
+    except UnicodeDecodeError:
+        response["body_base64"] = base64.b64encode(content).decode("ascii")
+    return response
+
+
+def edgar_content(response):
+    if "body_base64" in response:
+        return base64.b64decode(response["body_base64"])
+    return response["body"].encode("utf-8")
@@ -0,0 +1,283 @@
+import json
+import os
+import threading
+import time
+
+import httpx
+
+from shared_code.edgar_session import EdgarSession, set_edgar_session
+from shared_code.facts_cache import get_facts_cache
+from shared_code.filing_cache import get_filing_cache
+from shared_code.instrumentation import traced
+from shared_code.llm_concurrency import LimitedTransport, get_llm_limiter, run_concurrently
+
+from .fixtures import edgar_content, edgar_response
+
+# The functions reach the outside world at four boundaries, where a fixture is recorded and replayed:
+#   EDGAR      the transport of the shared EdgarSession, so edgartools parses the recorded submissions,
+#              company facts and filing documents the same way as downloaded ones. The accession
+#              number -> CIK lookup, which edgartools answers from quarterly full indexes, is seeded
+#              into the facts cache instead.
+#   13F        ThirteenF.wrapper_13f.extract_13f_from_accession, whose extractor lives in the
+#              13F-Analysis submodule, returns the recorded information table
+#   LLM        LLMAnalysis.llm_analy_wrapper.llm_pipeline, whose pipeline lives in the
+#              llm_analysis_repo submodule, fetches the recorded filing documents through the EDGAR
+#              session and sends the recorded chat completion requests through an openai client,
+#              so the LLM cache, the progress store and the limiter handle them as in production.
+#              The recorded completions are served by the client's transport and the recorded
+#              output is returned. Tokenization is not replayed, tiktoken's encodings are downloaded.
+#   Cosmos DB  a FakeContainer, see fake_cosmos.py
+#
+# Recorded latencies are replayed multiplied by latency_scale, 0 serving every response at once.
+
+REPLAY_LLM_URL = "http://llm.replay/v1"
+
+# Request rate of the replayed EDGAR session, high enough never to wait for a token
+REPLAY_EDGAR_RATE = 1_000_000
+
+
+class ReplayError(RuntimeError):
+    pass
+
+
+class Replay:
+    def __init__(self, fixture, latency_scale=0.0):
+        self.fixture = fixture
+        self.latency_scale = latency_scale
+        self.edgar = {response["url"]: response for response in fixture.get("edgar", [])}
+        self.llm = fixture.get("llm", {})
+        self.completions = {
+            _messages_key(exchange["request"].get("messages")): exchange
+            for recorded in self.llm.values() for exchange in recorded["exchanges"]
+        }
+        self.stats = {"edgar_requests": 0, "llm_requests": 0, "extractions": 0, "misses": 0}
+        self._lock = threading.Lock()
+
+    def install(self):
+        # Route the boundaries of the current process to the fixture
+        from ThirteenF import wrapper_13f
+        from LLMAnalysis import llm_analy_wrapper
+
+        set_edgar_session(EdgarSession(
+            transport=httpx.MockTransport(self._edgar_response), rate=REPLAY_EDGAR_RATE, cache=get_filing_cache()
+        ))
+        cache = get_facts_cache()
+        for filing in self.fixture.get("filings", []):
+            if filing.get("cik"):
+                cache.filing_cik(filing["accession_code"], lambda: filing["cik"])
+
+        wrapper_13f.extract_13f_from_accession = traced("13f.extract")(self.extract_13f_from_accession)
+        llm_analy_wrapper.llm_pipeline = traced("llm.pipeline")(self.llm_pipeline)
+
+    def extract_13f_from_accession(self, accession_code):
+        holdings = self.fixture.get("holdings", {}).get(accession_code)
+        if holdings is None:
+            self._count("misses")
+            raise ReplayError(f"No recorded 13F information table for {accession_code}")
+        self._count("extractions")
+        return [dict(holding) for holding in holdings]
+
+    def llm_pipeline(self, accession_code):
+        import openai
+
+        recorded = self.llm.get(accession_code)
+        if recorded is None:
+            self._count("misses")
+            raise ReplayError(f"No recorded LLM analysis for {accession_code}")
+
+        # Fetch the filing documents like the pipeline, through the shared EDGAR session
+        from shared_code.edgar_session import get_edgar_session
+
+        session = get_edgar_session()
+        for url in recorded["documents"]:
+            session.get(url)
+
+        client = openai.OpenAI(
+            api_key="replay", base_url=REPLAY_LLM_URL, max_retries=0,
+            http_client=httpx.Client(transport=LimitedTransport(httpx.MockTransport(self._llm_response))),
+        )
+        try:
+            results = run_concurrently(
+                recorded["exchanges"],
+                lambda exchange: client.chat.completions.create(**exchange["request"]),
+                get_llm_limiter().max_concurrency,
+            )
+        finally:
+            client.close()
+        for _, _, error in results:
+            if error is not None:
+                raise error
+
+        comp_analysis, risk_analysis = recorded["output"]
+        return comp_analysis, risk_analysis
+
+    def _edgar_response(self, request):
+        response = self.edgar.get(str(request.url))
+        if response is None:
+            self._count("misses")
+            raise ReplayError(f"No recorded EDGAR response for {request.url}")
+        self._count("edgar_requests")
+        self._wait(response)
+        headers = {"Content-Type": response["content_type"]} if response.get("content_type") else None
+        return httpx.Response(response["status"], content=edgar_content(response), headers=headers)
+
+    def _llm_response(self, request):
+        exchange = self.completions.get(_messages_key(json.loads(request.content).get("messages")))
+        if exchange is None:
+            self._count("misses")
+            raise ReplayError("No recorded chat completion for the request")
+        self._count("llm_requests")
+        self._wait(exchange)
+        return httpx.Response(200, json=exchange["response"])
+
+    def _wait(self, recorded):
+        if self.latency_scale and recorded.get("elapsed_ms"):
+            time.sleep(recorded["elapsed_ms"] * self.latency_scale / 1000)
+
+    def _count(self, counter):
+        with self._lock:
+            self.stats[counter] += 1
+
+
+class Recorder:
+    # Captures a fixture at the boundaries above while the functions run against EDGAR, the model
+    # endpoint and the extractors of the submodules. The LLM cache, the progress store and the filing
+    # cache must be disabled, so every response goes through the boundaries.
+    def __init__(self):
+        self.filings = []
+        self.edgar = []
+        self.holdings = {}
+        self.llm = {}
+        self.ciks = {}
+        self._exchanges = None
+        self._lock = threading.Lock()
+
+    def install(self):
+        from openai.resources.chat.completions import Completions
+        from shared_code.facts_cache import FactsCache
+        from ThirteenF import wrapper_13f
+        from LLMAnalysis import llm_analy_wrapper
+
+        set_edgar_session(EdgarSession(transport=_RecordingTransport(self, httpx.HTTPTransport()), cache=None))
+
+        filing_cik = FactsCache.filing_cik
+
+        def recorded_filing_cik(cache, accn, loader):
+            cik = filing_cik(cache, accn, loader)
+            self.ciks[accn] = int(cik)
+            return cik
+
+        FactsCache.filing_cik = recorded_filing_cik
+
+        create = Completions.create
+
+        def recorded_create(completions, *args, **kwargs):
+            started = time.perf_counter()
+            response = create(completions, *args, **kwargs)
+            request = {key: value for key, value in kwargs.items() if key not in ("timeout", "extra_headers")}
+            with self._lock:
+                if self._exchanges is not None:
+                    self._exchanges.append({
+                        "request": json.loads(json.dumps(request, default=str)),
+                        "response": response.model_dump(mode="json"),
+                        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+                    })
+            return response
+
+        Completions.create = recorded_create
+
+        extract = wrapper_13f.extract_13f_from_accession
+
+        @traced("13f.extract")
+        def recorded_extract(accession_code):
+            holdings = list(extract.__wrapped__(accession_code))
+            self.holdings[accession_code] = json.loads(json.dumps(holdings, default=str))
+            return holdings
+
+        wrapper_13f.extract_13f_from_accession = recorded_extract
+
+        pipeline = llm_analy_wrapper.llm_pipeline
+
+        @traced("llm.pipeline")
+        def recorded_pipeline(accession_code):
+            # Documents fetched and completions requested while the pipeline runs belong to the filing
+            with self._lock:
+                first_document = len(self.edgar)
+                self._exchanges = []
+            try:
+                output = pipeline.__wrapped__(accession_code)
+            finally:
+                with self._lock:
+                    exchanges, self._exchanges = self._exchanges, None
+                    documents = [response["url"] for response in self.edgar[first_document:]]
+            self.llm[accession_code] = {
+                "documents": documents,
+                "exchanges": exchanges,
+                "output": json.loads(json.dumps(list(output), default=str)),
+            }
+            return output
+
+        llm_analy_wrapper.llm_pipeline = recorded_pipeline
+
+    def add_filing(self, accession_code, ticker, date, form):
+        self.filings.append({"accession_code": accession_code, "ticker": ticker, "date": date, "form": form})
+
+    def record_edgar(self, url, status, content, content_type, elapsed_ms):
+        with self._lock:
+            self.edgar.append(edgar_response(url, status, content, content_type, elapsed_ms))
+
+    def fixture(self, description):
+        # Later responses for a URL replace earlier ones
+        edgar = {response["url"]: response for response in self.edgar}
+        filings = [dict(filing, cik=self.ciks.get(filing["accession_code"])) for filing in self.filings]
+        return {
+            "description": description,
+            "filings": filings,
+            "edgar": list(edgar.values()),
+            "holdings": self.holdings,
+            "llm": self.llm,
+        }
+
+
+class _RecordingTransport(httpx.BaseTransport):
+    def __init__(self, recorder, transport):
+        self.recorder = recorder
+        self.transport = transport
+
+    def handle_request(self, request):
+        started = time.perf_counter()
+        response = self.transport.handle_request(request)
+        content = response.read()
+        self.recorder.record_edgar(
+            str(request.url), response.status_code, content, response.headers.get("Content-Type"),
+            (time.perf_counter() - started) * 1000,
+        )
+        return httpx.Response(response.status_code, headers=response.headers, content=content)
+
+    def close(self):
+        self.transport.close()
+
+
+def _messages_key(messages):
+    return json.dumps(messages, sort_keys=True, default=str)
+
+
+def replay_environment(directory, warm_caches=False):
+    # Environment of a replayed run: dummy Cosmos DB settings, the caches of the process under
+    # directory, and, unless warm_caches, the facts, filing and LLM caches set to miss so every
+    # invocation parses the replayed responses
+    environment = {
+        "COSMOS_DB_URL": "https://replay.documents.azure.com:443/",
+        "COSMOS_DB_KEY": "replay",
+        "COSMOS_DB_DATABASE": "replay",
+        "COSMOS_DB_CONTAINER_FILINGS": "filings",
+        "EDGAR_IDENTITY": os.getenv("EDGAR_IDENTITY") or "Benchmark benchmark@example.com",
+        "FACTS_CACHE_DIR": os.path.join(directory, "facts"),
+        "FILING_CACHE_DIR": os.path.join(directory, "filings"),
+        "LLM_CACHE_PATH": os.path.join(directory, "llm_cache.sqlite3"),
+        "ANALYSIS_DISPATCH_MODE": "queue",
+        "WORK_QUEUE_BACKEND": "memory",
+    }
+    if not warm_caches:
+        environment.update({"FACTS_CACHE_TTL_SECONDS": "0", "FILING_CACHE_MAX_BYTES": "0", "LLM_CACHE_MAX_BYTES": "0"})
+    return environment
@@ -0,0 +1,251 @@
+"""
+Generates the "sample" fixture: made-up EDGAR, 13F and model responses shaped like recorded ones.
+
+Recording a fixture (bench_functions.py --record) needs EDGAR and model access and both submodules.
+This one is generated from a fixed seed instead, with the sizes of a mid-sized filer:
+a company with a few years of 10-K and 10-Q company facts, a filing document and the model
+exchanges of its LLM analysis, and an investment manager's 13F information tables for two
+consecutive quarters.
+
+Usage: python benchmarks/offline/synthetic.py [--facts 250] [--holdings 2500] [--output sample]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "TL74Functions"))
+
+from offline.fixtures import edgar_response, save_fixture
+from FinancialHealth.metrics import METRICS
+
+COMPANY = {"cik": 1234567, "ticker": "CHVX", "name": "Chevalier Example Corp"}
+MANAGER = {"cik": 7654321, "ticker": "CHVM", "name": "Chevalier Example Capital LLC"}
+MODEL = "gpt-4o-mini"
+
+# (form, period end, filing date) of the company's filings, oldest first
+PERIODS = [
+    ("10-Q", "2021-12-31", "2022-02-04"), ("10-Q", "2022-03-31", "2022-05-06"), ("10-Q", "2022-06-30", "2022-08-05"),
+    ("10-K", "2022-09-30", "2022-11-18"), ("10-Q", "2022-12-31", "2023-02-03"), ("10-Q", "2023-03-31", "2023-05-05"),
+    ("10-Q", "2023-06-30", "2023-08-04"), ("10-K", "2023-09-30", "2023-11-17"), ("10-Q", "2023-12-31", "2024-02-02"),
+    ("10-Q", "2024-03-31", "2024-05-03"), ("10-Q", "2024-06-30", "2024-08-02"),
+]
+
+# (accession number, filing date) of the manager's 13F-HR filings, previous quarter first
+THIRTEENF_FILINGS = [("0007654321-24-000003", "2024-05-15"), ("0007654321-24-000007", "2024-08-14")]
+
+SECTIONS = ["business", "risk_factors", "md_and_a", "liquidity", "market_risk", "controls"]
+
+
+def accession(cik, year, sequence):
+    return f"{cik:010d}-{year % 100:02d}-{sequence:06d}"
+
+
+def company_filings():
+    filings = []
+    for sequence, (form, period, filed) in enumerate(PERIODS, start=1):
+        filings.append({
+            "accession_code": accession(COMPANY["cik"], int(filed[:4]), sequence * 7),
+            "ticker": COMPANY["ticker"], "date": filed, "form": form, "cik": COMPANY["cik"], "period": period,
+        })
+    return filings
+
+
+def fiscal_period(form, period):
+    # Fiscal year ending in September
+    year, month = int(period[:4]), int(period[5:7])
+    if form == "10-K":
+        return year, "FY"
+    return (year + 1, "Q1") if month == 12 else (year, {3: "Q2", 6: "Q3"}[month])
+
+
+def company_facts(rng, filings, fact_count):
+    names = sorted({name for metric in METRICS for name in metric.inputs})
+    names += [f"SyntheticDisclosure{index:03d}" for index in range(max(0, fact_count - len(names)))]
+    facts = {}
+    for name in names:
+        base = rng.randint(10**6, 10**11)
+        rows = []
+        for index, filing in enumerate(filings):
+            fy, fp = fiscal_period(filing["form"], filing["period"])
+            # Each filing reports the current period and the comparative one of the year before
+            for offset, end in ((0, filing["period"]), (1, f"{int(filing['period'][:4]) - 1}{filing['period'][4:]}")):
+                rows.append({
+                    "end": end, "val": int(base * (1 + 0.03 * (index - 4 * offset)) * rng.uniform(0.95, 1.05)),
+                    "accn": filing["accession_code"], "fy": fy, "fp": fp, "form": filing["form"],
+                    "filed": filing["date"], **({"frame": f"CY{end[:4]}Q{(int(end[5:7]) - 1) // 3 + 1}I"} if not offset else {}),
+                })
+        facts[name] = {"label": name, "description": f"Synthetic {name}.", "units": {"USD": rows}}
+    return {
+        "cik": COMPANY["cik"], "entityName": COMPANY["name"],
+        "facts": {
+            "dei": {"EntityCommonStockSharesOutstanding": {
+                "label": "Entity Common Stock, Shares Outstanding", "description": "Shares outstanding.",
+                "units": {"shares": [
+                    {"end": filing["period"], "val": 15_000_000_000 - 50_000_000 * index, "accn": filing["accession_code"],
+                     "fy": fiscal_period(filing["form"], filing["period"])[0], "fp": fiscal_period(filing["form"], filing["period"])[1],
+                     "form": filing["form"], "filed": filing["date"]}
+                    for index, filing in enumerate(filings)
+                ]},
+            }},
+            "us-gaap": facts,
+        },
+    }
+
+
+def submissions(entity, filings):
+    address = {"street1": "1 EXAMPLE PLAZA", "street2": None, "city": "WILMINGTON", "stateOrCountry": "DE",
+               "zipCode": "19801", "stateOrCountryDescription": "DE"}
+    recent = {key: [] for key in (
+        "accessionNumber", "filingDate", "reportDate", "acceptanceDateTime", "act", "form", "fileNumber",
+        "filmNumber", "items", "size", "isXBRL", "isInlineXBRL", "primaryDocument", "primaryDocDescription",
+    )}
+    for filing in reversed(filings):
+        for key, value in (
+            ("accessionNumber", filing["accession_code"]), ("filingDate", filing["date"]),
+            ("reportDate", filing.get("period", "")), ("acceptanceDateTime", f"{filing['date']}T16:30:00.000Z"),
+            ("act", "34"), ("form", filing["form"]), ("fileNumber", "001-00000"), ("filmNumber", "240000000"),
+            ("items", ""), ("size", 1_000_000), ("isXBRL", 1), ("isInlineXBRL", 1),
+            ("primaryDocument", primary_document(filing)), ("primaryDocDescription", filing["form"]),
+        ):
+            recent[key].append(value)
+    return {
+        "cik": str(entity["cik"]), "entityType": "operating", "sic": "3571", "sicDescription": "Electronic Computers",
+        "insiderTransactionForOwnerExists": 0, "insiderTransactionForIssuerExists": 1, "name": entity["name"],
+        "tickers": [entity["ticker"]], "exchanges": ["Nasdaq"], "ein": "000000000", "description": "",
+        "website": "", "investorWebsite": "", "category": "Large accelerated filer", "fiscalYearEnd": "0930",
+        "stateOfIncorporation": "DE", "stateOfIncorporationDescription": "DE",
+        "addresses": {"mailing": address, "business": address}, "phone": "(555) 010-0000", "flags": "",
+        "formerNames": [], "filings": {"recent": recent, "files": []},
+    }
+
+
+def primary_document(filing):
+    return f"{filing['ticker'].lower()}-{filing.get('period', filing['date']).replace('-', '')}.htm"
+
+
+def document_url(filing):
+    return (f"https://www.sec.gov/Archives/edgar/data/{filing['cik']}/"
+            f"{filing['accession_code'].replace('-', '')}/{primary_document(filing)}")
+
+
+def section_text(rng, section, paragraphs):
+    words = ["revenue", "customers", "supply", "demand", "margin", "products", "services", "competition",
+             "regulation", "currency", "interest", "liquidity", "capital", "operations", "markets", "risk"]
+    return "\n".join(
+        f"{section.replace('_', ' ').title()} {index}: " + " ".join(rng.choice(words) for _ in range(120)) + "."
+        for index in range(paragraphs)
+    )
+
+
+def filing_document(rng, filing):
+    sections = {section: section_text(rng, section, 40) for section in SECTIONS}
+    body = "".join(f"<h2>{section}</h2><p>{text.replace(chr(10), '</p><p>')}</p>" for section, text in sections.items())
+    return f"<html><head><title>{filing['form']}</title></head><body>{body}</body></html>", sections
+
+
+def llm_analysis(rng, filing, sections):
+    exchanges = []
+    for analysis in ("comprehensive", "risk"):
+        for section, text in sections.items():
+            request = {
+                "model": MODEL, "temperature": 0, "max_tokens": 800,
+                "messages": [
+                    {"role": "system", "content": f"You write the {analysis} analysis of one section of an SEC filing."},
+                    {"role": "user", "content": f"Section {section} of {filing['accession_code']}:\n{text[:12000]}"},
+                ],
+            }
+            content = json.dumps({"section": section, "summary": section_text(rng, section, 3), "score": rng.randint(1, 10)})
+            prompt_tokens = len(json.dumps(request["messages"])) // 4
+            completion_tokens = len(content) // 4
+            response = {
+                "id": f"chatcmpl-{analysis}-{section}", "object": "chat.completion", "created": 1722600000, "model": MODEL,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop", "logprobs": None}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens},
+            }
+            exchanges.append({"request": request, "response": response, "elapsed_ms": round(rng.uniform(1500, 6000), 1)})
+
+    def output(analysis):
+        return {
+            exchange["request"]["messages"][1]["content"].split(" ")[1]: json.loads(exchange["response"]["choices"][0]["message"]["content"])
+            for exchange in exchanges if analysis in exchange["request"]["messages"][0]["content"]
+        }
+
+    return {"documents": [document_url(filing)], "exchanges": exchanges, "output": [output("comprehensive"), output("risk")]}
+
+
+def information_tables(rng, holding_count):
+    previous = []
+    for index in range(holding_count):
+        shares = rng.randint(100, 5_000_000)
+        previous.append({
+            "nameOfIssuer": f"EXAMPLE ISSUER {index:05d} INC", "titleOfClass": "COM",
+            "cusip": f"{rng.randrange(16**8):08X}{index % 10}", "value": shares * rng.randint(5, 400),
+            "sshPrnamt": shares, "sshPrnamtType": "SH", "putCall": "Call" if index % 50 == 0 else None,
+            "investmentDiscretion": "SOLE", "otherManager": None,
+            "votingAuthoritySole": shares, "votingAuthorityShared": 0, "votingAuthorityNone": 0,
+        })
+
+    # The next quarter closes a few positions, opens a few and changes most of the others
+    current = []
+    for holding in previous:
+        roll = rng.random()
+        if roll < 0.05:
+            continue
+        if roll < 0.8:
+            shares = max(1, int(holding["sshPrnamt"] * rng.uniform(0.7, 1.3)))
+            holding = dict(holding, sshPrnamt=shares, votingAuthoritySole=shares, value=shares * rng.randint(5, 400))
+        current.append(holding)
+    for index in range(holding_count // 20):
+        shares = rng.randint(100, 1_000_000)
+        current.append(dict(previous[0], nameOfIssuer=f"NEW EXAMPLE ISSUER {index:04d} CORP", cusip=f"N{index:07d}0",
+                            sshPrnamt=shares, votingAuthoritySole=shares, value=shares * 20, putCall=None))
+    return previous, current
+
+
+def make_fixture(fact_count, holding_count, seed=74):
+    rng = random.Random(seed)
+    filings = company_filings()
+    latest = filings[-1]
+    edgar = [
+        edgar_response(f"https://data.sec.gov/submissions/CIK{COMPANY['cik']:010d}.json", 200,
+                       json.dumps(submissions(COMPANY, filings)).encode("utf-8"), "application/json", 120.0),
+        edgar_response(f"https://data.sec.gov/api/xbrl/companyfacts/CIK{COMPANY['cik']:010d}.json", 200,
+                       json.dumps(company_facts(rng, filings, fact_count)).encode("utf-8"), "application/json", 900.0),
+    ]
+    document, sections = filing_document(rng, latest)
+    edgar.append(edgar_response(document_url(latest), 200, document.encode("utf-8"), "text/html", 400.0))
+
+    previous, current = information_tables(rng, holding_count)
+    thirteenf_filings = [
+        {"accession_code": accession_code, "ticker": MANAGER["ticker"], "date": date, "form": "13F-HR", "cik": MANAGER["cik"]}
+        for accession_code, date in THIRTEENF_FILINGS
+    ]
+
+    return {
+        "description": "Synthetic company facts, filing document, LLM exchanges and 13F information tables "
+                       f"(seed {seed}, {fact_count} facts, {holding_count} holdings)",
+        "filings": [{key: value for key, value in filing.items() if key != "period"} for filing in filings] + thirteenf_filings,
+        "edgar": edgar,
+        "holdings": {THIRTEENF_FILINGS[0][0]: previous, THIRTEENF_FILINGS[1][0]: current},
+        "llm": {latest["accession_code"]: llm_analysis(rng, latest, sections)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--facts", type=int, default=250, help="us-gaap facts of the company")
+    parser.add_argument("--holdings", type=int, default=2500, help="holdings of the manager's previous quarter")
+    parser.add_argument("--seed", type=int, default=74)
+    parser.add_argument("--output", default="sample", help="fixture name or path")
+    args = parser.parse_args()
+
+    path = save_fixture(args.output, make_fixture(args.facts, args.holdings, args.seed))
+    print(f"Wrote {path} ({os.path.getsize(path) / 1024:.0f} KB)")
+
+
+if __name__ == "__main__":
+    main()
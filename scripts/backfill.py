@@ -0,0 +1,534 @@
+"""
+Bulk backfill: run the financial health, 13F and LLM analyses for many filings at once.
+
+Calls the analysis code directly (fha_many, extract_13f_from_accession, llm_pipeline) instead of
+going through the HTTP functions. Each stage runs in its own process pool, EDGAR requests are
+rate limited across all worker processes, results are written to Cosmos DB in transactional
+batches per ticker and progress is checkpointed so an interrupted run resumes where it stopped.
+
+Filings are read from a CSV or JSON lines file with accession_code, ticker, date and form
+columns, from the EDGAR quarterly index, or from the filing history of a ticker:
+
+    python scripts/backfill.py --input filings.csv
+    python scripts/backfill.py --edgar-index 2024Q1 --edgar-index 2024Q2 --forms 10-K,10-Q
+    python scripts/backfill.py --ticker AAPL --ticker MSFT --stages fha
+
+Needs the same settings as the function app (COSMOS_DB_*, EDGAR_IDENTITY and, for the LLM
+stage, the OpenAI settings) in the environment.
+"""
+import argparse
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "TL74Functions"))
+
+from azure.cosmos.exceptions import CosmosBatchOperationError
+
+from shared_code.cosmos import MAX_BATCH_OPERATIONS, BatchPacker, get_container
+from shared_code.edgar_session import configure_edgar
+from shared_code.filing_store import apply_analysis, filing_update_operation
+from shared_code.idempotency import completed_runs, finished_run_record, new_run_record
+from shared_code.llm_cache import llm_cache_scope
+from shared_code.llm_concurrency import configure_llm_limiter, get_llm_limiter, run_concurrently
+from shared_code.thirteenf_chunks import is_13f_analysis, iter_13f_chunks, stale_chunk_deletes, thirteenf_analysis
+
+# Analyses run for each form, the same ones the EntryPoint triggers
+FORM_STAGES = {
+    "10-K": ("fha", "llm"),
+    "10-Q": ("fha", "llm"),
+    "13F-HR": ("13f",),
+}
+STAGES = ("fha", "13f", "llm")
+
+# Outcomes of a filing in a stage. Everything but "failed" is final and not repeated on resume
+STORED = "stored"
+SKIPPED = "skipped"
+EMPTY = "empty"
+FAILED = "failed"
+
+# SEC fair access policy allows 10 requests per second; stay below it by default
+DEFAULT_SEC_RATE = 8
+
+
+def load_jobs(args):
+    # Filings to backfill as dicts with accession_code, ticker, date and form, in input order
+    jobs = []
+    for path in args.input or []:
+        jobs.extend(_read_job_file(path))
+    for index in args.edgar_index or []:
+        jobs.extend(_edgar_index_jobs(index, args.forms))
+    for ticker in args.ticker or []:
+        jobs.extend(_ticker_jobs(ticker, args.forms))
+
+    unique = {}
+    for job in jobs:
+        if job["form"] in args.forms:
+            unique.setdefault(job["accession_code"], job)
+    jobs = list(unique.values())
+    return jobs[:args.limit] if args.limit else jobs
+
+
+def _read_job_file(path):
+    with open(path, newline="") as f:
+        if path.endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+
+    return [
+        {
+            "accession_code": row["accession_code"].strip(),
+            "ticker": row["ticker"].strip(),
+            "date": str(row.get("date") or "").strip(),
+            "form": row["form"].strip(),
+        }
+        for row in rows
+    ]
+
+
+def _edgar_index_jobs(index, forms):
+    # index is "<year>Q<quarter>", e.g. 2024Q1
+    from edgar import get_filings
+    from edgar.reference.tickers import find_ticker
+
+    configure_edgar()
+    year, quarter = index.upper().split("Q")
+    filings = get_filings(int(year), int(quarter), form=list(forms), amendments=False)
+    if filings is None:
+        return []
+
+    jobs = []
+    for row in filings.to_pandas().itertuples():
+        # Filers without a listed ticker (most 13F filers) are stored under their CIK
+        ticker = find_ticker(row.cik) or f"{int(row.cik):010d}"
+        jobs.append({
+            "accession_code": row.accession_number,
+            "ticker": ticker,
+            "date": str(row.filing_date),
+            "form": row.form,
+        })
+    logging.info(f"Loaded {len(jobs)} filing(s) from the {index} EDGAR index")
+    return jobs
+
+
+def _ticker_jobs(ticker, forms):
+    from edgar import Company
+
+    configure_edgar()
+    filings = Company(ticker).get_filings(form=list(forms))
+    jobs = [
+        {
+            "accession_code": row.accession_number,
+            "ticker": ticker.upper(),
+            "date": str(row.filing_date),
+            "form": row.form,
+        }
+        for row in filings.to_pandas().itertuples()
+    ]
+    logging.info(f"Loaded {len(jobs)} filing(s) of {ticker}")
+    return jobs
+
+
+class Checkpoint:
+    # Append-only JSON lines log of finished (stage, accession_code) pairs
+    def __init__(self, path):
+        self.path = path
+        self.finished = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line cut short by an interrupted run
+                        continue
+                    if entry.get("outcome") != FAILED:
+                        self.finished.add((entry["stage"], entry["accession_code"]))
+        self._file = open(path, "a")
+
+    def is_finished(self, stage, accession_code):
+        return (stage, accession_code) in self.finished
+
+    def record(self, results):
+        for result in results:
+            self._file.write(json.dumps({
+                "stage": result["stage"],
+                "accession_code": result["accession_code"],
+                "outcome": result["outcome"],
+                "status": result["status"],
+                "message": result["message"],
+            }) + "\n")
+            if result["outcome"] != FAILED:
+                self.finished.add((result["stage"], result["accession_code"]))
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def init_worker(sec_rate, llm_limits=None):
+    # Give every worker process an equal share of the SEC request rate, enforced by the shared EDGAR
+    # session all of its EDGAR requests go through, and LLM workers their share of the model limits
+    logging.basicConfig(level=logging.WARNING, format="%(processName)s %(levelname)s %(message)s")
+    configure_edgar(rate=sec_rate)
+    if llm_limits:
+        configure_llm_limiter(**llm_limits)
+
+
+def run_fha_task(jobs, force):
+    # One task per ticker: the company facts are loaded once for all of its filings
+    from FinancialHealth.fha import fha_many
+    from FinancialHealth.fha_wrapper import ANALYSIS_TYPE, ANALYSIS_VERSION, fiscal_fields
+
+    jobs, results = _skip_completed("fha", jobs, ANALYSIS_TYPE, ANALYSIS_VERSION, force)
+    if not jobs:
+        return results
+
+    fha_results = fha_many([job["accession_code"] for job in jobs])
+    for job in jobs:
+        result = _result("fha", job, ANALYSIS_TYPE, ANALYSIS_VERSION)
+        fha_json = fha_results.get(job["accession_code"])
+        if fha_json is None:
+            result.update(outcome=EMPTY, status=204, message=f"No valid Financial analysis to append for {job['accession_code']}.")
+        elif isinstance(fha_json, str):
+            result.update(outcome=FAILED, status=422, message=fha_json)
+        else:
+            result["analysis"] = {"fha": fha_json}
+            result["fields"] = fiscal_fields(job["accession_code"], fha_json)
+            result["message"] = f"Stored financial health analysis for {job['accession_code']}."
+        results.append(result)
+    return results
+
+
+def run_13f_task(jobs, force):
+    from ThirteenF.wrapper_13f import ANALYSIS_TYPE, ANALYSIS_VERSION, extract_13f_from_accession
+
+    jobs, results = _skip_completed("13f", jobs, ANALYSIS_TYPE, ANALYSIS_VERSION, force)
+    for job in jobs:
+        result = _result("13f", job, ANALYSIS_TYPE, ANALYSIS_VERSION)
+        holdings = extract_13f_from_accession(job["accession_code"])
+        if isinstance(holdings, (str, bytes, dict)) or not hasattr(holdings, "__iter__"):
+            result.update(outcome=FAILED, status=500, message="Failed to parse extraction output.")
+        else:
+            result["documents"] = list(iter_13f_chunks(job["accession_code"], job["ticker"], holdings))
+            chunk_refs = [document["id"] for document in result["documents"]]
+            result["message"] = f"Stored {len(chunk_refs)} chunk(s) for {job['accession_code']}."
+        results.append(result)
+    return results
+
+
+def run_llm_task(jobs, force):
+    # The filings of a task are analyzed concurrently, since LLM analyses mostly wait on the model, up
+    # to the process's LLM concurrency at once. A failing filing is reported on its own.
+    from LLMAnalysis.llm_analy_wrapper import ANALYSIS_TYPE, ANALYSIS_VERSION, llm_pipeline
+
+    def analyze(job):
+        with llm_cache_scope(job["accession_code"]):
+            return llm_pipeline(job["accession_code"])
+
+    jobs, results = _skip_completed("llm", jobs, ANALYSIS_TYPE, ANALYSIS_VERSION, force)
+    for job, analyses, error in run_concurrently(jobs, analyze, get_llm_limiter().max_concurrency):
+        result = _result("llm", job, ANALYSIS_TYPE, ANALYSIS_VERSION)
+        if error is not None:
+            result.update(outcome=FAILED, status=500, message=str(error))
+        elif analyses[0] is None and analyses[1] is None:
+            result.update(outcome=EMPTY, status=204, message=f"No valid LLM analysis to append for {job['accession_code']}.")
+        else:
+            result["analysis"] = {"comp_analysis": analyses[0], "risk_analysis": analyses[1]}
+            result["message"] = f"Stored LLM analysis for {job['accession_code']}."
+        results.append(result)
+    return results
+
+
+STAGE_TASKS = {"fha": run_fha_task, "13f": run_13f_task, "llm": run_llm_task}
+
+
+def _result(stage, job, analysis_type, analysis_version):
+    return dict(job, stage=stage, analysis_type=analysis_type, analysis_version=analysis_version,
+                outcome=STORED, status=200, message="", analysis=None, fields={}, documents=[])
+
+
+def _skip_completed(stage, jobs, analysis_type, analysis_version, force):
+    # Leave out filings whose analysis was already completed, by the functions or an earlier backfill
+    if force:
+        return jobs, []
+    # LLM tasks mix the filings of several tickers, and run records are partitioned by ticker
+    by_ticker = defaultdict(list)
+    for job in jobs:
+        by_ticker[job["ticker"]].append(job["accession_code"])
+    completed = {}
+    for ticker, accession_codes in by_ticker.items():
+        completed.update(completed_runs(get_container(), ticker, accession_codes, analysis_type, analysis_version))
+    results = []
+    for job in jobs:
+        record = completed.get(job["accession_code"])
+        if record is not None:
+            result = _result(stage, job, analysis_type, analysis_version)
+            result.update(outcome=SKIPPED, status=record.get("status_code", 200), message="Already completed.")
+            results.append(result)
+    return [job for job in jobs if job["accession_code"] not in completed], results
+
+
+def write_results(container, results):
+    # Store the results of one flush, one ticker (partition) at a time. Results whose writes fail
+    # are marked failed so they are retried on the next run.
+    by_ticker = defaultdict(list)
+    for result in results:
+        if result["outcome"] in (STORED, EMPTY):
+            by_ticker[result["ticker"]].append(result)
+
+    for ticker, ticker_results in by_ticker.items():
+        try:
+            _write_ticker(container, ticker, ticker_results)
+        except Exception as e:
+            logging.error(f"Failed to store {len(ticker_results)} result(s) for {ticker}: {e}")
+            for result in ticker_results:
+                result.update(outcome=FAILED, status=500, message=f"Write failed: {e}")
+
+
+def _write_ticker(container, ticker, results):
+    # Holding chunks are plain upserts and go first, so a filing never references a missing chunk
+    packer = BatchPacker()
+    for result in results:
+        for document in result["documents"]:
+            full = packer.add([("upsert", (document,))])
+            if full:
+                container.execute_item_batch(full, partition_key=ticker)
+    if packer.operations:
+        container.execute_item_batch(packer.flush(), partition_key=ticker)
+
+    by_filing = defaultdict(list)
+    for result in results:
+        by_filing[result["accession_code"]].append(result)
+    accession_codes = list(by_filing)
+
+    # Each filing is updated together with its run records, in as few transactional batches as
+    # fit. A batch that loses a race with a concurrent write (404, 409, 412) is re-read and applied again.
+    for attempt in range(3):
+        filings = _read_filings(container, ticker, accession_codes)
+        batches = []
+        packer = BatchPacker()
+        batch_codes = []
+        for accession_code in accession_codes:
+            full = packer.add(_filing_operations(container, by_filing[accession_code], filings.get(accession_code)))
+            if full:
+                batches.append((full, batch_codes))
+                batch_codes = []
+            batch_codes.append(accession_code)
+        batches.append((packer.flush(), batch_codes))
+
+        retry = []
+        for batch, batch_codes in batches:
+            try:
+                container.execute_item_batch(batch, partition_key=ticker)
+            except CosmosBatchOperationError as e:
+                if e.status_code not in (404, 409, 412) or attempt == 2:
+                    raise
+                retry.extend(batch_codes)
+        if not retry:
+            return
+        accession_codes = retry
+
+
+def _read_filings(container, ticker, accession_codes):
+    filings = {}
+    for start in range(0, len(accession_codes), MAX_BATCH_OPERATIONS):
+        for filing in container.query_items(
+            "SELECT * FROM c WHERE ARRAY_CONTAINS(@ids, c.id)",
+            parameters=[{"name": "@ids", "value": accession_codes[start:start + MAX_BATCH_OPERATIONS]}],
+            partition_key=ticker,
+        ):
+            filings[filing["id"]] = filing
+    return filings
+
+
+def _filing_operations(container, results, filing):
+    first = results[0]
+    operations = []
+    stored = [result for result in results if result["outcome"] == STORED]
+    if stored:
+        analyses = []
+        fields = {}
+        supersedes = None
+        for result in stored:
+            if result["stage"] == "13f":
+                # Chunks of an earlier run are deleted together with the filing update
+                chunk_refs = [document["id"] for document in result["documents"]]
+                analyses.append(thirteenf_analysis(chunk_refs))
+                supersedes = is_13f_analysis
+                operations.extend(stale_chunk_deletes(container, first["accession_code"], first["ticker"], chunk_refs))
+            else:
+                analyses.append(result["analysis"])
+            fields.update(result["fields"])
+        if filing is None:
+            # Filings the EntryPoint never saw get the same entry it would have created
+            filing = {"id": first["accession_code"], "ticker": first["ticker"], "date": first["date"], "form": first["form"], "analyses": []}
+            operations.append(("create", (apply_analysis(filing, analyses, fields),)))
+        else:
+            # Patched into the filing, so analyses the functions store concurrently are kept
+            operations.append(filing_update_operation(filing, analyses, fields, supersedes))
+
+    for result in results:
+        record = new_run_record(result["accession_code"], result["ticker"], result["analysis_type"], result["analysis_version"])
+        operations.append(("upsert", (finished_run_record(record, result["message"], result["status"]),)))
+    return operations
+
+
+def plan_tasks(jobs, stages, checkpoint, fha_batch_size, llm_batch_size=1):
+    # (stage, jobs) tasks for every filing and stage not finished yet. FHA tasks hold up to
+    # fha_batch_size filings of one ticker, LLM tasks up to llm_batch_size filings and 13F tasks
+    # one filing each.
+    tasks = []
+    fha_by_ticker = defaultdict(list)
+    llm_jobs = []
+    for job in jobs:
+        for stage in FORM_STAGES.get(job["form"], ()):
+            if stage not in stages or checkpoint.is_finished(stage, job["accession_code"]):
+                continue
+            if stage == "fha":
+                fha_by_ticker[job["ticker"]].append(job)
+            elif stage == "llm":
+                llm_jobs.append(job)
+            else:
+                tasks.append((stage, [job]))
+
+    for ticker_jobs in fha_by_ticker.values():
+        for start in range(0, len(ticker_jobs), fha_batch_size):
+            tasks.append(("fha", ticker_jobs[start:start + fha_batch_size]))
+    for start in range(0, len(llm_jobs), llm_batch_size):
+        tasks.append(("llm", llm_jobs[start:start + llm_batch_size]))
+    return tasks
+
+
+def run_backfill(jobs, args):
+    checkpoint = Checkpoint(args.checkpoint)
+    tasks = plan_tasks(jobs, args.stages, checkpoint, args.fha_batch_size, args.llm_batch_size)
+    logging.info(f"{len(jobs)} filing(s), {len(tasks)} task(s) to run after the checkpoint")
+
+    workers = {stage: getattr(args, f"{stage}_workers") for stage in args.stages}
+    # The SEC rate limit applies per client, so it is split between every worker process
+    sec_rate = args.sec_rate / sum(workers.values())
+    llm_limits = {
+        "max_concurrency": args.llm_concurrency,
+        "tokens_per_minute": args.llm_tpm / workers["llm"] if args.llm_tpm and "llm" in workers else None,
+    }
+    context = multiprocessing.get_context("spawn")
+    executors = {
+        stage: ProcessPoolExecutor(
+            max_workers=count, mp_context=context, initializer=init_worker,
+            initargs=(sec_rate, llm_limits if stage == "llm" else None),
+        )
+        for stage, count in workers.items()
+    }
+
+    container = get_container()
+    counts = defaultdict(Counter)
+    pending_results = []
+    started = time.monotonic()
+    try:
+        futures = {
+            executors[stage].submit(STAGE_TASKS[stage], task_jobs, args.force): (stage, task_jobs)
+            for stage, task_jobs in tasks
+        }
+        remaining = set(futures)
+        while remaining:
+            done, remaining = wait(remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, task_jobs = futures.pop(future)
+                try:
+                    pending_results.extend(future.result())
+                except Exception as e:
+                    logging.error(f"{stage} failed for {len(task_jobs)} filing(s): {e}")
+                    for job in task_jobs:
+                        pending_results.append(dict(_result(stage, job, stage, None), outcome=FAILED, status=500, message=str(e)))
+
+            if len(pending_results) >= args.write_batch_size or not remaining:
+                _flush(container, pending_results, checkpoint, counts)
+                pending_results = []
+                _log_progress(counts, len(tasks) - len(remaining), len(tasks), started)
+    finally:
+        if pending_results:
+            _flush(container, pending_results, checkpoint, counts)
+        for executor in executors.values():
+            executor.shutdown(cancel_futures=True)
+        checkpoint.close()
+
+    return counts, time.monotonic() - started
+
+
+def _flush(container, results, checkpoint, counts):
+    write_results(container, results)
+    checkpoint.record(results)
+    for result in results:
+        counts[result["stage"]][result["outcome"]] += 1
+
+
+def _log_progress(counts, tasks_done, tasks_total, started):
+    processed = sum(count[STORED] + count[EMPTY] for count in counts.values())
+    minutes = (time.monotonic() - started) / 60
+    logging.info(f"{tasks_done}/{tasks_total} task(s) done, {processed / minutes if minutes else 0:.1f} filing analyses/min")
+
+
+def report(counts, elapsed):
+    minutes = elapsed / 60
+    print(f"Backfill finished in {minutes:.1f} min")
+    total = 0
+    for stage in STAGES:
+        if stage not in counts:
+            continue
+        count = counts[stage]
+        processed = count[STORED] + count[EMPTY]
+        total += processed
+        print(f"  {stage:<4} {count[STORED]} stored, {count[EMPTY]} empty, {count[SKIPPED]} skipped, "
+              f"{count[FAILED]} failed, {processed / minutes if minutes else 0:.1f} filings/min")
+    print(f"  total {total} filing analyses, {total / minutes if minutes else 0:.1f} filings/min")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Backfill analyses for many SEC filings.")
+    parser.add_argument("--input", action="append", help="CSV or JSON lines file of filings (accession_code, ticker, date, form)")
+    parser.add_argument("--edgar-index", action="append", help="EDGAR quarterly index to backfill, e.g. 2024Q1")
+    parser.add_argument("--ticker", action="append", help="Backfill the filing history of a ticker")
+    parser.add_argument("--forms", default="10-K,10-Q,13F-HR", help="Comma-separated forms to backfill")
+    parser.add_argument("--stages", default=",".join(STAGES), help="Comma-separated analyses to run: fha, 13f, llm")
+    parser.add_argument("--fha-workers", type=int, default=2, help="Processes for the financial health analysis")
+    parser.add_argument("--13f-workers", dest="13f_workers", type=int, default=2, help="Processes for the 13F analysis")
+    parser.add_argument("--llm-workers", type=int, default=4, help="Processes for the LLM analysis")
+    parser.add_argument("--fha-batch-size", type=int, default=25, help="Filings of one ticker per financial health task")
+    parser.add_argument("--llm-batch-size", type=int, default=8, help="Filings per LLM task, analyzed concurrently")
+    parser.add_argument("--llm-concurrency", type=int, default=8, help="Filings analyzed at once per LLM process")
+    parser.add_argument("--llm-tpm", type=float, help="Model tokens per minute over all LLM processes, for openai clients built on the LLM limiter's transport")
+    parser.add_argument("--sec-rate", type=float, default=DEFAULT_SEC_RATE, help="EDGAR requests per second over all processes")
+    parser.add_argument("--write-batch-size", type=int, default=50, help="Results collected before they are written to Cosmos DB")
+    parser.add_argument("--checkpoint", default="backfill_checkpoint.jsonl", help="Progress file used to resume an interrupted run")
+    parser.add_argument("--limit", type=int, help="Only backfill the first N filings")
+    parser.add_argument("--force", action="store_true", help="Rerun analyses that are already completed")
+    args = parser.parse_args(argv)
+
+    args.forms = [form.strip() for form in args.forms.split(",") if form.strip()]
+    args.stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    unknown = set(args.stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stage(s): {', '.join(sorted(unknown))}")
+    if not (args.input or args.edgar_index or args.ticker):
+        parser.error("one of --input, --edgar-index or --ticker is required")
+    return args
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    args = parse_args(argv)
+    jobs = load_jobs(args)
+    counts, elapsed = run_backfill(jobs, args)
+    report(counts, elapsed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Import-time profile of the function app: what loading each function costs a cold worker.
+
+The Python worker imports the script of every function in the app when it starts, before the first
+request is served, so the imports of all functions add to a cold start. Each function is imported
+in a fresh interpreter with -X importtime, and its import time is reported per top-level package,
+heaviest first, followed by all functions imported together the way the worker loads them. The
+check fails when an import takes longer than its budget or does not succeed at all.
+
+    python scripts/profile_imports.py
+    python scripts/profile_imports.py --budget-ms 400 --budget FinancialHealth=600 --top 15
+    python scripts/profile_imports.py --function EntryPoint --repeat 5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from collections import Counter
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "TL74Functions")
+
+# Name of the row importing every function in one interpreter
+APP = "(app)"
+
+DEFAULT_BUDGET_MS = 500
+DEFAULT_APP_BUDGET_MS = 600
+
+# Written to stderr right before the profiled imports, so interpreter startup is left out
+MARKER = "profile_imports: begin"
+
+
+def function_modules(app_dir, names=None):
+    # {function name: module the worker imports for it}, for every folder with a function.json
+    modules = {}
+    for name in sorted(os.listdir(app_dir)):
+        path = os.path.join(app_dir, name, "function.json")
+        if not os.path.isfile(path) or (names and name not in names):
+            continue
+        with open(path) as f:
+            script = os.path.splitext(json.load(f).get("scriptFile", "__init__.py"))[0]
+        modules[name] = name if script == "__init__" else f"{name}.{script}"
+    return modules
+
+
+def profile(app_dir, modules):
+    # (total seconds, Counter of seconds per top-level package, error) of importing modules in a
+    # fresh interpreter
+    code = f"import sys; sys.stderr.write({MARKER!r} + '\\n'); sys.stderr.flush()\n"
+    code += "".join(f"import {module}\n" for module in modules)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [app_dir, os.environ.get("PYTHONPATH")])))
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code], cwd=app_dir, env=env, capture_output=True, text=True
+    )
+
+    lines = process.stderr.splitlines()
+    lines = lines[lines.index(MARKER) + 1:] if MARKER in lines else []
+    total = 0.0
+    packages = Counter()
+    errors = []
+    for line in lines:
+        if not line.startswith("import time:"):
+            errors.append(line)
+            continue
+        try:
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            self_seconds = int(self_us) / 1e6
+            cumulative_seconds = int(cumulative_us) / 1e6
+        except ValueError:
+            # The header line
+            continue
+        if not name.startswith("  "):
+            total += cumulative_seconds
+        packages[name.strip().split(".")[0]] += self_seconds
+
+    error = None
+    if process.returncode != 0:
+        error = next((line for line in reversed(errors) if line.strip()), f"exit code {process.returncode}")
+    return total, packages, error
+
+
+def best_profile(app_dir, modules, repeat):
+    # The fastest of repeat runs, which is the least disturbed by the rest of the machine
+    runs = [profile(app_dir, modules) for _ in range(repeat)]
+    return min(runs, key=lambda run: (run[2] is not None, run[0]))
+
+
+def budget(value):
+    name, _, milliseconds = value.partition("=")
+    try:
+        return name, float(milliseconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected NAME=MS, got {value!r}")
+
+
+def report(name, total, packages, error, budget_ms, top):
+    over = error is not None or total * 1000 > budget_ms
+    status = "FAILED" if error is not None else "OVER BUDGET" if over else "ok"
+    print(f"{name:22} {total * 1000:8.1f} ms  budget {budget_ms:7.0f} ms  {status}")
+    if error is not None:
+        print(f"    {error}")
+    for package, seconds in packages.most_common(top):
+        print(f"    {package:30} {seconds * 1000:8.1f} ms")
+    return not over
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--app-dir", default=APP_DIR, help="function app folder (default: TL74Functions)")
+    parser.add_argument("--function", action="append", help="only profile this function (repeatable)")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS, help="import budget of each function")
+    parser.add_argument("--app-budget-ms", type=float, default=DEFAULT_APP_BUDGET_MS, help="import budget of all functions together")
+    parser.add_argument("--budget", action="append", type=budget, default=[], metavar="NAME=MS", help="budget of one function, or of (app)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per import, the fastest is reported")
+    parser.add_argument("--top", type=int, default=8, help="packages listed per import")
+    args = parser.parse_args(argv)
+
+    app_dir = os.path.abspath(args.app_dir)
+    budgets = dict(args.budget)
+    modules = function_modules(app_dir, args.function)
+    if not modules:
+        parser.error(f"No functions found in {app_dir}")
+
+    within_budget = True
+    for name, module in modules.items():
+        total, packages, error = best_profile(app_dir, [module], args.repeat)
+        within_budget &= report(name, total, packages, error, budgets.get(name, args.budget_ms), args.top)
+
+    if len(modules) > 1:
+        total, packages, error = best_profile(app_dir, list(modules.values()), args.repeat)
+        within_budget &= report(APP, total, packages, error, budgets.get(APP, args.app_budget_ms), args.top)
+
+    sys.exit(0 if within_budget else 1)
+
+
+if __name__ == "__main__":
+    main()
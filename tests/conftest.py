@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The functions import their shared code as "shared_code", relative to the function app, and the tests
+# use the in-memory Cosmos DB container of the offline benchmarks
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "TL74Functions"), ROOT]
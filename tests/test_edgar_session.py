@@ -0,0 +1,56 @@
+import asyncio
+import os
+import time
+
+import httpx
+from edgar import httprequests
+
+from shared_code.edgar_session import EdgarSession, reset_edgar_session, set_edgar_session
+
+
+def test_edgartools_requests_go_through_the_shared_session(monkeypatch):
+    monkeypatch.setattr(httprequests, "httpx", httprequests.httpx)
+    monkeypatch.setenv("EDGAR_IDENTITY", "Someone else other@example.com")
+    seen = []
+
+    def respond(request):
+        seen.append((str(request.url), request.headers["User-Agent"]))
+        return httpx.Response(200, content=b"filing", headers={"Content-Type": "text/plain"})
+
+    session = EdgarSession(identity="Test Agent test@example.com", transport=httpx.MockTransport(respond), rate=1000)
+    set_edgar_session(session)
+    try:
+        assert os.environ["EDGAR_IDENTITY"] == "Test Agent test@example.com"
+
+        assert httprequests.get_with_retry("https://www.sec.gov/sync.txt").content == b"filing"
+        response = asyncio.run(httprequests.get_with_retry_async("https://www.sec.gov/async.txt"))
+        assert response.content == b"filing"
+
+        assert seen == [
+            ("https://www.sec.gov/sync.txt", "Test Agent test@example.com"),
+            ("https://www.sec.gov/async.txt", "Test Agent test@example.com"),
+        ]
+        assert session.stats["requests"] == 2
+    finally:
+        reset_edgar_session()
+
+
+def test_throttlers_created_after_install_do_not_wait(monkeypatch):
+    monkeypatch.setattr(httprequests, "httpx", httprequests.httpx)
+    session = EdgarSession(identity="Test Agent test@example.com",
+                           transport=httpx.MockTransport(lambda request: httpx.Response(200)), rate=1000)
+    set_edgar_session(session)
+    try:
+        throttler = httprequests.Throttler(httprequests.RequestRate(max_requests=1, time_window=5))
+        started = time.monotonic()
+        for _ in range(3):
+            throttler.wait_for_ticket()
+        assert time.monotonic() - started < 0.5
+    finally:
+        reset_edgar_session()
+
+    # Once edgartools is back on its own client, its throttle applies again
+    monkeypatch.undo()
+    throttler = httprequests.Throttler(httprequests.RequestRate(max_requests=1, time_window=60))
+    throttler.wait_for_ticket()
+    assert not throttler.get_ticket()
@@ -0,0 +1,30 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from benchmarks.offline.fake_cosmos import FakeContainer
+from shared_code.filing_store import append_analysis
+
+WRITERS = 16
+
+
+@pytest.mark.parametrize("filing", [
+    {"id": "0001-24-000001", "ticker": "ACME", "analyses": []},
+    # Without the array the writers fall back to the conditional replace
+    {"id": "0001-24-000001", "ticker": "ACME"},
+])
+def test_concurrent_writers_lose_no_analysis(filing):
+    container = FakeContainer([filing], latency=0.002)
+    start = threading.Barrier(WRITERS)
+
+    def write(index):
+        start.wait()
+        append_analysis(container, filing["id"], filing["ticker"], {"writer": index}, {f"field_{index}": index})
+
+    with ThreadPoolExecutor(max_workers=WRITERS) as executor:
+        list(executor.map(write, range(WRITERS)))
+
+    stored = container.read_item(item=filing["id"], partition_key=filing["ticker"])
+    assert sorted(analysis["writer"] for analysis in stored["analyses"]) == list(range(WRITERS))
+    assert all(stored[f"field_{index}"] == index for index in range(WRITERS))
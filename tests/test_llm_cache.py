@@ -0,0 +1,73 @@
+import asyncio
+import sqlite3
+import threading
+
+import httpx
+import openai
+import pytest
+
+from shared_code import llm_cache
+from shared_code.llm_cache import LLMCache, llm_cache_scope
+
+COMPLETION = {
+    "id": "chatcmpl-1", "object": "chat.completion", "created": 1, "model": "gpt-4o-mini",
+    "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "ok"}}],
+    "usage": {"prompt_tokens": 3, "completion_tokens": 4, "total_tokens": 7},
+}
+
+
+def test_cache_closes_its_connections(tmp_path, monkeypatch):
+    cache = LLMCache(str(tmp_path / "llm_cache.sqlite3"), max_bytes=64)
+    opened = []
+    connect = cache._connect
+
+    def tracked_connect():
+        connection = connect()
+        opened.append(connection)
+        return connection
+
+    monkeypatch.setattr(cache, "_connect", tracked_connect)
+
+    assert cache.tokens("0001", "cl100k_base", "text", lambda: [1, 2, 3]) == [1, 2, 3]
+    assert cache.tokens("0001", "cl100k_base", "text", lambda: []) == [1, 2, 3]
+    cache.store_completion({"model": "gpt-4o-mini", "messages": []}, {"choices": ["x" * 100]})
+    assert cache.total_bytes() <= 64
+
+    assert opened
+    for connection in opened:
+        with pytest.raises(sqlite3.ProgrammingError):
+            connection.execute("SELECT 1")
+
+
+def test_async_completions_use_the_cache_off_the_event_loop(tmp_path, monkeypatch):
+    monkeypatch.setenv("LLM_CACHE_PATH", str(tmp_path / "llm_cache.sqlite3"))
+    monkeypatch.setattr(llm_cache, "_cache", None)
+    requests = []
+    cache_threads = set()
+    connect = LLMCache._connect
+
+    def tracked_connect(self):
+        cache_threads.add(threading.get_ident())
+        return connect(self)
+
+    monkeypatch.setattr(LLMCache, "_connect", tracked_connect)
+
+    def respond(request):
+        requests.append(request)
+        return httpx.Response(200, json=COMPLETION)
+
+    async def ask():
+        client = openai.AsyncOpenAI(api_key="test", http_client=httpx.AsyncClient(transport=httpx.MockTransport(respond)))
+        with llm_cache_scope("0001"):
+            cache_threads.clear()
+            responses = [
+                await client.chat.completions.create(model="gpt-4o-mini", messages=[{"role": "user", "content": "hi"}])
+                for _ in range(2)
+            ]
+        return threading.get_ident(), responses
+
+    loop_thread, responses = asyncio.run(ask())
+
+    assert len(requests) == 1
+    assert [response.choices[0].message.content for response in responses] == ["ok", "ok"]
+    assert cache_threads and loop_thread not in cache_threads
@@ -0,0 +1,55 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import openai
+
+from shared_code.llm_concurrency import LimitedTransport, configure_llm_limiter
+
+COMPLETION = {
+    "id": "chatcmpl-1", "object": "chat.completion", "created": 1, "model": "gpt-4o-mini",
+    "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "ok"}}],
+    "usage": {"prompt_tokens": 3, "completion_tokens": 4, "total_tokens": 7},
+}
+
+
+def test_limited_clients_share_the_concurrency_limit():
+    limiter = configure_llm_limiter(max_concurrency=2)
+    in_flight = [0, 0]
+    lock = threading.Lock()
+
+    def respond(request):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight[1], in_flight[0])
+        time.sleep(0.02)
+        with lock:
+            in_flight[0] -= 1
+        return httpx.Response(200, json=COMPLETION)
+
+    clients = [
+        openai.OpenAI(api_key="test", http_client=httpx.Client(transport=LimitedTransport(httpx.MockTransport(respond))))
+        for _ in range(2)
+    ]
+
+    def ask(index):
+        return clients[index % 2].chat.completions.create(model="gpt-4o-mini", messages=[{"role": "user", "content": "hi"}])
+
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        responses = list(executor.map(ask, range(6)))
+
+    assert [response.choices[0].message.content for response in responses] == ["ok"] * 6
+    assert in_flight[1] == 2
+    # Charged with the usage the model reported
+    assert limiter.stats["requests"] == 6 and limiter.stats["tokens"] == 42
+
+
+def test_clients_without_a_limited_transport_are_not_limited():
+    limiter = configure_llm_limiter(max_concurrency=1)
+    client = openai.OpenAI(api_key="test", http_client=httpx.Client(
+        transport=httpx.MockTransport(lambda request: httpx.Response(200, content=json.dumps(COMPLETION)))
+    ))
+    client.chat.completions.create(model="gpt-4o-mini", messages=[{"role": "user", "content": "hi"}])
+    assert limiter.stats["requests"] == 0
@@ -0,0 +1,22 @@
+import pandas as pd
+
+from FinancialHealth.metrics import evaluate_metrics
+
+
+def test_int_metrics_stay_exact_above_float_precision():
+    assets = 2 ** 60 + 3
+    facts = pd.DataFrame(
+        {"Assets": [assets, 10.7], "StockholdersEquity": [1, 2.2],
+         "Revenues": ["123456789012345678901", 5], "NetIncomeLoss": [1, "n/a"]},
+        index=["0001", "0002"], dtype=object,
+    )
+
+    calculated = evaluate_metrics(facts)
+
+    assert calculated["0001"]["Liabilities"]["Value"] == str(assets - 1)
+    assert calculated["0001"]["Expenses"]["Value"] == "123456789012345678900"
+    assert calculated["0001"]["Assets"]["Value"] == str(assets)
+    # Values are truncated like int() before subtracting, and a fact that is not a number is missing
+    assert calculated["0002"]["Liabilities"]["Value"] == "8"
+    assert calculated["0002"]["Expenses"]["Value"] == "N/A"
+    assert calculated["0002"]["Expenses"]["If Missing"] == "YES"
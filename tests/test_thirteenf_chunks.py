@@ -0,0 +1,60 @@
+import pytest
+from azure.cosmos.exceptions import CosmosBatchOperationError
+
+from benchmarks.offline.fake_cosmos import FakeContainer
+from shared_code import thirteenf_chunks
+from shared_code.thirteenf_chunks import read_13f_holdings, store_13f_holdings
+from shared_code.thirteenf_diff import chunk_refs_of
+
+ACCESSION_CODE = "0001-24-000001"
+
+
+class FailingContainer(FakeContainer):
+    # Fails every transactional batch after the first fail_after ones
+    def __init__(self, documents, fail_after):
+        super().__init__(documents)
+        self.fail_after = fail_after
+        self.batches = 0
+
+    def execute_item_batch(self, batch_operations, partition_key, **kwargs):
+        self.batches += 1
+        if self.batches > self.fail_after:
+            raise CosmosBatchOperationError(
+                error_index=0, headers={}, status_code=503, message="Unavailable", operation_responses=[]
+            )
+        return super().execute_item_batch(batch_operations, partition_key, **kwargs)
+
+
+def holdings(run, count):
+    return [{"cusip": f"C{index:05d}", "nameOfIssuer": f"Issuer {index}", "sshPrnamt": run, "value": run} for index in range(count)]
+
+
+def stored_holdings(container):
+    filing = container.read_item(item=ACCESSION_CODE, partition_key="FUND")
+    return list(read_13f_holdings(container, "FUND", chunk_refs_of(filing)))
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    # A few holdings per chunk, so the holdings need several transactional batches
+    monkeypatch.setattr(thirteenf_chunks, "MAX_DOC_SIZE", 400)
+
+
+def test_interrupted_rerun_keeps_the_previous_chunks(small_chunks):
+    container = FakeContainer()
+    filing = {"id": ACCESSION_CODE, "ticker": "FUND", "date": "2024-05-15", "form": "13F-HR", "analyses": []}
+    container.upsert_item(filing)
+    first = store_13f_holdings(container, container.read_item(item=ACCESSION_CODE, partition_key="FUND"), holdings(1, 600))
+    assert len(first) > thirteenf_chunks.MAX_BATCH_OPERATIONS
+
+    failing = FailingContainer(container.snapshot(), fail_after=1)
+    with pytest.raises(CosmosBatchOperationError):
+        store_13f_holdings(failing, failing.read_item(item=ACCESSION_CODE, partition_key="FUND"), holdings(2, 600))
+    assert failing.batches == 2
+    assert stored_holdings(failing) == holdings(1, 600)
+
+    # The retry switches to its chunks and deletes those of both earlier runs
+    retry = FakeContainer(failing.snapshot())
+    chunk_refs = store_13f_holdings(retry, retry.read_item(item=ACCESSION_CODE, partition_key="FUND"), holdings(3, 600))
+    assert stored_holdings(retry) == holdings(3, 600)
+    assert sorted(key[1] for key in retry.documents if "::chunk_" in key[1]) == sorted(chunk_refs)
@@ -0,0 +1,31 @@
+from benchmarks.offline.fake_cosmos import FakeContainer
+from shared_code.orchestration import new_orchestration
+from shared_code.thirteenf_chunks import iter_13f_chunks, thirteenf_analysis
+from shared_code.thirteenf_diff import PositionIndex, previous_13f_filing, store_13f_diff
+
+
+def holding(cusip, shares, value):
+    return {"cusip": cusip, "nameOfIssuer": cusip, "sshPrnamt": shares, "value": value}
+
+
+def test_previous_filing_skips_documents_sharing_its_form_and_date():
+    container = FakeContainer()
+    # Stored before the filing, so the fake returns it first when the dates tie
+    container.upsert_item(new_orchestration("0001-24-000001", "FUND", "2024-02-14", "13F-HR", []))
+    chunks = list(iter_13f_chunks("0001-24-000001", "FUND", [holding("AAA", 100, 1000)]))
+    for chunk in chunks:
+        container.upsert_item(chunk)
+    container.upsert_item({
+        "id": "0001-24-000001", "ticker": "FUND", "date": "2024-02-14", "form": "13F-HR",
+        "analyses": [thirteenf_analysis([chunk["id"] for chunk in chunks])],
+    })
+    filing = {"id": "0001-24-000002", "ticker": "FUND", "date": "2024-05-15", "form": "13F-HR", "analyses": []}
+    container.upsert_item(filing)
+
+    assert previous_13f_filing(container, filing)["id"] == "0001-24-000001"
+
+    current = PositionIndex()
+    for entry in [holding("AAA", 150, 1500), holding("BBB", 10, 100)]:
+        current.add(entry)
+    summary = store_13f_diff(container, filing, current)
+    assert summary == {"new": 1, "closed": 0, "increased": 1, "decreased": 0, "unchanged": 0}
@@ -0,0 +1,71 @@
+import json
+
+import pytest
+
+from shared_code import work_queue
+from shared_code.work_queue import get_work_queue, run_queued_analysis, run_worker
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def queue_backend(request, monkeypatch, tmp_path):
+    monkeypatch.setenv("WORK_QUEUE_BACKEND", request.param)
+    monkeypatch.setenv("WORK_QUEUE_SQLITE_PATH", str(tmp_path / "work_queue.sqlite3"))
+    monkeypatch.setattr(work_queue, "_queues", {})
+    return request.param
+
+
+def test_run_worker_completes_retries_and_dead_letters(queue_backend):
+    queue = get_work_queue("fha-requests")
+    for accession_code in ("0001", "0002", "0003"):
+        queue.send({"accession_code": accession_code, "ticker": "AAPL"})
+    attempts = {}
+
+    def handler(body):
+        accession_code = body["accession_code"]
+        attempts[accession_code] = attempts.get(accession_code, 0) + 1
+        # 0002 succeeds on its second attempt, 0003 never does
+        if accession_code == "0003" or (accession_code == "0002" and attempts[accession_code] < 2):
+            raise RuntimeError("analysis failed")
+
+    stats = run_worker(queue, handler, concurrency=2, max_dequeue_count=3, visibility_timeout=0)
+
+    assert stats == {"completed": 2, "retried": 3, "dead_lettered": 1}
+    assert attempts == {"0001": 1, "0002": 2, "0003": 3}
+    assert len(queue) == 0
+
+    poison = get_work_queue("fha-requests-poison")
+    assert len(poison) == 1
+    assert [message.body for message in poison.receive(max_messages=10)] == [{"accession_code": "0003", "ticker": "AAPL"}]
+
+
+def test_run_queued_analysis_raises_on_server_errors_only():
+    payloads = []
+
+    def wrapper(status_code):
+        def analyse(request):
+            payloads.append(json.loads(request.get_body()))
+            return f"status {status_code}", status_code
+        return analyse
+
+    payload = {"accession_code": "0001", "ticker": "AAPL", "date": "2024-01-01", "form": "10-K"}
+
+    with pytest.raises(RuntimeError, match="503"):
+        run_queued_analysis(payload, wrapper(503))
+    # A client error is permanent: it is logged and the message is completed, not retried
+    assert run_queued_analysis(payload, wrapper(404)) == ("status 404", 404)
+    assert run_queued_analysis(payload, wrapper(200)) == ("status 200", 200)
+    assert payloads == [payload] * 3
+
+
+def test_run_worker_dead_letters_analyses_that_keep_failing(queue_backend):
+    queue = get_work_queue("llm-requests")
+    queue.send({"accession_code": "0001", "ticker": "AAPL"})
+
+    def failing_wrapper(request):
+        return "Cosmos DB unavailable", 500
+
+    stats = run_worker(queue, lambda body: run_queued_analysis(body, failing_wrapper),
+                       max_dequeue_count=2, visibility_timeout=0)
+
+    assert stats == {"completed": 0, "retried": 1, "dead_lettered": 1}
+    assert len(get_work_queue("llm-requests-poison")) == 1